@@ -1,7 +1,14 @@
 from gmusicapi import Mobileclient
 from gmusicapi import Webclient
 import re
-from Song import Song
+import time
+import threading
+from urlparse import urlparse, parse_qs
+from shared import *
+from Song import SongMap
+from library import LibrarySnapshot
+from search import LibraryIndex
+from metrics import getMetrics
 
 class Account:
 	'''
@@ -18,8 +25,28 @@ class Account:
 				Google Play account	
 			*_authenticated: a boolean for whether or not the account is
 				succesfully logged in
+			*_deviceID: the mobile device ID used to get stream URLs, resolved
+				once per session. None until first needed
+			*_streamUrls: a dictionary of songID:(url, expiry time) pairs for
+				stream URLs that have been obtained and are still valid
+			*_urlCacheHits, _urlCacheMisses: the number of calls to
+				getStreamUrl that were and were not answered from _streamUrls
+			*_cacheLock: protects _streamUrls and the counters, which are used
+				from buffer threads
+			*_deviceLock: ensures the device ID is only looked up once
+			*_library: a LibrarySnapshot of the account's tracks, kept on disc
+				between sessions
+			*_index: a LibraryIndex for searching the tracks, built on a
+				thread once the library is loaded and synced
 	'''
 
+	# stream URLs are dropped from the cache this many seconds before they
+	# expire, so that a URL is never handed out just before it stops working
+	URL_EXPIRY_MARGIN = 30
+
+	# lifetime assumed for a stream URL that does not say when it expires
+	DEFAULT_URL_LIFETIME = 60
+
 	def __init__(self):
 		'''
 		Default constructor. Initializes _mobile and _web but does not log in.
@@ -28,6 +55,9 @@ class Account:
 		self._mobile = Mobileclient()
 		self._web = Webclient()
 		self._authenticated = False
+		self._initCaches()
+		self._library = LibrarySnapshot()
+		self._index = LibraryIndex()
 
 	def __init__(self, username, password):
 		'''
@@ -41,6 +71,7 @@ class Account:
 		self._mobile = Mobileclient()
 		self._web = Webclient()
 		self._authenticated = False
+		self._initCaches()
 		self.login(username, password)
 
 	def login(self, username, password):
@@ -55,6 +86,10 @@ class Account:
 		:param password: The password corresponding to the username
 		'''
 
+		# each account keeps its own snapshot of its library
+		self._library = LibrarySnapshot('library-' + username + '.dat')
+		self._index = LibraryIndex()
+
 		webSuccess = self._web.login(username, password)
 		if not webSuccess:
 			self._web = None
@@ -64,6 +99,7 @@ class Account:
 			self._mobile = None
 
 		self._authenticated = webSuccess and mobileSuccess
+		self.clearCaches()
 		return self._authenticated
 
 	def isAuthenticated(self):
@@ -84,6 +120,7 @@ class Account:
 
 		#if either of the interfacs is logged out, we are not authenticated
 		self._authenticated = not(webSuccess or mobileSuccess)
+		self.clearCaches()
 
 		#the operation was not successful unless both are logged out
 		return webSuccess and mobileSuccess
@@ -117,22 +154,57 @@ class Account:
 
 		return None
 
+	def deviceID(self):
+		'''
+		Returns the mobile device ID used to obtain stream URLs. The registered
+		devices are only looked up the first time this is called in a session.
+		'''
+
+		# a separate lock so that cached URLs can be handed out while the
+		# devices are being looked up
+		with self._deviceLock:
+			if self._deviceID is None:
+				with getMetrics().span('deviceId'):
+					self._deviceID = self.validMobileDeviceID()
+			return self._deviceID
+
 	def getAllSongs(self):
 		'''
-		Return a dictionary of title:Song pairs for each song in the library.
+		Return a dictionary of songID:Song pairs for each song in the library,
+		a SongMap creating each Song when it is first used. The library is
+		loaded from the local snapshot, and only the changes since the last
+		session are fetched. The search index is then built on a thread, so
+		songs can play while it is built.
 		'''
 
-		ret = {}
-		allSongs = self._mobile.get_all_songs()
-		for song in allSongs:
-			if song['title'] not in ret:
-				ret[song['title']] = Song(song, self)
+		self._library.load()
+		try:
+			self._library.sync(self._mobile)
+			self._library.save()
+		except Exception as e:
+			# play whatever we have from the last session
+			log('Unable to sync library, using local snapshot', console = True)
+			log('\t' + str(e))
 
-		return ret
+		self._library.setIndex(self._index, background = True)
+		return SongMap(self._library.store(), self)
+
+	def search(self, query, limit = LibraryIndex.DEFAULT_LIMIT):
+		'''
+		Return a list of the IDs of up to limit songs matching query, best
+		first. See LibraryIndex. Empty until getAllSongs is called, and waits
+		for the index to be built after that.
+		'''
+		return self._index.search(query, limit)
+
+	def libraryIndex(self):
+		return self._index
 
 	def getStreamUrl(self, songID, deviceID = None):
 		'''
-		Return a  playable URL corresponding to the given song
+		Return a  playable URL corresponding to the given song. URLs are cached
+		per song until shortly before they expire, so asking for the same song
+		again (eg when going back a track) does not make a request.
 
 		Note: Due to the current (4/22/15) implementation of the
 		gmusic api, makes an unverified https request causing a
@@ -141,21 +213,96 @@ class Account:
 		risk.
 		'''
 
+		with self._cacheLock:
+			if songID in self._streamUrls:
+				url, expiry = self._streamUrls[songID]
+				if time.time() < expiry:
+					self._urlCacheHits += 1
+					return url
+				del self._streamUrls[songID]
+			self._urlCacheMisses += 1
+
 		if deviceID is None:
-			deviceID = self.validMobileDeviceID()
+			deviceID = self.deviceID()
 		try:
 			#the unverified request happens here
 			import urllib3
 			urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-			url = self._mobile.get_stream_url(songID, deviceID)
-
-			return url
+			with getMetrics().span('streamUrl', song = songID):
+				url = self._mobile.get_stream_url(songID, deviceID)
 
 		except RuntimeError as e:
 			log('Exception in getStreamUrl: ')
 			log( e)
 			return None
 
+		if url:
+			with self._cacheLock:
+				self._removeExpiredUrls()
+				self._streamUrls[songID] = (url, self._urlExpiry(url))
+
+		return url
+
+	def invalidateStreamUrl(self, songID):
+		'''
+		Drop the cached stream URL for the given song, eg because the server
+		rejected it. The next call to getStreamUrl will request a new one.
+		'''
+
+		with self._cacheLock:
+			self._streamUrls.pop(songID, None)
+
+	def cacheStats(self):
+		'''
+		Return a dictionary with the number of stream URL cache hits and misses
+		and the number of URLs currently cached
+		'''
+
+		with self._cacheLock:
+			return {'hits': self._urlCacheHits,
+					'misses': self._urlCacheMisses,
+					'size': len(self._streamUrls)}
+
+	def clearCaches(self):
+		'''
+		Forget the device ID and all stream URLs. Called when the session changes
+		'''
+
+		with self._cacheLock:
+			self._deviceID = None
+			self._streamUrls = {}
+
+	def _initCaches(self):
+		self._cacheLock = threading.Lock()
+		self._deviceLock = threading.Lock()
+		self._deviceID = None
+		self._streamUrls = {}
+		self._urlCacheHits = 0
+		self._urlCacheMisses = 0
+
+	def _urlExpiry(self, url):
+		'''
+		Return the time after which a cached stream URL should no longer be
+		used. Signed stream URLs carry their expiry time, in seconds since the
+		epoch, in the 'expire' query parameter.
+		'''
+
+		expire = parse_qs(urlparse(url).query).get('expire')
+		try:
+			return int(expire[0]) - self.URL_EXPIRY_MARGIN
+		except (TypeError, ValueError):
+			return time.time() + self.DEFAULT_URL_LIFETIME
+
+	def _removeExpiredUrls(self):
+		'''
+		Drop expired URLs from the cache. Caller must hold _cacheLock
+		'''
+
+		now = time.time()
+		for songID, (url, expiry) in self._streamUrls.items():
+			if expiry <= now:
+				del self._streamUrls[songID]
+
 	def __del__(self):
 		'''
 		Logout of the connection before closing the account
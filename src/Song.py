@@ -1,16 +1,20 @@
 from shared import *
+from transport import getTransport
+from download import RangeDownload
+from library import LibraryStore
+from metrics import getMetrics
+import time
 import urllib3
-import certifi
 
-class Song:
+class Song(object):
 	'''
-	A class representing a song
-
-	TODO: implement function to write album art to file
+	A class representing a song. A Song is a lightweight handle on a row of
+	a LibraryStore, which holds the song's information.
 
 	Members:
 		Public:
-			* data: the dictionary representing the song
+			* data: a dictionary representing the song, built from the store
+				on each access
 
 
 			*play(): begin playback of the song
@@ -19,61 +23,116 @@ class Song:
 			*title()
 			*artist()
 			*album()
+			*genre()
+			*year()
 			*rating(): the rating(thumbs up, thumbs down, or none)
+			*playCount()
 			*lastPlayed()
+			*albumArtUrl()
+			*writeAlbumArtToFile(filename)
 			*bpm()
+			*store(): the LibraryStore holding the song's information
+			*row(): the song's row in store()
 
 		Private:
 			*streamUrl(): returns a playableURL for the song
 
+			*_refreshStreamUrl(): returns a new playable URL for the song
+
 			*id(): returns the Google id code for the song
 
+			*_store: the LibraryStore holding the song's information
+
+			*_row: the song's row in _store
+
 			*_account: the account which owns the song
 	'''
 
-	def __init__(self, data, account):
+	__slots__ = ('_store', '_row', '_account')
+
+	def __init__(self, store, row, account):
 		'''
 		Constructor for a song with the given information
-		:param data: a dictionary representing the song
+		:param store: the LibraryStore holding the song
+		:param row: the song's row in store
 		:param account: the account to which the song belongs
 		'''
-		self.data = data
+		self._store = store
+		self._row = row
 		self._account = account
-		self._song = None
-<<<<<<< HEAD
-		self._exitFlag = False
-=======
->>>>>>> master
+
+	@classmethod
+	def fromData(cls, data, account):
+		'''
+		Create a song from a dictionary as returned by the API, in a store of
+		its own
+		'''
+		store = LibraryStore()
+		return cls(store, store.put(data), account)
+
+	@property
+	def data(self):
+		return self._store.track(self._row)
 
 	def title(self):
-		return self.data['title']
+		return self._store.get(self._row, 'title')
 
-	def id(self):
+	def artist(self):
+		return self._store.get(self._row, 'artist')
+
+	def album(self):
+		return self._store.get(self._row, 'album')
+
+	def genre(self):
+		return self._store.get(self._row, 'genre')
+
+	def year(self):
+		return self._store.get(self._row, 'year')
+
+	def rating(self):
+		return self._store.get(self._row, 'rating')
+
+	def playCount(self):
+		return self._store.get(self._row, 'playCount')
+
+	def lastPlayed(self):
 		'''
-		Returns the song id, which can be used to get URLs for the song
+		Returns the time the song was last played, in microseconds since the
+		epoch, or 0 if unknown
 		'''
+		return self._store.get(self._row, 'recentTimestamp')
 
-		#try to find the id in the song dictionary
-		if 'id' in self.data:
-			return self.data['id'].encode('utf-8')
-		elif 'nid' in self.data:
-			# all access ids are stored as 'nid'
-			return self.data['nid'].encode('utf-8')
+	def albumArtUrl(self):
+		return self._store.get(self._row, 'albumArtUrl')
 
-		#the lengths of each segment separated by a '-' in a song id
-		#IDFORMAT = [8,4,4,4,12]
+	def duration(self):
+		'''
+		Returns the length of the song in milliseconds, or None if unknown
+		'''
+		duration = self._store.get(self._row, 'durationMillis')
+		if duration:
+			return duration
+		return None
+
+	def store(self):
+		'''
+		Returns the LibraryStore holding the song's information
+		'''
+		return self._store
+
+	def row(self):
+		'''
+		Returns the song's row in store()
+		'''
+		return self._row
 
-		#the actual key for the id data varies, sometimes it is something like
-		#nid or storeid, so we search for anything containing 'id' with the
-		#proper format
-		#for key in self.data:
-		#	if 'id' in key:
-		#		format = string.split(self.data[key], '-')
-		#		if [len(subString) for subString in format] == IDFORMAT:
-		#			return self.data[key].encode('utf-8')
+	def id(self):
+		'''
+		Returns the song id, which can be used to get URLs for the song
+		'''
 
-		#assert(False) #fail if we don't find an id
-		#return
+		# the store keeps the id (or the 'nid' of all access songs) utf-8 encoded
+		return self._store.string(self._store.column('id')[self._row])
 
 	def streamUrl(self):
 		'''
@@ -83,64 +142,171 @@ class Song:
 		'''
 		return self._account.getStreamUrl(self.id())
 
-<<<<<<< HEAD
-	def abortThreads(self):
+	def _refreshStreamUrl(self):
 		'''
-		Stop any operations currently being processed
+		Returns a new playable URL for the song, eg because the server rejected
+		the last one as expired
 		'''
-		self._exitFlag = True
+		self._account.invalidateStreamUrl(self.id())
+		return self.streamUrl()
 
-=======
->>>>>>> master
-	def writeAudioToFile(self, filename):
+	def writeAudioToFile(self, filename, progress = None, aborted = None):
 		'''
 		Write the audio to the given file. Should overwrite if the file
-		exists
+		exists, unless it holds a stopped download of the song. The song is
+		fetched by a RangeDownload, in byte ranges over several connections
+		of the shared Transport at once where the server supports it, each
+		read and written in chunks of RangeDownload.CHUNK_SIZE bytes, so
+		little of the song is held in memory at a time. Between chunks
+		aborted is checked, so that the caller can stop the download (eg when
+		the user skips the song).
+
+		A failed request or response is retried from the bytes already on
+		disc, with a fresh stream URL if the server rejected the old one, and
+		a download which is stopped carries on from where it stopped the next
+		time the song is written to the same file. See RangeDownload.
+
+		A complete download records the 'download' span, from sending the
+		first request to the last chunk, and the 'diskWrite' span, the time
+		spent writing the chunks.
+
+		Returns True if the whole song was written, False if the download
+		failed or was aborted. In the latter case the file may be incomplete.
+
+		:param filename: the file to write
+		:param progress: if not None, called after each chunk is written with
+			the number of bytes from the start of the song written so far and
+			the total size of the song in bytes (None if the server did not say)
+		:param aborted: if not None, a function returning True if the download
+			should stop. Each download has its own, since a song may be
+			downloaded by several buffers
 		'''
-		http = urllib3.PoolManager(
-		    cert_reqs='CERT_REQUIRED', # Force certificate check.
-		    ca_certs=certifi.where()  # Path to the Certifi bundle.
-		)
 
-		response = None
+		if aborted is None:
+			aborted = lambda: False
+
 		try:
-<<<<<<< HEAD
-			log('getting stream url: song ' + self.data['title'])
-			url = self.streamUrl()
-			log('obtained stream url: song ' + self.data['title'])
-			log('getting audio data: song ' + self.data['title'])
-
-			# TODO: this is where the call spends the vast majority of its time
-			# get the data in chunks and have the song check a flag each time so
-			# that the streaming can be interrupted when necessary
-			response = http.request('GET', url)
-			log('obtained audio data: song ' + self.data['title'])
-=======
+			log('getting stream url: song %s', args = (self.title(),))
 			url = self.streamUrl()
-			response = http.request('GET', url)
->>>>>>> master
-
+			log('obtained stream url: song %s', args = (self.title(),))
 		except urllib3.exceptions.SSLError as e:
 			log('SSL Error:', console=True)
 			log(e, console=True)
+			return False
+
+		log('getting audio data: song %s', args = (self.title(),))
+		start = time.time()
+		download = RangeDownload(url, filename, aborted, progress,
+								 refreshUrl = self._refreshStreamUrl, key = self.id())
+		if not download.run():
+			if aborted():
+				log('aborted audio data: song %s', args = (self.title(),))
+			return False
+
+		log('wrote audio data: song %s (%d bytes resumed, %d retries)',
+			args = (self.title(), download.resumedBytes(), download.retries()))
+		metrics = getMetrics()
+		metrics.observe('download', time.time() - start, song = self.id())
+		metrics.observe('diskWrite', download.writeSeconds(), song = self.id())
+		return True
+
+	def writeAlbumArtToFile(self, filename):
+		'''
+		Write the song's album art, as served, to the given file. Returns True
+		if it was written, False if the song has no album art or the download
+		failed. Album art is small, so it is not streamed in chunks and cannot
+		be aborted.
+		'''
+
+		url = self.albumArtUrl()
+		if not url:
+			return False
+
+		try:
+			response = getTransport().request('GET', url, preload_content = True, retries = 2)
+		except urllib3.exceptions.HTTPError as e:
+			log('HTTP Error while fetching album art for song ' + self.title())
+			log(e)
+			return False
+		if response.status != 200:
+			log('Unable to fetch album art for song %s: status %d', args = (self.title(), response.status))
+			return False
 
 		try:
-			f = open(filename, 'wb')
-<<<<<<< HEAD
-			log('writing audio data: song ' + self.data['title'])
-			f.write(response.data)
-			log('wrote audio data: song ' + self.data['title'])
-			f.close()
+			with open(filename, 'wb') as f:
+				f.write(response.data)
 		except IOError as e:
-			log('IOERROR: Unable to open file in Song ' + self.data['title'], console = True)
+			log('IOERROR: Unable to write album art in Song ' + self.title(), console = True)
 			log('\tFile: ' + filename, console = True)
 			log('\t' + str(e), console = True)
-			log('\tTraceback: song.Song.writeAudioToFile(' + filename + ')')
-=======
-			f.write(response.data)
-			f.close()
-		except IOError as e:
-			log('IOERROR: Unable to open file in Song ' + self.data['title'], console = True)
-			log('File: ' + filename, console = True)
-			log(e, console = True)
->>>>>>> master
+			return False
+		return True
+
+class SongMap(object):
+	'''
+	A read-only dictionary of songID:Song pairs for the live tracks of a
+	LibraryStore. A Song is only created when it is first asked for, and the
+	same Song is returned from then on, so handing the whole library to a
+	caller does not visit each track.
+
+	Members:
+		Private:
+			* _store: the LibraryStore holding the tracks
+			* _account: the account which owns the songs
+			* _songs: a dictionary of row:Song pairs for the Songs created
+	'''
+
+	def __init__(self, store, account):
+		self._store = store
+		self._account = account
+		self._songs = {}
+
+	def __len__(self):
+		return len(self._store)
+
+	def __contains__(self, songID):
+		return self._store.row(songID) is not None
+
+	def __getitem__(self, songID):
+		row = self._store.row(songID)
+		if row is None:
+			raise KeyError(songID)
+		return self._song(row)
+
+	def __iter__(self):
+		return self.iterkeys()
+
+	def get(self, songID, default = None):
+		row = self._store.row(songID)
+		if row is None:
+			return default
+		return self._song(row)
+
+	def iterkeys(self):
+		ids = self._store.column('id')
+		for row in self._store.rows():
+			yield self._store.string(ids[row])
+
+	def itervalues(self):
+		for row in self._store.rows():
+			yield self._song(row)
+
+	def iteritems(self):
+		ids = self._store.column('id')
+		for row in self._store.rows():
+			yield self._store.string(ids[row]), self._song(row)
+
+	def keys(self):
+		return list(self.iterkeys())
+
+	def values(self):
+		return list(self.itervalues())
+
+	def items(self):
+		return list(self.iteritems())
+
+	def _song(self, row):
+		song = self._songs.get(row)
+		if song is None:
+			song = self._songs[row] = Song(self._store, row, self._account)
+		return song
@@ -1,5 +1,10 @@
+import time
+from collections import deque
 from shared import *
 from SongQueue import SongQueue
+from events import EventStore
+from albumart import getArtCache
+from metrics import getMetrics
 from controls import *
 
 
@@ -14,9 +19,25 @@ class SongPlayer(pyglet.window.Window):
 	* _account: an instance of the api that is logged into the user's 
 		Google Play account
 	* _queue: the songs queued for playing
+	* _events: the EventStore recording what the listener does, kept between
+		sessions
 
 	* _curSong: a ManagedSoundPlayer that manages the currently playing song
 
+	* _batch: the pyglet Batch holding the vertices of every control
+	* _dirty: True when what the window shows may have changed since it was
+		last drawn. The window is only drawn when it is set
+	* _drawn: True when on_draw has drawn a frame which has not been flipped
+	* _frameTimes: the time taken to draw each of the most recent frames, in
+		seconds
+	* _renderStats: counters for renderStats()
+	* _artSprite: a sprite showing the current song's album art, None until
+		there is some to show
+	* _artImage: the image from the ArtCache shown by _artSprite. The sprite
+		only knows the image's texture
+	* _artUrl: the URL of the album art of the current song, None if it has
+		none
+
 	Controls (pyglet UI):
 	* _btnQuit: a button that closes the window on click
 	* _btnPlay: a button to play the current song
@@ -33,6 +54,13 @@ class SongPlayer(pyglet.window.Window):
 	LABEL_WIDTH = 100
 	PADDING = 12
 
+	# the number of frame times kept for renderStats()
+	FRAME_HISTORY = 100
+
+	# how often to check whether the current song's album art is ready, in
+	# seconds
+	ART_POLL_INTERVAL = 0.25
+
 	def __init__(self, account, x = 50, y = 50, width = 500, height = 500):
 		'''
 		:param account: a valid, authenticated instance of the api
@@ -44,9 +72,24 @@ class SongPlayer(pyglet.window.Window):
 		#super(SongPlayer, self).__init__(x = x, y = y,
 		#								 width = width, height = height, 
 		#								 resizable = True, caption = 'SmartShuffle')
-		super(SongPlayer, self).__init__()
+		# hidden until the first song is ready to play
+		super(SongPlayer, self).__init__(visible = False)
+
+		self._batch = pyglet.graphics.Batch()
+		self._dirty = True
+		self._drawn = False
+		self._frameTimes = deque(maxlen = self.FRAME_HISTORY)
+		self._renderStats = {
+			'draws': 0,
+			'redraws': 0,
+			'totalFrameTime': 0.0,
+			'maxFrameTime': 0.0,
+		}
+		self._artSprite = None
+		self._artImage = None
+		self._artUrl = None
 		
-		self._btnRestart = TextButton(self)
+		self._btnRestart = TextButton(self, batch = self._batch)
 		self._btnRestart.x = self.width / 2 - self.BUTTON_WIDTH / 2
 		self._btnRestart.y = self.PADDING
 		self._btnRestart.width = self.BUTTON_WIDTH
@@ -54,7 +97,7 @@ class SongPlayer(pyglet.window.Window):
 		self._btnRestart.text = ('Restart')
 		self._btnRestart.on_press = self.restart
 
-		self._btnPlayPause = TextButton(self)
+		self._btnPlayPause = TextButton(self, batch = self._batch)
 		self._btnPlayPause.x = self.width / 2 - self.BUTTON_WIDTH / 2
 		self._btnPlayPause.y = self._btnRestart.y + self._btnRestart.height \
 							+ self.PADDING
@@ -63,7 +106,7 @@ class SongPlayer(pyglet.window.Window):
 		self._btnPlayPause.text = ('Play')
 		self._btnPlayPause.on_press = self.togglePlay
 
-		self._btnNext = TextButton(self)
+		self._btnNext = TextButton(self, batch = self._batch)
 		self._btnNext.x = self._btnPlayPause.x + self.BUTTON_WIDTH + self.PADDING
 		self._btnNext.y = self._btnPlayPause.y
 		self._btnNext.width = self.BUTTON_WIDTH
@@ -71,7 +114,7 @@ class SongPlayer(pyglet.window.Window):
 		self._btnNext.text = ('Next Song')
 		self._btnNext.on_press = self.next
 
-		self._btnPrevious = TextButton(self)
+		self._btnPrevious = TextButton(self, batch = self._batch)
 		self._btnPrevious.x = self._btnPlayPause.x - self.PADDING - self.BUTTON_WIDTH
 		self._btnPrevious.y = self._btnPlayPause.y
 		self._btnPrevious.width = self.BUTTON_WIDTH
@@ -79,7 +122,7 @@ class SongPlayer(pyglet.window.Window):
 		self._btnPrevious.text = ('Previous Song')
 		self._btnPrevious.on_press = self.previous
 
-		self._btnQuit = TextButton(self)
+		self._btnQuit = TextButton(self, batch = self._batch)
 		self._btnQuit.x = self.PADDING
 		self._btnQuit.y = self.height - self.BUTTON_HEIGHT - self.PADDING
 		self._btnQuit.width = self.BUTTON_WIDTH
@@ -87,14 +130,14 @@ class SongPlayer(pyglet.window.Window):
 		self._btnQuit.text = ('Exit')
 		self._btnQuit.on_press = self.onQuit
 
-		self._lblSongName = Label(self)
+		self._lblSongName = Label(self, batch = self._batch)
 		self._lblSongName.x = self.width / 2 - self.LABEL_WIDTH / 2
 		self._lblSongName.y = self.height / 2
 		self._lblSongName.width = self.LABEL_WIDTH
 		self._lblSongName.height = self.LABEL_HEIGHT
 		self._lblSongName.text = ''
 
-		self._lblArtist = Label(self)
+		self._lblArtist = Label(self, batch = self._batch)
 		self._lblArtist.x = self._lblSongName.x
 		self._lblArtist.y = self._lblSongName.y - self.LABEL_HEIGHT - self.PADDING
 		self._lblArtist.width = self.LABEL_WIDTH
@@ -103,28 +146,28 @@ class SongPlayer(pyglet.window.Window):
 
 		# Next and previous display either the appropriate text or "Buffering"
 
-		self._lblNextSongName = Label(self)
+		self._lblNextSongName = Label(self, batch = self._batch)
 		self._lblNextSongName.x = self._lblSongName.x + 3*self.LABEL_WIDTH + 2*self.PADDING
 		self._lblNextSongName.y = self.height / 2
 		self._lblNextSongName.width = self.LABEL_WIDTH
 		self._lblNextSongName.height = self.LABEL_HEIGHT
 		self._lblNextSongName.text = ''
 
-		self._lblNextArtist = Label(self)
+		self._lblNextArtist = Label(self, batch = self._batch)
 		self._lblNextArtist.x = self._lblNextSongName.x
 		self._lblNextArtist.y = self._lblNextSongName.y - self.LABEL_HEIGHT - self.PADDING
 		self._lblNextArtist.width = self.LABEL_WIDTH
 		self._lblNextArtist.height = self.LABEL_HEIGHT
 		self._lblNextArtist.text = ''
 
-		self._lblPrevSongName = Label(self)
+		self._lblPrevSongName = Label(self, batch = self._batch)
 		self._lblPrevSongName.x = self._lblSongName.x - 2*self.LABEL_WIDTH - 2*self.PADDING
 		self._lblPrevSongName.y = self.height / 2
 		self._lblPrevSongName.width = self.LABEL_WIDTH
 		self._lblPrevSongName.height = self.LABEL_HEIGHT
 		self._lblPrevSongName.text = ''
 
-		self._lblPrevArtist = Label(self)
+		self._lblPrevArtist = Label(self, batch = self._batch)
 		self._lblPrevArtist.x = self._lblPrevSongName.x
 		self._lblPrevArtist.y = self._lblPrevSongName.y - self.LABEL_HEIGHT - self.PADDING
 		self._lblPrevArtist.width = self.LABEL_WIDTH
@@ -156,13 +199,34 @@ class SongPlayer(pyglet.window.Window):
 		log('Done. ' + str(len(allSongs)) + ' songs detected.', console = True)
 		log(console = True)
 
-		self._queue = SongQueue(allSongs)
+		# timings of buffering and playback, for watching while it runs
+		getMetrics().startExport()
+
+		self._events = EventStore()
+		self._queue = SongQueue(allSongs, events = self._events, onChange = self.invalidate)
+
+		# the queue returns once the first song is playable
+		self.set_visible(True)
+
+	def invalidate(self):
+		'''
+		Mark the contents of the window as changed, so that they are drawn
+		again on the next frame
+		'''
+		self._dirty = True
 
 	def on_draw(self):
 		'''
-		Update the contents of the window
+		Update the contents of the window, if anything has changed since they
+		were last drawn. The event loop calls this whenever a scheduled
+		function runs, which happens many times a second while songs play.
 		'''
-		self.clear()
+		self._renderStats['draws'] += 1
+		if not self._dirty:
+			return
+
+		start = time.time()
+		self._dirty = False
 
 		self.updateInfo()
 
@@ -171,14 +235,17 @@ class SongPlayer(pyglet.window.Window):
 		else:
 			self._btnPlayPause.text = 'Play'
 
-		for control in self._controls:
-			control.draw()
+		self.clear()
+		self._batch.draw()
+		self._drawn = True
 
-<<<<<<< HEAD
-		self.set_visible(visible = self._queue.visible)
+		frameTime = time.time() - start
+		self._frameTimes.append(frameTime)
+		self._renderStats['redraws'] += 1
+		self._renderStats['totalFrameTime'] += frameTime
+		if frameTime > self._renderStats['maxFrameTime']:
+			self._renderStats['maxFrameTime'] = frameTime
 
-=======
->>>>>>> master
 	def updateInfo(self):
 		'''
 		Update the song information, album photo, etc
@@ -187,12 +254,81 @@ class SongPlayer(pyglet.window.Window):
 		if songInfo:
 			if self._lblSongName.text != songInfo['title']:
 				self._lblSongName.text = songInfo['title']
-			if self._lblSongName.text != songInfo['artist']:
+			if self._lblArtist.text != songInfo['artist']:
 				self._lblArtist.text = songInfo['artist']
 		else:
 			self._lblSongName.text = ''
 			self._lblArtist.text = ''
 
+		url = (songInfo['albumArtRef'] or [{}])[0].get('url') if songInfo else None
+		self._updateArt(url)
+
+	def _updateArt(self, url):
+		'''
+		Show the album art for the given URL if it is ready. Otherwise hide
+		the art, and check back until it is ready, without waiting for it.
+		'''
+
+		pyglet.clock.unschedule(self._checkArt)
+		self._artUrl = url
+		image = getArtCache().get(url) if url else None
+		if image is None:
+			if self._artSprite is not None:
+				self._artSprite.visible = False
+			if url:
+				pyglet.clock.schedule_interval(self._checkArt, self.ART_POLL_INTERVAL)
+			return
+
+		x = self.width / 2 - image.width / 2
+		y = self._lblSongName.y + self.LABEL_HEIGHT + self.PADDING
+		if self._artSprite is None:
+			self._artSprite = pyglet.sprite.Sprite(image, x, y, batch = self._batch)
+		else:
+			if self._artImage is not image:
+				self._artSprite.image = image
+			self._artSprite.set_position(x, y)
+			self._artSprite.visible = True
+		self._artImage = image
+
+	def _checkArt(self, dt):
+		if getArtCache().contains(self._artUrl):
+			pyglet.clock.unschedule(self._checkArt)
+			self.invalidate()
+
+	def flip(self):
+		'''
+		Called by the event loop after on_draw. The back buffer only holds a
+		frame when on_draw drew one, so the window is left as it is otherwise.
+		'''
+		if self._drawn:
+			self._drawn = False
+			super(SongPlayer, self).flip()
+
+	def on_expose(self):
+		self.invalidate()
+
+	def on_resize(self, width, height):
+		super(SongPlayer, self).on_resize(width, height)
+		self.invalidate()
+
+	def renderStats(self):
+		'''
+		Return a dictionary describing the drawing of the window:
+			* draws: the number of times the event loop asked for a frame
+			* redraws: the number of frames drawn, because something changed
+			* meanFrameTime, maxFrameTime: the time taken to draw a frame, in
+				seconds, None if none were drawn
+			* recentFrameTimes: the times of the most recent frames, oldest first
+		'''
+
+		stats = dict(self._renderStats)
+		count = stats['redraws']
+		stats['meanFrameTime'] = stats.pop('totalFrameTime') / count if count else None
+		if not count:
+			stats['maxFrameTime'] = None
+		stats['recentFrameTimes'] = list(self._frameTimes)
+		return stats
+
 	def on_close(self):
 		
 		self.onQuit()
@@ -208,10 +344,13 @@ class SongPlayer(pyglet.window.Window):
 		'''
 		Do necessary cleanup and exit the window
 		'''
+		pyglet.clock.unschedule(self._checkArt)
 		try:
 			self._queue.close()
-		except WindowsError:
+		except OSError:
 			log('Unable to free queue buffering resources', console=True)
+		self._events.close()
+		getMetrics().stopExport()
 
 		print 'Logging out'
 		if self._account.logout():
@@ -225,41 +364,28 @@ class SongPlayer(pyglet.window.Window):
 		'''
 		Play or pause the queue appropriately
 		'''
-<<<<<<< HEAD
 		log('Button clicked: PLAY_PAUSE')
-=======
-
->>>>>>> master
 		self._queue.togglePlay()
 
 	def restart(self):
 		'''
 		Restart the current song from the beginning
 		'''
-<<<<<<< HEAD
 		log('Button clicked: RESTART')
-=======
->>>>>>> master
 		self._queue.playCurrent()
 
 	def next(self):
 		'''
 		Play the next song
 		'''
-<<<<<<< HEAD
 		log('Button clicked: NEXT')
-=======
->>>>>>> master
 		self._queue.playNext()
 
 	def previous(self):
 		'''
 		Play the previous song
 		'''
-<<<<<<< HEAD
 		log('Button clicked: PREVIOUS')
-=======
->>>>>>> master
 		self._queue.playPrevious()
 
 	def on_mouse_press(self, x, y, button, modifiers):
@@ -267,3 +393,11 @@ class SongPlayer(pyglet.window.Window):
 			if control.hit_test(x, y):
 				control.on_mouse_press(x, y, button, modifiers)
 				break
+		self.invalidate()
+
+	def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
+		# a pressed button is highlighted while the mouse is over it
+		self.invalidate()
+
+	def on_mouse_release(self, x, y, button, modifiers):
+		self.invalidate()
@@ -1,6 +1,13 @@
 from shared import *
 from songbuffer import SongBuffer
-import threading
+from prefetch import PrefetchManager
+from shuffle import ShuffleEngine
+from playqueue import PlayQueue
+from events import EventStore
+from transition import TransitionEngine
+from metrics import getMetrics
+import time
+import pyglet
 
 class SongQueue:
 	'''
@@ -10,90 +17,153 @@ class SongQueue:
 
 	Members:
 		Private:
-			*_songsD: a dictionary mapping song titles to Song objects for all
-				songs in the queue
+			*_songsD: a dictionary mapping song IDs to Song objects for all
+				songs which can be queued
 
-			*_songs: a list of the songs in the queue in the order in which they are to be played
-				the next song to be played is at the back of songs
+			* _queue: a PlayQueue of entries, one for each time a song was
+				queued: the songs which have been played, then the current
+				song, then the songs to be played, in order. A song played
+				several times has an entry in the history for each play, and
+				at most one entry after the current song. Holds at least the
+				songs in the prefetch window after the current song, topped up
+				from _shuffle
 
-			* _history: an ordered list of the songs which have been played(). The current song is 
-				at the back of history
+			* _songIDs: a dictionary of entry:song ID pairs for the entries in
+				_queue
 
-			* _currentBuffer: a SongBuffer containing the currently playing song
+			* _entries: a dictionary of song ID:set of entries pairs, the
+				entries of each song in _queue
 
-			* _nextBuffer: a SongBuffer containing the next song in the queue
+			* _nextEntry: the entry to give the next song queued
 
-			* _prevBuffer: a SongBuffer containing the previously played song
+			* _position: the position of the current song in _queue, -1 before
+				playback starts, when the first song to be played is at 0
 
-			* _curSong: a managed sound player for the currently playing song
+			* _shuffle: a ShuffleEngine choosing the songs to add to _queue
 
-<<<<<<< HEAD
-			* _curBufThread: a thread object that updates _currentBuffer
+			* _events: an EventStore recording plays, skips, completes, seeks
+				and ratings, or None
 
-			* _nextBufThread: updates _nextBuffer
+			* _onChange: called when what a view of the queue shows changes,
+				or None
 
-			* _prevBufThread: updates _prevBuffer
+			* _unplayed: the entries in _queue which were drawn from _shuffle
+				and have not been played. These are redrawn after a skip
+
+			* _prefetch: a PrefetchManager holding the buffers for the current
+				song and the songs around it
+
+			* _transitions: a TransitionEngine playing the songs, which has the
+				next song queued near the end of the current one
+
+			* _curSong: the player of the TransitionEngine, None until playback
+				starts
+
+			* _sourcePartial: True if the current song's source was opened
+				before the song was completely downloaded
+
+			* _underrunPosition: the position in seconds at which playback
+				ran out of downloaded audio, None if not in an underrun
+
+			* _underruns: the number of underruns so far
+
+			* _pendingSkips: the number of skips forward made since playback
+				stopped for them. While it is nonzero the current song has not
+				been started or buffered, in case the listener skips it too
 
-=======
->>>>>>> master
-			#TODO: look into using 3.x, in which _songs.keys() would be O(1)
-				instead of O(n) in 2.x. This will be useful for shuffling, when
-				we lose the benefit of constant time lookup for a known song.
 	'''
 
 	FORWARD = True
 	BACKWARD = False
 
-	def __init__(self, songs):
+	# how often to check whether enough audio has arrived to resume after an
+	# underrun, in seconds
+	UNDERRUN_POLL_INTERVAL = 0.1
+
+	# a partially downloaded song which ends within this many seconds of its
+	# duration is taken to have finished rather than run out of audio
+	END_TOLERANCE = 1.0
+
+	# the next song is queued on the player this many seconds before the end
+	# of the current one, if it is completely buffered. Later changes to the
+	# queue make the player's next song wrong, so this is kept short
+	PRELOAD_SECONDS = 10.0
+
+	# how often to check whether to queue the next song on the player, in seconds
+	PRELOAD_POLL_INTERVAL = 0.5
+
+	# a skip to a song which is not buffered yet waits this many seconds for
+	# further skips before the song is started and buffered, so the songs
+	# skipped over in a burst are never downloaded
+	SKIP_SETTLE_SECONDS = 0.3
+
+	def __init__(self, songs, progressive = False, prebufferSeconds = SongBuffer.DEFAULT_PREBUFFER_SECONDS,
+				 lookahead = PrefetchManager.DEFAULT_LOOKAHEAD, lookbehind = PrefetchManager.DEFAULT_LOOKBEHIND,
+				 workers = PrefetchManager.DEFAULT_WORKERS, seed = None, events = None, onChange = None):
 		'''
 		Create a queue set up to play the given songs
 
-		:param songs: a dictionary of title:Song pairs
+		:param songs: a dictionary whose values are the Songs to play
+		:param progressive: if True, songs start playing once prebufferSeconds
+			of them are downloaded instead of once they are fully downloaded
+		:param prebufferSeconds: see progressive
+		:param lookahead: the number of songs after the current song to buffer
+		:param lookbehind: the number of songs before the current song to buffer
+		:param workers: the number of songs to download at once
+		:param seed: if given, the shuffle is reproducible
+		:param events: an EventStore in which to record what the listener does,
+			which also informs the shuffle. The caller closes it
+		:param onChange: called with no arguments when the current song, the
+			songs around it or whether it is playing changes
 		'''	
-<<<<<<< HEAD
 		self.visible = False
 
-=======
->>>>>>> master
-		self._songsD = songs
-		self._songs = songs.keys()
-
-		log(self._songs[-1:10])
-
-		self._history = []
-		self._currentBuffer = SongBuffer('buffer1', song=self._songsD[self._songs[-1]], debugName = 'CURRENT')
-		self._nextBuffer = SongBuffer('buffer2', song = self._songsD[self._songs[-2]], debugName = 'NEXT')
-
-		# Since no songs have been played yet, prevBuffer's song is undefined
-		self._prevBuffer = SongBuffer('buffer3', debugName = 'PREVIOUS')
-<<<<<<< HEAD
-		self._prevBufThread = None
+		self._songsD = dict((song.id(), song) for song in songs.itervalues())
+		self._events = events
+		self._onChange = onChange
+		self._shuffle = ShuffleEngine(self._songsD.values(), seed = seed, history = events)
+		self._queue = PlayQueue()
+		self._songIDs = {}
+		self._entries = {}
+		self._nextEntry = 0
+		self._position = -1
+		self._unplayed = set()
+
+		self._fillQueue(lookahead + 1)
+		log([self._songsD[songID].title() for songID in self._slice(0, 10)])
+
+		self._prefetch = PrefetchManager(lookahead = lookahead, lookbehind = lookbehind,
+										 workers = workers, progressive = progressive,
+										 prebufferSeconds = prebufferSeconds)
+		self.updateBuffers()
 
-		# Buffer next song in a separate thread
-		self._nextBufThread = BufferThread(self._nextBuffer)
-		self._nextBufThread.start()
+		# Current buffer must be playable to continue to playback. In progressive
+		# mode it keeps downloading after that
+		self._currentBuffer().waitUntilPlayable()
 
-		# Update current buffer in this thread, must be updated to continue to playback
-		self._curBufThread = None
-		self._currentBuffer.update()
+		self._sourcePartial = False
+		self._underrunPosition = None
+		self._underruns = 0
+		self._pendingSkips = 0
 
 		# Display the window when the first song is ready
 		self.visible = True;
-=======
->>>>>>> master
 
+		self._transitions = TransitionEngine(onTransition = self._onTransition, onEnd = self._onEos)
 		self._curSong = None #Allows us to tell if the queue has been started or not
-		self._source = None
 
 	def numSongs(self):
-		return len(self._songs)
+		'''
+		Return the number of songs queued after the current song
+		'''
+		return len(self._queue) - self._position - 1
 
 	def getCurrentSongInfo(self):
 		'''
 		Return a dictionary with information about the currently playing song
 		'''
-		if self._history:
-			return self._songsD[self._history[-1]].data
+		if self._position >= 0:
+			return self._currentSong().data
 		else:
 			return None
 
@@ -107,6 +177,18 @@ class SongQueue:
 		else:
 			return None
 
+	def playbackTime(self):
+		'''
+		Return the position in the current song in seconds, None before
+		playback starts or while a burst of skips settles
+		'''
+
+		if self._curSong is None or self._pendingSkips:
+			return None
+		if self._underrunPosition is not None:
+			return self._underrunPosition
+		return self._curSong.time
+
 	def togglePlay(self):
 		'''
 		Resume or begin playback if not playing. Pause if playing.
@@ -114,10 +196,16 @@ class SongQueue:
 		if self._curSong is None:
 			# begin playback of the queue
 
-			# get the first song from the queue and add it to history
-			song = self._songs.pop(-1)
-			self._history.append(song)
+			# the first song in the queue becomes the current song
+			self._position = 0
+			self._unplayed.discard(self._queue[0])
+			self._fillQueue(self._prefetch.lookahead())
+
+			self.playCurrent()
+			pyglet.clock.schedule_interval(self._preloadNext, self.PRELOAD_POLL_INTERVAL)
 
+		elif self._pendingSkips:
+			# start the song skipped to without waiting for more skips
 			self.playCurrent()
 
 		elif not self._curSong.playing:
@@ -127,24 +215,76 @@ class SongQueue:
 			#the song is playing
 			self._curSong.pause()
 
+		self._changed()
+
 	def playNext(self):
 		'''
 		Skips to the beginning of the next song in the queue and fixes buffers.
+		The current song counts as skipped: songs like it become less likely,
+		and the songs queued after the next one are redrawn.
+
+		If the next song is already buffered it starts at once. Otherwise
+		playback stops, and the song starts once no further skip has come for
+		SKIP_SETTLE_SECONDS, so a burst of skips only buffers the song it ends
+		on and the songs around that.
 		'''
 
-		if self._songs:
+		if self._curSong is None:
+			self._advance()
+			return
+
+		# a song skipped before it started was not heard
+		self._record(EventStore.SKIP, 0.0 if self._pendingSkips else self._curSong.time)
+		self._shuffle.recordSkip(self._currentSong())
+		self._redrawQueue()
+
+		self._fillQueue(self._prefetch.lookahead() + 1)
+		if self._position + 1 >= len(self._queue):
+			return
+		self._position += 1
+		self._unplayed.discard(self._queue[self._position])
+
+		if not self._pendingSkips:
+			buffer = self._prefetch.getBuffer(self._currentSong())
+			if buffer is not None and buffer.isPlayableFrom(0):
+				self.exchangeBuffers(self.FORWARD)
+				self.playCurrent()
+				return
+
+			# stop the song skipped, leaving the buffers where they are
+			pyglet.clock.unschedule(self._resumeAfterUnderrun)
+			self._underrunPosition = None
+			self._transitions.stop()
+
+		self._pendingSkips += 1
+		pyglet.clock.unschedule(self._settleSkips)
+		pyglet.clock.schedule_once(self._settleSkips, self.SKIP_SETTLE_SECONDS)
+		self._changed()
+
+	def _settleSkips(self, dt = None):
+		'''
+		Scheduled after a skip to a song which is not buffered. Moves the
+		prefetch window to the song skipped to, which aborts the downloads of
+		the songs skipped over, and starts it.
+		'''
 
-			# get the next song from the queue and add it to history
-			song = self._songs.pop(-1)
-			self._history.append(song)
+		if self._pendingSkips > 1:
+			log('Coalesced %d skips', args = (self._pendingSkips,))
+		self.playCurrent()
 
-			self.exchangeBuffers(self.FORWARD)
+	def _advance(self):
+		'''
+		Move on to the next song in the queue
+		'''
 
-			# for a forward step, currentBuffer and prevBuffer will be OK
-			# nextBuffer needs to be reloaded
-			if self._songs:
-				#there is a next song, so write it to the buffer
-				self._nextBuffer.setSong(self._songsD[self._songs[-1]])
+		self._fillQueue(self._prefetch.lookahead() + 1)
+		if self._position + 1 < len(self._queue):
+
+			# the next song becomes the current song
+			self._position += 1
+			self._unplayed.discard(self._queue[self._position])
+
+			self.exchangeBuffers(self.FORWARD)
 
 			self.playCurrent()
 
@@ -154,190 +294,513 @@ class SongQueue:
 		Rewind to the song that was played before the current song and fix buffers.
 		if no such song exists in history, do nothing and return False.
 		'''
-		if len(self._history) >= 2:
-			#History must contain the current song and a previous song
-			
-			#get the currently playing song name from history, and put it back on the queue
-			self._songs.append(self._history.pop(-1))
+		if self._position >= 1:
+			# the current song stays in the queue, as the next song
+			self._position -= 1
 
 			self.exchangeBuffers(self.BACKWARD)
 
-			# for a backward step, currentBuffer and nextBuffer will be OK
-			# prevBuffer needs to be reloaded
-			if len(self._history) > 1:
-				# there is a previous song, write it to the buffer
-				self._prevBuffer.setSong(self._songsD[self._history[-2]])
-
 			self.playCurrent()
 
 	def playCurrent(self):
 		'''
-		Start the current song from the beginning. Buffers do not change.
-		:pre All three buffers are correct
+		Start the current song from the beginning. Records the 'playStart'
+		span, which includes waiting for the song to buffer, the
+		'bufferWait' span.
 		'''
 
+		start = time.time()
+
 		# stop playback
 		if self._curSong and self._curSong.playing:
 			self._curSong.pause()
 
-<<<<<<< HEAD
-		# while the song is playing, update the buffers
+		# a song started by any means ends a burst of skips
+		pyglet.clock.unschedule(self._settleSkips)
+		self._pendingSkips = 0
+
+		# a new song replaces any song waiting to resume after an underrun
+		pyglet.clock.unschedule(self._resumeAfterUnderrun)
+		self._underrunPosition = None
+
+		# while the song is playing, update the buffers. This also retries
+		# any buffers whose downloads failed
 		self.updateBuffers()
 
-		# if currentBuffer is still updating, wait for it to finish
-		# unlike prevBuffer and nextBuffer, currentBuffer MUST be
-		# up-to-date for a song to be played
-		log('waiting for thread: CURRENT')
-		self._curBufThread.join()
+		# if currentBuffer is still updating, wait for it to become playable
+		# unlike the other buffers, currentBuffer MUST be ready for a song
+		# to be played
+		log('waiting for buffer: CURRENT')
+		songID = self._currentSong().id()
+		with getMetrics().span('bufferWait', song = songID, buffer = 'CURRENT'):
+			playable = self._currentBuffer().waitUntilPlayable()
+		if not playable:
+			log('Unable to buffer song: ' + self._currentSong().title(), console = True)
+			self._changed()
+			return
 		log('proceeding')
 
 		# start the new song
-		log('playing song: ' + self._history[-1])
-		self._curSong = self._currentBuffer.getSource().play()
-		#self._curSong.on_eos = self.playNext
-		self._curSong.on_eos = self.close()
-=======
-		# current buffer must be updated before song can be played
-		self._currentBuffer.update()
+		log('playing song: %s', args = (self._currentSong().title(),))
+		self._startSource(0)
+		getMetrics().observe('playStart', time.time() - start, song = songID, buffer = 'CURRENT')
+		self._record(EventStore.PLAY, 0.0)
+		self._changed()
 
-		# start the new song
-		log('playing song: ' + self._songs[-1])
-		self._curSong = self._currentBuffer.getSource().play()
-		self._curSong.on_eos = self.playNext
+	def isPrefetching(self):
+		'''
+		Return True while songs around the current song are still downloading
+		'''
+		return self._prefetch.isBusy()
 
-		# while the song is playing, update the other buffers
-		self.updateBuffers()
->>>>>>> master
-
-	def playSong(self, songName):
-		###############################################################
-		# This method can be implemented several ways:
-		# 1. Search through the list for the song. Play it and refresh
-		#	buffers. Theta(n). Preserves order of queue. Also, if 
-		#	searching through queue, no need to have a dictionary.
-		#
-		# 2. Reshuffle. Append song to beginning of shuffled queue and
-		#	start the queue from the beginning. Complexity depends on
-		#	shuffling algorithm
-		#
-		# 3. Pause playback of the queue. Play song. Resume playback.
-		#	Theta(1). Preserves order of queue. However, since buffers
-		#	are not changed, the user cannot "jump ahead" in the queue
-		###############################################################
-		'''
-		Play the given song. Returns True if the song was able to be played,
-		false otherwise.
-
-		:param songName: the title of the song to be played
-		
-
-		# DEBUG
-		self._songsD[songName].writeAudioToFile('test.txt')
-		self._songsD[songName].writeAudioToFile('test.mp3')
-		# END DEBUG
-
-
-		if self._curSong is not None and self._curSong.playing:
-			self._curSong.pause()
+	def underruns(self):
+		'''
+		Return the number of times playback has caught up with a download
+		'''
+		return self._underruns
+
+	def transitionGaps(self):
+		'''
+		Return a list of the gaps between the most recent songs, in seconds.
+		See TransitionEngine.
+		'''
+		return self._transitions.gaps()
+
+	def transitionStats(self):
+		return self._transitions.stats()
+
+	def _startSource(self, position):
+		'''
+		Play a new source for the current buffer from the given position in seconds
+		'''
+
+		buffer = self._currentBuffer()
+		self._sourcePartial = not buffer.isComplete()
+		self._transitions.play(self._currentSong().id(), buffer.getSource(), position)
+		self._curSong = self._transitions.player()
+
+	def _preloadNext(self, dt = None):
+		'''
+		Scheduled while the queue plays. Near the end of the current song,
+		queues the next song on the player if it is completely buffered, so
+		that it follows without a gap. A partial song may end early, so
+		nothing is queued after it.
+		'''
+
+		if self._pendingSkips or self._sourcePartial or self._underrunPosition is not None:
+			return
+		if self._transitions.queued() is not None:
+			return
+		if self._position < 0 or self._position + 1 >= len(self._queue):
+			return
+		duration = self._currentSong().duration()
+		if duration is not None and duration / 1000.0 - self._curSong.time > self.PRELOAD_SECONDS:
+			return
+
+		song = self._songsD[self._songAt(self._position + 1)]
+		buffer = self._prefetch.getBuffer(song)
+		if buffer is None or not buffer.isComplete():
+			return
+		source = buffer.getSource()
+		if source is not None and self._transitions.preload(song.id(), source):
+			debug('Queued next song on the player: %s', song.title())
+
+	def _onTransition(self, songID):
+		'''
+		Called when the player moves on to the song queued after the current
+		one by itself, at the end of the current song
+		'''
+
+		duration = self._currentSong().duration()
+		self._record(EventStore.COMPLETE, duration / 1000.0 if duration is not None else 0.0)
+		self._shuffle.recordComplete(self._currentSong())
+
+		self._fillQueue(self._prefetch.lookahead() + 1)
+		if self._position + 1 >= len(self._queue):
+			# the song queued on the player was removed, and nothing follows
+			self._transitions.stop()
+			self._changed()
+			return
+		if self._songAt(self._position + 1) != songID:
+			# the queue changed after the song was queued on the player
+			self._advance()
+			return
+
+		self._position += 1
+		self._unplayed.discard(self._queue[self._position])
+		self._sourcePartial = False
+		self.exchangeBuffers(self.FORWARD)
+		log('playing song: %s', args = (self._currentSong().title(),))
+		self._record(EventStore.PLAY, 0.0)
+		self._changed()
+
+	def _onEos(self, songID):
+		'''
+		Called by the player when it reaches the end of the current source
+		with nothing queued after it. In progressive mode that may be the end
+		of the audio downloaded so far rather than the end of the song, in
+		which case playback is resumed from the same position once more audio
+		has arrived.
+		'''
+
+		if self._sourcePartial:
+			position = self._curSong.time
+			duration = self._currentSong().duration()
+			if duration is None or position < duration / 1000.0 - self.END_TOLERANCE:
+				self._underruns += 1
+				self._underrunPosition = position
+				log('Buffer underrun at %.1fs: song %s' % (position, self._currentSong().title()), console = True)
+				pyglet.clock.schedule_interval(self._resumeAfterUnderrun, self.UNDERRUN_POLL_INTERVAL)
+				self._changed()
+				return
+
+		self._record(EventStore.COMPLETE, self._curSong.time)
+		self._shuffle.recordComplete(self._currentSong())
+		self._advance()
+
+	def _resumeAfterUnderrun(self, dt):
+		'''
+		Scheduled during an underrun. Resumes playback once the current buffer
+		has prebufferSeconds of audio past the position where it ran out.
+		'''
+
+		buffer = self._currentBuffer()
+		if buffer.hasFailed():
+			# the rest of the song is not coming
+			pyglet.clock.unschedule(self._resumeAfterUnderrun)
+			log('Unable to finish buffering song: ' + self._currentSong().title(), console = True)
+			self._advance()
+			return
+		if not buffer.isPlayableFrom(self._underrunPosition):
+			return
+
+		pyglet.clock.unschedule(self._resumeAfterUnderrun)
+		position = self._underrunPosition
+		self._underrunPosition = None
+		log('Resuming after underrun at %.1fs: song %s' % (position, self._currentSong().title()))
+		self._startSource(position)
+		self._changed()
+
+	def seek(self, position):
+		'''
+		Move playback of the current song to the given position in seconds.
+		During a burst of skips, the song skipped to is started first, which
+		ends the burst. Returns False, leaving playback where it is, before
+		playback starts, during an underrun, if the song skipped to could not
+		be started, or in progressive mode if that part of the song has not
+		been downloaded yet.
+		'''
+
+		if self._pendingSkips:
+			self._settleSkips()
+			if self._transitions.current() != self._currentSong().id():
+				return False
+		if self._curSong is None or self._underrunPosition is not None:
+			return False
+		if self._sourcePartial and not self._currentBuffer().isPlayableFrom(position):
+			return False
+
+		self._record(EventStore.SEEK, self._curSong.time, position)
+		self._curSong.seek(position)
+		return True
+
+	def rateCurrent(self, rating):
+		'''
+		Record a rating for the current song, 5 for thumbs up, 1 for thumbs
+		down or 0 for none. The shuffle takes it into account from the next
+		session.
+		'''
+
+		if self._position >= 0:
+			self._record(EventStore.RATE, self._curSong.time if self._curSong else 0.0, rating)
+
+	def _changed(self):
+		if self._onChange is not None:
+			self._onChange()
+
+	def _record(self, eventType, position, value = 0.0):
+		'''
+		Record an event for the current song, if there is an EventStore
+		'''
+
+		if self._events is not None:
+			self._events.record(eventType, self._currentSong().id(), position, value)
+
+	def playSong(self, songID):
+		'''
+		Play the given song now. It is moved to just after the current song,
+		so the rest of the queue keeps its order and the current song is
+		still the previous song. Returns True if the song was able to be
+		played, False otherwise.
 
-		if songName in self._songsD:
-			song = self._songsD[songName]
-			self._curSong = song.play()
+		:param songID: the ID of the song to be played
+		'''
+
+		if songID not in self._songsD:
+			return False
+		if self._position >= 0 and songID == self._songAt(self._position):
+			self.playCurrent()
 			return True
+
+		self.playAfterCurrent(songID)
+		if self._curSong is None:
+			self.togglePlay()
 		else:
+			self._advance()
+		return True
+
+	def playAfterCurrent(self, songID):
+		'''
+		Queue the given song to be played next, moving it if it is already
+		queued. Before playback starts, it becomes the first song.
+		'''
+
+		self.insertSong(songID, 0)
+
+	def insertSong(self, songID, offset):
+		'''
+		Queue the given song so that offset songs are played between the
+		current song and it, moving it if it is already queued. A song in the
+		history stays there as well. Offsets past the end of the queue add it
+		at the end. Returns False if the song is unknown or is the current
+		song.
+		'''
+
+		if songID not in self._songsD:
 			return False
+		if self._position >= 0 and songID == self._songAt(self._position):
+			return False
+
+		entry = self._queuedEntry(songID)
+		if entry is None:
+			entry = self._newEntry(songID)
+		else:
+			self._queue.remove(entry)
+		self._queue.insert(self._position + 1 + max(0, offset), entry)
+
+		# chosen by the listener, so it is not redrawn
+		self._unplayed.discard(entry)
+		self.updateBuffers()
+		self._changed()
+		return True
+
+	def moveSong(self, songID, offset):
+		'''
+		Move a queued song so that offset songs are played between the
+		current song and it. Returns False if it is not queued after the
+		current song.
+		'''
 
+		entry = self._queuedEntry(songID)
+		if entry is None:
+			return False
+		unplayed = entry in self._unplayed
+		self.insertSong(songID, offset)
+		if unplayed:
+			self._unplayed.add(entry)
+		return True
+
+	def removeSong(self, songID):
+		'''
+		Remove a song from the queue or, if it is not queued, its latest play
+		from the history. Returns False if it is in neither or is the current
+		song.
+		'''
+
+		if self._position >= 0 and songID == self._songAt(self._position):
+			return False
+
+		entry = self._queuedEntry(songID)
+		if entry is None:
+			played = [(self._queue.index(other), other) for other in self._entries.get(songID, ())]
+			played = [(index, other) for index, other in played if index < self._position]
+			if not played:
+				return False
+			entry = max(played)[1]
+
+		if self._removeEntry(entry) < self._position:
+			self._position -= 1
+		if entry in self._unplayed:
+			self._unplayed.discard(entry)
+			self._shuffle.putBack(self._songsD[songID])
+		self.updateBuffers()
+		self._changed()
+		return True
+
+	def jumpTo(self, offset):
+		'''
+		Play the song offset places after the current song, or before it if
+		offset is negative. The songs jumped over stay where they are, so
+		jumping forward puts them in the history. Returns False if there is
+		no song at that offset.
+		'''
+
+		if self._position < 0:
+			return False
+		position = self._position + offset
+		if offset == 0 or not 0 <= position < len(self._queue):
+			return False
+
+		if offset > 0:
+			for entry in self._queue.slice(self._position + 1, position + 1):
+				self._unplayed.discard(entry)
+		self._position = position
+		self.exchangeBuffers(offset > 0)
+		self.playCurrent()
+		return True
+
+	def upcoming(self, count):
+		'''
+		Return a list of up to count Songs queued after the current song, in order
+		'''
+
+		start = self._position + 1
+		return [self._songsD[songID] for songID in self._slice(start, start + count)]
+
+	def history(self, count):
+		'''
+		Return a list of up to count Songs played before the current song, most
+		recent first
 		'''
 
+		return [self._songsD[songID] for songID in
+				reversed(self._slice(self._position - count, self._position))]
+
 	def exchangeBuffers(self, forward):
 		'''
-		Executed when stepping to another song. Exchanges the
-		buffer files so that the current song is ready to be played,
-		either the prev or next buffer corresponds to the proper song,
-		and the other is ready to be filled.
+		Executed when stepping to another song. Moves the prefetch window so
+		that the new current song is at its centre. Buffers for songs which
+		are still in the window are kept, downloads of songs which left it
+		are cancelled, and songs which entered it are queued for download.
 
 		:param forward: A boolean value that is true if stepping to the
 			next song, False if stepping to the previous song
 		'''
 
-		if forward:
-			# step forward:
-			# currentBuffer becomes prevBuffer
-			# nextBuffer becomes currentBuffer
-			# prevBuffer becomes nextBuffer, and is ready to be loaded
-			oldPrev = self._prevBuffer
-			self._prevBuffer = self._currentBuffer
-			self._currentBuffer = self._nextBuffer
-			self._nextBuffer = oldPrev
-
-		else:
-			# step backward:
-			# currentBuffer becomes nextBuffer
-			# prevBuffer becomes currentBuffer
-			# nextBuffer becomes prevBuffer, and is ready to be loaded
-			oldNext = self._nextBuffer
-			self._nextBuffer = self._currentBuffer
-			self._currentBuffer = self._prevBuffer
-			self._prevBuffer = oldNext
-
-		self._nextBuffer.name = 'NEXT'
-		self._currentBuffer.name = 'CURRENT'
-		self._prevBuffer.name = 'PREVIOUS'
+		self.updateBuffers()
 
 	def updateBuffers(self):
-<<<<<<< HEAD
-		self._curBufThread = BufferThread(self._currentBuffer)
-		self._nextBufThread = BufferThread(self._nextBuffer)
-		self._prevBufThread = BufferThread(self._prevBuffer)
-
-		self._curBufThread.start()
-		self._nextBufThread.start()
-		self._prevBufThread.start()
-=======
-		self._prevBuffer.update()
-		self._currentBuffer.update()
-		self._nextBuffer.update()
->>>>>>> master
+		'''
+		Set the prefetch window to the current song and the songs around it
+		'''
 
-	def close(self):
+		# before the queue starts, the first song to be played is current
+		current = max(self._position, 0)
+		after = self._slice(current + 1, current + 1 + self._prefetch.lookahead())
+		before = self._slice(current - self._prefetch.lookbehind(), current)
+		before.reverse()
+
+		self._prefetch.setWindow(self._currentSong(),
+								 [self._songsD[songID] for songID in after],
+								 [self._songsD[songID] for songID in before])
+
+	def _fillQueue(self, count):
 		'''
-		Clean up resources
+		Draw songs from the shuffle until at least count songs are queued
+		after the current song
 		'''
 
-<<<<<<< HEAD
-		# for now wait for threads to finish before we can access the files
-		# TODO: interrupt the threads so we dont have to wait
-		self._curBufThread.join()
-		self._nextBufThread.join()
-		self._prevBufThread.join()
+		needed = count - self.numSongs()
+		if needed <= 0:
+			return
+		for song in self._shuffle.next(needed):
+			songID = song.id()
+			if self._queuedEntry(songID) is not None or \
+					(self._position >= 0 and songID == self._songAt(self._position)):
+				# drawn again in a new shuffle cycle before it came round.
+				# Once played it gets a new entry, and stays in the history
+				continue
+			entry = self._newEntry(songID)
+			self._queue.append(entry)
+			self._unplayed.add(entry)
+
+	def _redrawQueue(self):
+		'''
+		Return the unplayed songs queued after the next song to the shuffle,
+		so they are drawn again with the latest scores. The next song is kept,
+		since it is already buffered.
+		'''
 
-=======
->>>>>>> master
-		# delete the buffers
-		self._prevBuffer.close()
-		self._currentBuffer.close()
-		self._nextBuffer.close()
+		for entry in list(self._unplayed):
+			if self._queue.index(entry) > self._position + 1:
+				songID = self._songIDs[entry]
+				self._removeEntry(entry)
+				self._unplayed.discard(entry)
+				self._shuffle.putBack(self._songsD[songID])
 
+	def shuffleStats(self):
+		return self._shuffle.stats()
 
-<<<<<<< HEAD
-class BufferThread(threading.Thread):
-	'''
-	Updates a songbuffer 
-	TODO: can be interrupted (eg when the user skips several songs quickly)
-	'''
+	def _currentSong(self):
+		'''
+		Return the current Song, or the first song to be played if the queue
+		has not started
+		'''
+
+		return self._songsD[self._songAt(max(self._position, 0))]
+
+	def _songAt(self, index):
+		'''
+		Return the ID of the song at the given position in _queue
+		'''
+
+		return self._songIDs[self._queue[index]]
 
-	def __init__(self, buffer):
+	def _slice(self, start, stop):
 		'''
-		:param buffer: the buffer to update
+		Return a list of the IDs of the songs from position start up to but
+		not including stop in _queue, clamped to it
 		'''
-		super(BufferThread, self).__init__()
-		self._buffer = buffer
 
-	def run(self):
-		log('Starting buffer thread: ' + self._buffer.name)
-		self._buffer.update()
-		log('Returning from buffer thread: ' + self._buffer.name)
-=======
-	def __del__(self):
-		self.close()
->>>>>>> master
+		return [self._songIDs[entry] for entry in self._queue.slice(start, stop)]
+
+	def _queuedEntry(self, songID):
+		'''
+		Return the song's first entry after the current song, None if it is
+		not queued
+		'''
+
+		queued = [(self._queue.index(entry), entry) for entry in self._entries.get(songID, ())]
+		queued = [(index, entry) for index, entry in queued if index > self._position]
+		if not queued:
+			return None
+		return min(queued)[1]
+
+	def _newEntry(self, songID):
+		'''
+		Return a new entry for the song, to be put in _queue
+		'''
+
+		entry = self._nextEntry
+		self._nextEntry += 1
+		self._songIDs[entry] = songID
+		self._entries.setdefault(songID, set()).add(entry)
+		return entry
+
+	def _removeEntry(self, entry):
+		'''
+		Remove an entry from _queue and return the position it had
+		'''
+
+		index = self._queue.remove(entry)
+		songID = self._songIDs.pop(entry)
+		self._entries[songID].discard(entry)
+		if not self._entries[songID]:
+			del self._entries[songID]
+		return index
+
+	def _currentBuffer(self):
+		return self._prefetch.getBuffer(self._currentSong())
+
+	def close(self):
+		'''
+		Clean up resources
+		'''
+
+		pyglet.clock.unschedule(self._preloadNext)
+		pyglet.clock.unschedule(self._resumeAfterUnderrun)
+		pyglet.clock.unschedule(self._settleSkips)
+		self._transitions.stop()
+
+		# abort the downloads and delete the buffers
+		self._prefetch.close()
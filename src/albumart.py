@@ -0,0 +1,268 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import pyglet
+from shared import *
+from audiocache import AudioCache
+
+try:
+	import numpy
+except ImportError:
+	# images are scaled by nearest neighbour with a plain python loop
+	numpy = None
+
+class ArtCache:
+	'''
+	Album art, decoded and scaled to display size ahead of time so that
+	showing it never waits for the network or for image work. Buffer threads
+	call prepare() for the songs they buffer, and the window calls get(),
+	which only looks in memory.
+
+	The images are kept in memory as RGBA pyglet ImageData, least recently
+	used first, and evicted to keep their total size under a byte budget, so
+	the memory used does not grow with the size of the library. A texture is
+	only made from an image when it is displayed. The files as downloaded are
+	kept in an AudioCache of their own, so art is downloaded once across
+	sessions. Songs on the same album share the entries for its art.
+
+	Use getArtCache() to get the process-wide instance.
+
+	Members:
+		Private:
+			* _size: the largest width and height of the images, in pixels
+			* _files: an AudioCache of the downloaded images, keyed by a hash
+				of their URL
+			* _budget: the maximum total size of the images in memory, in bytes
+			* _images: an OrderedDict of key:ImageData pairs, least recently
+				used first
+			* _bytes: the total size of _images in bytes
+			* _loading: a dictionary of key:threading.Event pairs for the
+				images being prepared, so that one thread prepares each image
+			* _hits, _misses: the number of calls to get which did and did not
+				find their image
+			* _lock: protects the members above
+	'''
+
+	DEFAULT_DIRECTORY = 'art-cache'
+	DEFAULT_DISK_BUDGET = 64 * 1024 * 1024
+	DEFAULT_MEMORY_BUDGET = 16 * 1024 * 1024
+	DEFAULT_SIZE = 150
+
+	def __init__(self, directory = DEFAULT_DIRECTORY, diskBudget = DEFAULT_DISK_BUDGET,
+				 memoryBudget = DEFAULT_MEMORY_BUDGET, size = DEFAULT_SIZE):
+		'''
+		:param directory: the directory in which to keep the downloaded images
+		:param diskBudget: the maximum total size of the downloaded images in bytes
+		:param memoryBudget: the maximum total size of the decoded images in bytes
+		:param size: images are scaled down to fit in a square of this many
+			pixels. Smaller images are kept at their own size
+		'''
+
+		self._size = size
+		self._files = AudioCache(directory, diskBudget)
+		self._budget = memoryBudget
+		self._images = OrderedDict()
+		self._bytes = 0
+		self._loading = {}
+		self._hits = 0
+		self._misses = 0
+		self._lock = threading.Lock()
+
+	def get(self, url):
+		'''
+		Return the image for the given URL, or None if it has not been
+		prepared. Never waits. A successful get marks the image as recently
+		used.
+		'''
+
+		key = _key(url)
+		with self._lock:
+			image = self._images.pop(key, None)
+			if image is None:
+				self._misses += 1
+				return None
+			self._images[key] = image
+			self._hits += 1
+			return image
+
+	def contains(self, url):
+		'''
+		Return True if the image for the given URL is in memory. Does not
+		count as a use.
+		'''
+
+		with self._lock:
+			return _key(url) in self._images
+
+	def prepare(self, url, filename, download):
+		'''
+		Make sure the image for the given URL is in memory, downloading it if
+		it is not on disc. Blocks, so is called from a buffer thread. Returns
+		True if the image is ready.
+
+		:param url: the URL of the image
+		:param filename: a file to download the image to. It is moved into
+			the cache
+		:param download: a function which writes the image to the file it is
+			given and returns True, or returns False on failure
+		'''
+
+		key = _key(url)
+		with self._lock:
+			if key in self._images:
+				return True
+			loading = self._loading.get(key)
+			if loading is None:
+				self._loading[key] = threading.Event()
+
+		if loading is not None:
+			# another thread is preparing the same album's art
+			loading.wait()
+			return self.contains(url)
+
+		image = None
+		try:
+			path = self._files.lookup(key)
+			if path is None:
+				if not download(filename):
+					return False
+				path = self._files.store(key, filename) or filename
+			image = self._load(path)
+		finally:
+			with self._lock:
+				if image is not None:
+					self._add(key, image)
+				self._loading.pop(key).set()
+
+		return image is not None
+
+	def stats(self):
+		'''
+		Return a dictionary with the number of images in memory, their total
+		size, the memory budget, the number of get hits and misses, and the
+		stats of the files on disc
+		'''
+
+		with self._lock:
+			return {'images': len(self._images),
+					'bytes': self._bytes,
+					'budget': self._budget,
+					'hits': self._hits,
+					'misses': self._misses,
+					'files': self._files.stats()}
+
+	def _add(self, key, image):
+		'''
+		Add an image, evicting the least recently used images to stay within
+		the budget. Caller must hold _lock.
+		'''
+
+		size = _imageBytes(image)
+		if size > self._budget:
+			return
+		while self._images and self._bytes + size > self._budget:
+			evicted, evictedImage = self._images.popitem(last = False)
+			self._bytes -= _imageBytes(evictedImage)
+		self._images[key] = image
+		self._bytes += size
+
+	def _load(self, path):
+		'''
+		Decode an image file and scale it to fit the display size. Returns
+		None if the file cannot be decoded.
+		'''
+
+		try:
+			image = pyglet.image.load(path).get_image_data()
+		except Exception as e:
+			# decoders raise all sorts, depending on the platform
+			log('Unable to decode album art ' + path)
+			log('\t' + str(e))
+			return None
+
+		width, height = image.width, image.height
+		data = image.get_data('RGBA', width * 4)
+		scale = min(1.0, float(self._size) / max(width, height, 1))
+		newWidth = max(1, int(width * scale))
+		newHeight = max(1, int(height * scale))
+		if (newWidth, newHeight) != (width, height):
+			data = _scale(data, width, height, newWidth, newHeight)
+		return pyglet.image.ImageData(newWidth, newHeight, 'RGBA', data)
+
+def _key(url):
+	# URLs are long and contain characters which cannot be in a file name
+	if isinstance(url, unicode):
+		url = url.encode('utf-8')
+	return hashlib.sha1(url).hexdigest()
+
+def _imageBytes(image):
+	return image.width * image.height * 4
+
+def _scale(data, width, height, newWidth, newHeight):
+	'''
+	Scale RGBA pixels down to the given size. With NumPy, each new pixel is
+	the mean of a block of the old ones, which avoids the aliasing of
+	picking single pixels from a much larger image.
+	'''
+
+	if numpy is not None:
+		pixels = numpy.frombuffer(data, dtype = numpy.uint8).reshape(height, width, 4)
+
+		# average blocks of whole pixels, then pick from what is left
+		blockX = width // newWidth
+		blockY = height // newHeight
+		if blockX > 1 or blockY > 1:
+			croppedHeight = height // blockY * blockY
+			croppedWidth = width // blockX * blockX
+			pixels = pixels[:croppedHeight, :croppedWidth].reshape(
+				croppedHeight // blockY, blockY, croppedWidth // blockX, blockX, 4).mean(axis = (1, 3))
+		rows = (numpy.arange(newHeight) * pixels.shape[0] // newHeight)
+		columns = (numpy.arange(newWidth) * pixels.shape[1] // newWidth)
+		return pixels[rows][:, columns].astype(numpy.uint8).tostring()
+
+	pitch = width * 4
+	columns = [x * width // newWidth * 4 for x in xrange(newWidth)]
+	rows = []
+	for y in xrange(newHeight):
+		start = y * height // newHeight * pitch
+		row = data[start:start + pitch]
+		rows.append(''.join([row[column:column + 4] for column in columns]))
+	return ''.join(rows)
+
+
+_artCache = None
+_artCacheDisabled = False
+_artCacheLock = threading.Lock()
+
+def getArtCache():
+	'''
+	Return the process-wide ArtCache, creating it with default settings if
+	configureArtCache has not been called, or None if disableArtCache has
+	been called
+	'''
+	global _artCache
+	with _artCacheLock:
+		if _artCache is None and not _artCacheDisabled:
+			_artCache = ArtCache()
+		return _artCache
+
+def disableArtCache():
+	'''
+	Stop album art being prepared, eg when there is no window to show it
+	'''
+	global _artCache, _artCacheDisabled
+	with _artCacheLock:
+		_artCache = None
+		_artCacheDisabled = True
+
+def configureArtCache(directory = ArtCache.DEFAULT_DIRECTORY, diskBudget = ArtCache.DEFAULT_DISK_BUDGET,
+					  memoryBudget = ArtCache.DEFAULT_MEMORY_BUDGET, size = ArtCache.DEFAULT_SIZE):
+	'''
+	Replace the process-wide ArtCache with one using the given settings.
+	Should be called at startup, before any songs are buffered.
+	'''
+	global _artCache, _artCacheDisabled
+	with _artCacheLock:
+		_artCache = ArtCache(directory, diskBudget, memoryBudget, size)
+		_artCacheDisabled = False
+		return _artCache
@@ -0,0 +1,332 @@
+import os
+import shutil
+import atexit
+import threading
+from collections import OrderedDict
+from shared import *
+
+class AudioCache:
+	'''
+	A persistent cache of downloaded files, keyed by song ID, which survives
+	from one session to the next. The total size of the cached files is kept
+	under a byte budget by evicting the least recently used entries.
+
+	The cache keeps an index file in its directory with one line per entry,
+	least recently used first, in the format <key>\t<size in bytes>. Loading
+	the index at startup only reads this file, not the cached files themselves.
+	The index is rewritten when entries are added or removed and when the
+	cache is closed, not on every lookup, so the order of use may be a little
+	out of date after a crash.
+
+	A buffer which reads an entry's file pins the entry while it does, and
+	pinned entries are never evicted.
+
+	Use getAudioCache() to get the process-wide instance.
+
+	Members:
+		Private:
+			* _directory: the directory holding the cached files and the index
+			* _budget: the maximum total size of the cached files in bytes
+			* _entries: an OrderedDict of key:size pairs, least recently used first
+			* _size: the total size of the cached files in bytes
+			* _pins: a dictionary of key:count pairs, the number of times each
+				pinned entry has been pinned and not unpinned
+			* _dirty: True if _entries has changed since the index was saved
+			* _hits, _misses: the number of lookups that did and did not find
+				their key
+			* _lock: protects the members above, the cache is used from
+				buffer threads
+	'''
+
+	DEFAULT_DIRECTORY = 'cache'
+	DEFAULT_BUDGET = 512 * 1024 * 1024
+
+	INDEX_FILE = 'index.txt'
+
+	def __init__(self, directory = DEFAULT_DIRECTORY, budget = DEFAULT_BUDGET):
+		'''
+		:param directory: the directory in which to keep the cache. It is
+			created if it does not exist, and its index is loaded if it does
+		:param budget: the maximum total size of the cached files in bytes
+		'''
+
+		self._directory = directory
+		self._budget = budget
+		self._entries = OrderedDict()
+		self._size = 0
+		self._pins = {}
+		self._dirty = False
+		self._hits = 0
+		self._misses = 0
+		self._lock = threading.Lock()
+
+		if not os.path.exists(self._directory):
+			os.makedirs(self._directory)
+
+		self._loadIndex()
+
+		# the budget may have shrunk since the last session
+		with self._lock:
+			self._evict(0)
+			if self._dirty:
+				self._saveIndex()
+
+		atexit.register(self.close)
+
+	def lookup(self, key, pin = False):
+		'''
+		Return the path of the cached file for the given key, or None if it is
+		not cached. A successful lookup marks the entry as recently used.
+
+		:param pin: if True and the key is cached, pin the entry until a
+			matching call to unpin
+		'''
+
+		with self._lock:
+			if key in self._entries:
+				path = self._path(key)
+				if os.path.exists(path):
+					size = self._entries.pop(key)
+					self._entries[key] = size
+					self._hits += 1
+					self._dirty = True
+					if pin:
+						self._pin(key)
+					return path
+
+				# the file was removed behind our back
+				self._size -= self._entries.pop(key)
+				self._dirty = True
+
+			self._misses += 1
+			return None
+
+	def contains(self, key):
+		'''
+		Return True if the given key is cached. Does not count as a use.
+		'''
+
+		with self._lock:
+			return key in self._entries
+
+	def store(self, key, filename, pin = False):
+		'''
+		Move the given file into the cache under the given key, evicting least
+		recently used entries which are not pinned to stay within the budget.
+		Returns the new path of the file, or None if there is no room for it,
+		in which case it is left where it is. If the key is cached and pinned,
+		its file is kept and the given one deleted.
+
+		:param pin: if True and the file is stored, pin the entry until a
+			matching call to unpin
+		'''
+
+		size = os.path.getsize(filename)
+		if size > self._budget:
+			return None
+
+		with self._lock:
+			path = self._path(key)
+			if key in self._pins and key in self._entries and os.path.exists(path):
+				# a buffer is reading the cached copy
+				size = self._entries.pop(key)
+				self._entries[key] = size
+				self._dirty = True
+				if pin:
+					self._pin(key)
+				try:
+					os.remove(filename)
+				except OSError:
+					pass
+				return path
+
+			if key in self._entries:
+				self._size -= self._entries.pop(key)
+				self._dirty = True
+			if not self._evict(size):
+				debug('No room in the audio cache for %s, the rest is pinned', key)
+				self._saveIndex()
+				return None
+
+			try:
+				_replace(filename, path)
+			except (IOError, OSError) as e:
+				log('Unable to store ' + filename + ' in the audio cache')
+				log('\t' + str(e))
+				self._saveIndex()
+				return None
+
+			self._entries[key] = size
+			self._size += size
+			if pin:
+				self._pin(key)
+			self._saveIndex()
+			return path
+
+	def unpin(self, key):
+		'''
+		Match a lookup or store which pinned the given key. Once every pin is
+		matched the entry may be evicted again.
+		'''
+
+		with self._lock:
+			count = self._pins.get(key, 0) - 1
+			if count > 0:
+				self._pins[key] = count
+			else:
+				self._pins.pop(key, None)
+
+	def remove(self, key):
+		'''
+		Remove the given key from the cache, if it is cached
+		'''
+
+		with self._lock:
+			if key in self._entries:
+				self._size -= self._entries.pop(key)
+				self._removeFile(key)
+				self._saveIndex()
+
+	def size(self):
+		'''
+		Return the total size of the cached files in bytes
+		'''
+		return self._size
+
+	def stats(self):
+		'''
+		Return a dictionary with the number of entries, their total size, the
+		budget, the number of entries pinned, and the number of lookup hits
+		and misses
+		'''
+
+		with self._lock:
+			return {'entries': len(self._entries),
+					'size': self._size,
+					'budget': self._budget,
+					'pinned': len(self._pins),
+					'hits': self._hits,
+					'misses': self._misses}
+
+	def close(self):
+		'''
+		Save the index if lookups have changed the order of the entries since
+		it was last saved
+		'''
+
+		with self._lock:
+			if self._dirty:
+				self._saveIndex()
+
+	def _path(self, key):
+		return os.path.join(self._directory, key)
+
+	def _pin(self, key):
+		'''
+		Caller must hold _lock
+		'''
+		self._pins[key] = self._pins.get(key, 0) + 1
+
+	def _evict(self, needed):
+		'''
+		Evict least recently used entries which are not pinned until there is
+		room for needed more bytes. Caller must hold _lock. Returns False if
+		there is still not enough room.
+		'''
+
+		if self._size + needed <= self._budget:
+			return True
+		for key in self._entries.keys():
+			if key in self._pins:
+				continue
+			self._size -= self._entries.pop(key)
+			self._removeFile(key)
+			self._dirty = True
+			if self._size + needed <= self._budget:
+				return True
+		return False
+
+	def _removeFile(self, key):
+		try:
+			os.remove(self._path(key))
+		except OSError:
+			pass
+
+	def _loadIndex(self):
+		indexPath = os.path.join(self._directory, self.INDEX_FILE)
+		if not os.path.exists(indexPath):
+			return
+
+		f = open(indexPath, 'r')
+		for line in f:
+			try:
+				key, size = line.rstrip('\n').split('\t')
+				size = int(size)
+			except ValueError:
+				# skip damaged lines rather than losing the whole cache
+				continue
+			if key in self._entries:
+				self._size -= self._entries.pop(key)
+			self._entries[key] = size
+			self._size += size
+		f.close()
+
+	def _saveIndex(self):
+		'''
+		Rewrite the index file. Written to a temporary file first, so a crash
+		never leaves a half-written index. Caller must hold _lock.
+		'''
+
+		indexPath = os.path.join(self._directory, self.INDEX_FILE)
+		tempPath = indexPath + '.tmp'
+		try:
+			f = open(tempPath, 'w')
+			for key, size in self._entries.iteritems():
+				f.write(key + '\t' + str(size) + '\n')
+			f.close()
+			_replace(tempPath, indexPath)
+			self._dirty = False
+		except (IOError, OSError) as e:
+			log('Unable to save the audio cache index')
+			log('\t' + str(e))
+
+
+def _replace(source, destination):
+	'''
+	Move source to destination, overwriting destination. os.rename does not
+	overwrite on Windows, and does not work across file systems.
+	'''
+
+	try:
+		os.rename(source, destination)
+	except OSError:
+		if os.path.exists(destination):
+			os.remove(destination)
+		shutil.move(source, destination)
+
+
+_audioCache = None
+_audioCacheLock = threading.Lock()
+
+def getAudioCache():
+	'''
+	Return the process-wide AudioCache, creating it with default settings if
+	configureAudioCache has not been called
+	'''
+	global _audioCache
+	with _audioCacheLock:
+		if _audioCache is None:
+			_audioCache = AudioCache()
+		return _audioCache
+
+def configureAudioCache(directory = AudioCache.DEFAULT_DIRECTORY, budget = AudioCache.DEFAULT_BUDGET):
+	'''
+	Replace the process-wide AudioCache with one using the given directory
+	and budget. Should be called at startup, before any songs are buffered.
+	'''
+	global _audioCache
+	with _audioCacheLock:
+		if _audioCache is not None:
+			_audioCache.close()
+		_audioCache = AudioCache(directory, budget)
+		return _audioCache
@@ -0,0 +1,215 @@
+import os
+import shutil
+import atexit
+import tempfile
+import threading
+from shared import *
+
+class AudioMemory:
+	'''
+	Files held in memory rather than on disc, for buffers to download songs
+	into and decode them from without a round trip through the disc. The
+	files live in a directory on a memory file system (tmpfs), so they have
+	paths which the decoder can open, and the decoder reads the very pages
+	the download wrote. AVbin only opens files by name, so an in-process
+	buffer or an anonymous map could not be passed to it.
+
+	The space for a file is reserved before it is written, from an estimate
+	of its size, and the reservations are kept under a byte budget. A file
+	which does not fit is written to disc instead. Once the real size of a
+	file is known, or the bytes written pass the estimate, its reservation
+	is resized, and a file which no longer fits is written to disc instead.
+
+	Songs in memory are not kept in the AudioCache unless persist is set.
+	Copying them to the cache saves downloading them again in a later
+	session, but writes every song to disc after all, which is what the
+	memory backend avoids.
+
+	Use getAudioMemory() to get the process-wide instance, if the memory
+	backend has been enabled with configureAudioMemory().
+
+	Members:
+		Private:
+			* _directory: the directory on the memory file system holding the
+				files. Created for the process and removed when it exits
+			* _budget: the maximum total size of the reservations in bytes
+			* _persist: whether songs in memory are also kept in the
+				AudioCache
+			* _reserved: a dictionary of key:size pairs, the reservations
+			* _size: the total size of the reservations in bytes
+			* _fallbacks: the number of reservations refused for lack of room
+			* _spills: the number of files which outgrew their reservation
+				with no room to resize it
+			* _lock: protects the members above
+	'''
+
+	DEFAULT_BUDGET = 256 * 1024 * 1024
+
+	# memory file systems, in order of preference
+	MEMORY_DIRECTORIES = ('/dev/shm', '/run/shm')
+
+	def __init__(self, budget = DEFAULT_BUDGET, parent = None, persist = False):
+		'''
+		:param budget: the maximum total size of the files in memory in bytes
+		:param parent: a directory on a memory file system in which to create
+			the process's directory. By default the first of
+			MEMORY_DIRECTORIES which exists
+		:param persist: if True, songs in memory are copied into the
+			AudioCache once they are playable
+		:raises OSError: if there is no memory file system
+		'''
+
+		if parent is None:
+			parent = next((directory for directory in self.MEMORY_DIRECTORIES
+						   if os.path.isdir(directory)), None)
+			if parent is None:
+				raise OSError('No memory file system for audio buffers')
+
+		self._directory = tempfile.mkdtemp(prefix = 'smartshuffle-', dir = parent)
+		self._budget = budget
+		self._persist = persist
+		self._reserved = {}
+		self._size = 0
+		self._fallbacks = 0
+		self._spills = 0
+		self._lock = threading.Lock()
+		atexit.register(self.close)
+
+	def reserve(self, key, size):
+		'''
+		Reserve room for a file of about the given size and return its path,
+		or None if it does not fit in the budget. Reserving a key which is
+		already reserved returns the same path, so a download can carry on
+		from where it stopped.
+		'''
+
+		with self._lock:
+			if key not in self._reserved:
+				if self._size + size > self._budget:
+					self._fallbacks += 1
+					return None
+				self._reserved[key] = size
+				self._size += size
+			return self._path(key)
+
+	def resize(self, key, size, exact = True, force = False):
+		'''
+		Change the reservation for a file to the given size, or if exact is
+		False to at least the given size, eg the bytes written so far of a
+		file of unknown size. Returns False, leaving the reservation as it
+		was, if the key is not reserved or the new size does not fit in the
+		budget, in which case the file should be moved to disc.
+
+		:param force: resize the reservation even if it goes over the budget,
+			eg because the file is being played and cannot be moved. Later
+			reservations are refused until there is room again
+		'''
+
+		with self._lock:
+			reserved = self._reserved.get(key)
+			if reserved is None:
+				return False
+			if size == reserved or (not exact and size < reserved):
+				return True
+			if not force and self._size - reserved + size > self._budget:
+				self._spills += 1
+				return False
+			self._reserved[key] = size
+			self._size += size - reserved
+			return True
+
+	def persists(self):
+		'''
+		Return True if songs in memory are also kept in the AudioCache
+		'''
+		return self._persist
+
+	def release(self, key):
+		'''
+		Delete the file for the given key, if it is still in memory, along
+		with any files beside it, and free its reservation
+		'''
+
+		with self._lock:
+			size = self._reserved.pop(key, None)
+			if size is None:
+				return
+			self._size -= size
+
+		# eg the record of a stopped download beside the file
+		for filename in os.listdir(self._directory):
+			if filename == key or filename.startswith(key + '.'):
+				try:
+					os.remove(os.path.join(self._directory, filename))
+				except OSError:
+					pass
+
+	def stats(self):
+		'''
+		Return a dictionary with the number of files in memory, the bytes
+		reserved for them, the budget, the number of files which went to disc
+		for lack of room and the number which were moved to disc when they
+		outgrew their reservations
+		'''
+
+		with self._lock:
+			return {'files': len(self._reserved),
+					'bytes': self._size,
+					'budget': self._budget,
+					'fallbacks': self._fallbacks,
+					'spills': self._spills}
+
+	def close(self):
+		'''
+		Delete every file. The memory file system does not clear itself until
+		the machine restarts.
+		'''
+
+		with self._lock:
+			self._reserved = {}
+			self._size = 0
+		shutil.rmtree(self._directory, ignore_errors = True)
+
+	def _path(self, key):
+		return os.path.join(self._directory, key)
+
+
+_audioMemory = None
+_audioMemoryLock = threading.Lock()
+
+def getAudioMemory():
+	'''
+	Return the process-wide AudioMemory, or None if the memory backend has
+	not been enabled with configureAudioMemory, in which case buffers write
+	their songs to disc
+	'''
+	with _audioMemoryLock:
+		return _audioMemory
+
+def configureAudioMemory(budget = AudioMemory.DEFAULT_BUDGET, parent = None, persist = False):
+	'''
+	Enable the memory backend for buffers, replacing the process-wide
+	AudioMemory with one using the given budget and persist setting. Returns
+	None, leaving the file backend in use, if there is no memory file
+	system. Should be called at startup, before any songs are buffered.
+	'''
+	global _audioMemory
+	with _audioMemoryLock:
+		if _audioMemory is not None:
+			_audioMemory.close()
+			_audioMemory = None
+		try:
+			_audioMemory = AudioMemory(budget, parent, persist)
+		except OSError as e:
+			log('Unable to keep audio buffers in memory, using the disc: ' + str(e), console = True)
+		return _audioMemory
+
+def disableAudioMemory():
+	'''
+	Go back to writing buffers to disc
+	'''
+	global _audioMemory
+	with _audioMemoryLock:
+		if _audioMemory is not None:
+			_audioMemory.close()
+			_audioMemory = None
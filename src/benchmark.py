@@ -0,0 +1,345 @@
+'''
+End to end benchmarks of SongQueue against a local FakeMusicServer. Plays
+silently, so it needs no sound card and no Google account.
+
+Usage:
+	python benchmark.py [--songs N] [--duration SECONDS] [--bandwidth BYTES_PER_SECOND]
+		[--latency SECONDS] [--url-latency SECONDS] [--progressive] [--output FILE]
+	python benchmark.py --compare OLD.json NEW.json
+
+Each run plays scripted sessions and writes the results as JSON:
+	* start: time from creating the queue to the first song playing
+	* rapidSkips: latency of each of a series of quick skips forward
+	* skipBurst: a burst of skips forward faster than a song can buffer: the
+		time from the last skip to audio, and the bytes downloaded from the
+		first skip until the prefetch window is full again
+	* goBack: latency of each of a series of skips back
+	* longListening: listen to each song for a while before skipping, so the
+		next song has time to prefetch
+Latencies are the time from the action to audio playing, and are summarized
+as count, mean, median, p95 and max, in seconds.
+The durations of the spans recorded by Metrics, such as downloads and
+decodes, are included under spans. Memory per buffered song is the growth
+of the resident set while the window fills, divided by the number of songs
+in the window. It is only measured on systems with /proc.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import pyglet
+# must be set before pyglet.media is first used
+pyglet.options['audio'] = ('silent',)
+pyglet.options['shadow_window'] = False
+
+from shared import *
+from fakeservice import FakeMusicServer, FakeMobileclient, FakeAccount
+from audiocache import configureAudioCache
+from audiomemory import configureAudioMemory, disableAudioMemory, getAudioMemory
+from bufferstore import getBufferStore
+from transport import getTransport
+from SongQueue import SongQueue
+from metrics import getMetrics
+
+RESULTS_VERSION = 1
+
+# the longest to wait for the prefetch window to fill, in seconds
+WINDOW_TIMEOUT = 120
+
+DEFAULTS = {
+	'songs': 200,
+	'duration': 30.0,
+	'bandwidth': 2 * 1024 * 1024,
+	'latency': 0.05,
+	'urlLatency': 0.2,
+	'acceptRanges': True,
+	'urlLifetime': 3600,
+	'memoryBuffers': 0,
+	'persistMemoryBuffers': False,
+	'progressive': False,
+	'lookahead': 1,
+	'lookbehind': 1,
+	'workers': 2,
+	'skips': 10,
+	'skipInterval': 0.5,
+	'burstSkips': 5,
+	'burstInterval': 0.05,
+	'backs': 5,
+	'listens': 3,
+	'listenSeconds': 10.0,
+	'seed': 0,
+}
+
+def summarize(samples):
+	'''
+	Return the count, mean, median, p95 and max of a list of numbers
+	'''
+
+	if not samples:
+		return {'count': 0, 'mean': None, 'median': None, 'p95': None, 'max': None}
+	ordered = sorted(samples)
+	return {
+		'count': len(ordered),
+		'mean': sum(ordered) / len(ordered),
+		'median': ordered[len(ordered) / 2],
+		'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+		'max': ordered[-1],
+	}
+
+def residentBytes():
+	'''
+	Return the resident set size of this process, or None if unknown
+	'''
+
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError):
+		return None
+
+def directorySize(directory):
+	total = 0
+	for root, dirs, files in os.walk(directory):
+		for name in files:
+			try:
+				total += os.path.getsize(os.path.join(root, name))
+			except OSError:
+				pass
+	return total
+
+def timeToAudio(queue, action, timeout = WINDOW_TIMEOUT):
+	'''
+	Return the time from calling action until the queue is playing, running
+	pyglet's clock while waiting
+	'''
+
+	start = time.time()
+	action()
+	while not queue.isPlaying() and time.time() - start < timeout:
+		pyglet.clock.tick()
+		time.sleep(0.001)
+	return time.time() - start
+
+def idle(seconds):
+	'''
+	Run pyglet's clock for the given number of seconds, as the event loop would
+	'''
+
+	deadline = time.time() + seconds
+	while time.time() < deadline:
+		pyglet.clock.tick()
+		time.sleep(0.01)
+
+def run(config):
+	'''
+	Run every session against a fresh server, cache and buffer directory and
+	return the results as a dictionary
+	'''
+
+	# open the log before leaving the current directory
+	getLogger()
+
+	workDirectory = tempfile.mkdtemp(prefix = 'smartshuffle-bench-')
+	startDirectory = os.getcwd()
+	os.chdir(workDirectory)
+	configureAudioCache(os.path.join(workDirectory, 'cache'))
+	if config['memoryBuffers']:
+		configureAudioMemory(config['memoryBuffers'] * 1024 * 1024, persist = config['persistMemoryBuffers'])
+	else:
+		disableAudioMemory()
+
+	server = FakeMusicServer(bandwidth = config['bandwidth'], latency = config['latency'],
+							 acceptRanges = config['acceptRanges'], urlLifetime = config['urlLifetime'])
+	server.start()
+
+	queue = None
+	try:
+		mobile = FakeMobileclient(server, config['songs'], int(config['duration'] * 1000),
+								  urlLatency = config['urlLatency'], seed = config['seed'])
+		account = FakeAccount(mobile)
+		songs = account.getAllSongs()
+
+		metrics = {}
+		memoryBefore = residentBytes()
+
+		startTime = time.time()
+		queue = SongQueue(songs, progressive = config['progressive'],
+						  lookahead = config['lookahead'], lookbehind = config['lookbehind'],
+						  workers = config['workers'])
+		queue.togglePlay()
+		metrics['start'] = {'timeToFirstAudio': time.time() - startTime}
+
+		# let the rest of the window fill before measuring its memory
+		windowSize = 1 + config['lookahead'] + config['lookbehind']
+		deadline = time.time() + WINDOW_TIMEOUT
+		while queue.isPrefetching() and time.time() < deadline:
+			idle(0.1)
+		memoryAfter = residentBytes()
+		metrics['memory'] = {
+			'residentBytes': memoryAfter,
+			'perBufferedSong': (memoryAfter - memoryBefore) / windowSize
+				if memoryBefore is not None and memoryAfter is not None else None,
+			'diskPerBufferedSong': directorySize('buffers') / windowSize,
+		}
+
+		latencies = []
+		for i in range(config['skips']):
+			latencies.append(timeToAudio(queue, queue.playNext))
+			idle(config['skipInterval'])
+		metrics['rapidSkips'] = summarize(latencies)
+
+		bytesBefore = server.stats()['bytesSent']
+		for i in range(config['burstSkips'] - 1):
+			queue.playNext()
+			idle(config['burstInterval'])
+		burstLatency = timeToAudio(queue, queue.playNext)
+		deadline = time.time() + WINDOW_TIMEOUT
+		while queue.isPrefetching() and time.time() < deadline:
+			idle(0.1)
+		metrics['skipBurst'] = {
+			'skips': config['burstSkips'],
+			'timeToAudio': burstLatency,
+			'bytesSent': server.stats()['bytesSent'] - bytesBefore,
+		}
+
+		latencies = []
+		for i in range(config['backs']):
+			latencies.append(timeToAudio(queue, queue.playPrevious))
+			idle(config['skipInterval'])
+		metrics['goBack'] = summarize(latencies)
+
+		latencies = []
+		for i in range(config['listens']):
+			idle(config['listenSeconds'])
+			latencies.append(timeToAudio(queue, queue.playNext))
+		metrics['longListening'] = summarize(latencies)
+
+		metrics['underruns'] = queue.underruns()
+		metrics['transitions'] = queue.transitionStats()
+		metrics['server'] = server.stats()
+		metrics['transport'] = getTransport().stats()
+		metrics['account'] = account.cacheStats()
+		metrics['bufferStore'] = getBufferStore().stats()
+		if getAudioMemory() is not None:
+			metrics['audioMemory'] = getAudioMemory().stats()
+		metrics['spans'] = getMetrics().snapshot()['spans']
+	finally:
+		if queue is not None:
+			queue.close()
+		server.stop()
+		os.chdir(startDirectory)
+		shutil.rmtree(workDirectory, ignore_errors = True)
+
+	return {
+		'version': RESULTS_VERSION,
+		'time': time.time(),
+		'config': config,
+		'metrics': metrics,
+	}
+
+def flatten(metrics, prefix = ''):
+	'''
+	Return a dictionary of dotted.name:value pairs for the numbers in metrics
+	'''
+
+	ret = {}
+	for name, value in metrics.iteritems():
+		if isinstance(value, dict):
+			ret.update(flatten(value, prefix + name + '.'))
+		elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+			ret[prefix + name] = value
+	return ret
+
+def compare(old, new):
+	'''
+	Return a list of (metric, old value, new value, relative change) tuples
+	for the metrics in either of two results, sorted by metric. Values and
+	changes are None where they cannot be computed.
+	'''
+
+	oldMetrics = flatten(old['metrics'])
+	newMetrics = flatten(new['metrics'])
+	ret = []
+	for name in sorted(set(oldMetrics) | set(newMetrics)):
+		before = oldMetrics.get(name)
+		after = newMetrics.get(name)
+		change = None
+		if before and after is not None:
+			change = (after - before) / float(before)
+		ret.append((name, before, after, change))
+	return ret
+
+def _format(value):
+	if value is None:
+		return '-'
+	if isinstance(value, float):
+		return '%.4f' % value
+	return str(value)
+
+def printComparison(old, new):
+	print '%-40s %14s %14s %9s' % ('metric', 'old', 'new', 'change')
+	for name, before, after, change in compare(old, new):
+		print '%-40s %14s %14s %9s' % (name, _format(before), _format(after),
+									   '-' if change is None else '%+.1f%%' % (change * 100))
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = 'Benchmark SongQueue against a local fake music service')
+	parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'),
+						help = 'compare two results files instead of running')
+	parser.add_argument('--output', default = 'benchmark.json', help = 'file to write the results to')
+	parser.add_argument('--songs', type = int, default = DEFAULTS['songs'])
+	parser.add_argument('--duration', type = float, default = DEFAULTS['duration'],
+						help = 'length of each song in seconds')
+	parser.add_argument('--bandwidth', type = int, default = DEFAULTS['bandwidth'],
+						help = 'bytes per second per connection, 0 for unlimited')
+	parser.add_argument('--latency', type = float, default = DEFAULTS['latency'],
+						help = 'seconds before the server responds')
+	parser.add_argument('--url-latency', dest = 'urlLatency', type = float, default = DEFAULTS['urlLatency'],
+						help = 'seconds to fetch a stream URL')
+	parser.add_argument('--no-ranges', dest = 'acceptRanges', action = 'store_false',
+						help = 'serve whole songs only, ignoring Range headers')
+	parser.add_argument('--url-lifetime', dest = 'urlLifetime', type = int, default = DEFAULTS['urlLifetime'],
+						help = 'seconds before a stream URL expires and must be refreshed')
+	parser.add_argument('--progressive', action = 'store_true')
+	parser.add_argument('--memory-buffers', dest = 'memoryBuffers', type = int,
+						default = DEFAULTS['memoryBuffers'], metavar = 'MB',
+						help = 'download songs into up to MB megabytes of memory instead of to disc')
+	parser.add_argument('--persist-memory-buffers', dest = 'persistMemoryBuffers', action = 'store_true',
+						help = 'also keep songs downloaded into memory in the audio cache on disc')
+	parser.add_argument('--lookahead', type = int, default = DEFAULTS['lookahead'])
+	parser.add_argument('--lookbehind', type = int, default = DEFAULTS['lookbehind'])
+	parser.add_argument('--workers', type = int, default = DEFAULTS['workers'])
+	parser.add_argument('--skips', type = int, default = DEFAULTS['skips'])
+	parser.add_argument('--skip-interval', dest = 'skipInterval', type = float, default = DEFAULTS['skipInterval'])
+	parser.add_argument('--burst-skips', dest = 'burstSkips', type = int, default = DEFAULTS['burstSkips'])
+	parser.add_argument('--burst-interval', dest = 'burstInterval', type = float,
+						default = DEFAULTS['burstInterval'])
+	parser.add_argument('--backs', type = int, default = DEFAULTS['backs'])
+	parser.add_argument('--listens', type = int, default = DEFAULTS['listens'])
+	parser.add_argument('--listen-seconds', dest = 'listenSeconds', type = float,
+						default = DEFAULTS['listenSeconds'])
+	parser.add_argument('--seed', type = int, default = DEFAULTS['seed'])
+	args = parser.parse_args(argv)
+
+	if args.compare:
+		with open(args.compare[0]) as f:
+			old = json.load(f)
+		with open(args.compare[1]) as f:
+			new = json.load(f)
+		printComparison(old, new)
+		return 0
+
+	config = dict((name, getattr(args, name)) for name in DEFAULTS)
+	results = run(config)
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent = 2, sort_keys = True)
+	log('Wrote benchmark results to ' + args.output, console = True)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,242 @@
+import os
+import threading
+from shared import *
+from songbuffer import SongBuffer
+
+class BufferStore:
+	'''
+	The SongBuffers of every session in the process, one per song, shared by
+	the sessions which want the song and reference counted. A song wanted by
+	several sessions is downloaded and decoded once, and its buffer is closed
+	when the last of them releases it.
+
+	Each session registers with a memory budget for the decoded copies of
+	its songs, and the store has a budget for all of them. A session asks
+	the store to admit a song before decoding it. A song is admitted if its
+	decoded size fits in both budgets, counting the admitted songs the
+	session holds, shared or not, against the session's budget, and every
+	admitted song once against the store's. The song a session is playing
+	is always admitted. Until a song's decoded size is known it is estimated
+	from its duration. In progressive mode nothing is decoded ahead of
+	time, so progressive buffers cost nothing.
+
+	Buffers for progressive and non-progressive sessions are kept apart,
+	since they load songs differently.
+
+	Use getBufferStore() to get the process-wide instance.
+
+	Members:
+		Private:
+			* _directory: the directory under which each buffer gets its own
+				directory, named by song ID
+			* _budget: the maximum total decoded size of the admitted songs,
+				in bytes
+			* _buffers: a dictionary of key:SongBuffer pairs, where the key is
+				(songID, progressive)
+			* _owners: a dictionary of key:{session:holds} pairs, the sessions
+				holding each buffer and how many times each has acquired it
+				without releasing it
+			* _sessions: a dictionary of session:(budget, set of keys) pairs
+			* _admitted: the keys of the buffers admitted
+			* _lock: protects the members above
+	'''
+
+	DEFAULT_DIRECTORY = 'buffers'
+	DEFAULT_BUDGET = 1024 * 1024 * 1024
+
+	# decoded size assumed per second of a song before it is decoded: 16 bit
+	# stereo at 44.1kHz
+	DECODED_BYTES_PER_SECOND = 44100 * 2 * 2
+
+	def __init__(self, directory = DEFAULT_DIRECTORY, budget = DEFAULT_BUDGET):
+		'''
+		:param directory: the directory in which to create buffers
+		:param budget: the maximum total decoded size of the songs of every
+			session, in bytes
+		'''
+
+		self._directory = directory
+		self._budget = budget
+		self._buffers = {}
+		self._owners = {}
+		self._sessions = {}
+		self._admitted = set()
+		self._lock = threading.Lock()
+
+	def register(self, session, budget):
+		'''
+		Start holding buffers for a session, eg a PrefetchManager
+
+		:param budget: the maximum total decoded size of the session's songs,
+			in bytes
+		'''
+
+		with self._lock:
+			self._sessions[session] = (budget, set())
+
+	def unregister(self, session):
+		'''
+		Release every buffer the session holds. None of them may be updating
+		for the session.
+		'''
+
+		with self._lock:
+			budget, keys = self._sessions.get(session, (0, ()))
+			keys = list(keys)
+		for key in keys:
+			self._release(session, key, everyHold = True)
+		with self._lock:
+			self._sessions.pop(session, None)
+
+	def acquire(self, session, song, progressive = False,
+				prebufferSeconds = SongBuffer.DEFAULT_PREBUFFER_SECONDS):
+		'''
+		Return the buffer for the given song, creating it if no session holds
+		it. Each acquire by a session is matched by one release, and the
+		session holds the buffer until its last release.
+
+		:param progressive, prebufferSeconds: see SongBuffer. Used if the
+			buffer is created
+		'''
+
+		key = (song.id(), progressive)
+		with self._lock:
+			buffer = self._buffers.get(key)
+			if buffer is None:
+				name = song.id() + ('.progressive' if progressive else '')
+				buffer = self._buffers[key] = SongBuffer(
+					os.path.join(self._directory, name), song = song,
+					progressive = progressive, prebufferSeconds = prebufferSeconds)
+				self._owners[key] = {}
+			owners = self._owners[key]
+			owners[session] = owners.get(session, 0) + 1
+			self._sessions[session][1].add(key)
+			return buffer
+
+	def release(self, session, songID, progressive = False):
+		'''
+		Match one acquire of a song's buffer by a session. If no session holds
+		it any more, its download is aborted and it is closed. The session
+		must not be updating it.
+		'''
+
+		self._release(session, (songID, progressive))
+
+	def _release(self, session, key, everyHold = False):
+		'''
+		Drop one of the session's holds on a buffer, or all of them if
+		everyHold is set, closing the buffer if no session holds it any more.
+		The store's directory is left in place, even when it is empty.
+		'''
+
+		with self._lock:
+			owners = self._owners.get(key)
+			if owners is None or session not in owners:
+				return
+			owners[session] -= 1
+			if everyHold or not owners[session]:
+				del owners[session]
+				self._sessions[session][1].discard(key)
+			if owners:
+				return
+			del self._owners[key]
+			self._admitted.discard(key)
+			buffer = self._buffers.pop(key)
+
+		# closing removes only the buffer's own directory. The directory
+		# above it is shared with buffers another session may be creating
+		buffer.abort()
+		buffer.close()
+
+	def isShared(self, songID, progressive = False):
+		'''
+		Return True if more than one session holds the song's buffer
+		'''
+
+		with self._lock:
+			return len(self._owners.get((songID, progressive), ())) > 1
+
+	def admit(self, session, songID, progressive = False, force = False):
+		'''
+		Return True if the song may be decoded for the session within the
+		budgets, and count it against them if so. A song stays admitted until
+		its buffer is closed.
+
+		:param force: admit the song even if it is over budget, eg because
+			the session is about to play it
+		'''
+
+		key = (songID, progressive)
+		with self._lock:
+			if key in self._admitted:
+				return True
+			if force or progressive:
+				self._admitted.add(key)
+				return True
+
+			size = self._decodedBytes(key)
+			budget, keys = self._sessions[session]
+			sessionTotal = sum(self._decodedBytes(held) for held in keys if held in self._admitted)
+			total = sum(self._decodedBytes(admitted) for admitted in self._admitted)
+			if sessionTotal + size > budget or total + size > self._budget:
+				debug('Not buffering song %s: over the memory budget', songID)
+				return False
+			self._admitted.add(key)
+			return True
+
+	def stats(self):
+		'''
+		Return a dictionary with the number of buffers, the number held by
+		more than one session, the number of sessions, and the estimated
+		decoded size of the admitted songs against the budget
+		'''
+
+		with self._lock:
+			return {'buffers': len(self._buffers),
+					'shared': sum(1 for owners in self._owners.itervalues() if len(owners) > 1),
+					'sessions': len(self._sessions),
+					'decodedBytes': sum(self._decodedBytes(key) for key in self._admitted),
+					'budget': self._budget}
+
+	def _decodedBytes(self, key):
+		'''
+		Caller must hold _lock
+		'''
+
+		songID, progressive = key
+		if progressive:
+			return 0
+		buffer = self._buffers[key]
+		size = buffer.decodedBytes()
+		if size is not None:
+			return size
+		duration = buffer.song().duration()
+		if duration is None:
+			# assume a four minute song
+			duration = 4 * 60 * 1000
+		return int(duration / 1000.0 * self.DECODED_BYTES_PER_SECOND)
+
+
+_bufferStore = None
+_bufferStoreLock = threading.Lock()
+
+def getBufferStore():
+	'''
+	Return the process-wide BufferStore, creating it with default settings if
+	configureBufferStore has not been called
+	'''
+	global _bufferStore
+	with _bufferStoreLock:
+		if _bufferStore is None:
+			_bufferStore = BufferStore()
+		return _bufferStore
+
+def configureBufferStore(directory = BufferStore.DEFAULT_DIRECTORY, budget = BufferStore.DEFAULT_BUDGET):
+	'''
+	Replace the process-wide BufferStore with one using the given directory
+	and budget. Should be called at startup, before any session starts.
+	'''
+	global _bufferStore
+	with _bufferStoreLock:
+		_bufferStore = BufferStore(directory, budget)
+		return _bufferStore
@@ -51,13 +51,54 @@ def draw_rect(x, y, width, height):
     glVertex2f(x, y + height)
     glEnd()
 
+def rect_lines(x, y, width, height):
+    # the outline of a rectangle as the 8 vertices of 4 GL_LINES, which
+    # unlike GL_LINE_LOOP can share a batch with other controls
+    return (x, y, x + width, y,
+            x + width, y, x + width, y + height,
+            x + width, y + height, x, y + height,
+            x, y + height, x, y)
+
 class Control(pyglet.event.EventDispatcher):
-    x = y = 0
-    width = height = 10
+    '''
+    A control is drawn either by calling draw(), or with a pyglet.graphics.Batch
+    given to the constructor, in which case it keeps its vertices in the batch
+    and moves them whenever its position or size changes.
+    '''
+
+    _x = _y = 0
+    _width = _height = 10
 
-    def __init__(self, parent):
+    def __init__(self, parent, batch=None, group=None):
         super(Control, self).__init__()
         self.parent = parent
+        self.batch = batch
+        self.group = group
+
+    def layout(self):
+        # called when the position or size changes
+        pass
+
+    def _set_x(self, x):
+        self._x = x
+        self.layout()
+
+    def _set_y(self, y):
+        self._y = y
+        self.layout()
+
+    def _set_width(self, width):
+        self._width = width
+        self.layout()
+
+    def _set_height(self, height):
+        self._height = height
+        self.layout()
+
+    x = property(lambda self: self._x, _set_x)
+    y = property(lambda self: self._y, _set_y)
+    width = property(lambda self: self._width, _set_width)
+    height = property(lambda self: self._height, _set_height)
 
     def hit_test(self, x, y):
         return (self.x < x < self.x + self.width and  
@@ -70,7 +111,32 @@ class Control(pyglet.event.EventDispatcher):
         self.parent.remove_handlers(self)
 
 class Button(Control):
-    charged = False
+    COLOR = (255, 255, 255)
+    CHARGED_COLOR = (255, 0, 0)
+
+    _charged = False
+
+    def __init__(self, *args, **kwargs):
+        super(Button, self).__init__(*args, **kwargs)
+        self._border = None
+        if self.batch is not None:
+            self._border = self.batch.add(8, GL_LINES, self.group,
+                ('v2f', rect_lines(self.x, self.y, self.width, self.height)),
+                ('c3B', self.COLOR * 8))
+
+    def layout(self):
+        if self._border is not None:
+            self._border.vertices = rect_lines(self.x, self.y, self.width, self.height)
+
+    def _set_charged(self, charged):
+        if charged == self._charged:
+            return
+        self._charged = charged
+        if self._border is not None:
+            color = self.CHARGED_COLOR if charged else self.COLOR
+            self._border.colors = color * 8
+
+    charged = property(lambda self: self._charged, _set_charged)
 
     def draw(self):
         if self.charged:
@@ -97,15 +163,22 @@ Button.register_event_type('on_press')
 class TextButton(Button):
     def __init__(self, *args, **kwargs):
         super(TextButton, self).__init__(*args, **kwargs)
-        self._text = pyglet.text.Label('', anchor_x='center', anchor_y='center')
+        self._text = pyglet.text.Label('', anchor_x='center', anchor_y='center',
+                                       batch=self.batch, group=self.group)
+        self.layout()
 
-    def draw_label(self):
+    def layout(self):
+        super(TextButton, self).layout()
         self._text.x = self.x + self.width / 2
         self._text.y = self.y + self.height / 2
+
+    def draw_label(self):
         self._text.draw()
 
     def set_text(self, text):
-        self._text.text = text
+        # changing the text of a label lays it out again
+        if text != self._text.text:
+            self._text.text = text
 
     text = property(lambda self: self._text.text,
                     set_text)
@@ -113,18 +186,23 @@ class TextButton(Button):
 class Label(Control):
     def __init__(self, *args, **kwargs):
         super(Label, self).__init__(*args, **kwargs)
-        self._text = pyglet.text.Label('', anchor_x='center', anchor_y='center')
+        self._text = pyglet.text.Label('', anchor_x='center', anchor_y='center',
+                                       batch=self.batch, group=self.group)
+        self.layout()
+
+    def layout(self):
+        self._text.x = self.x + self.width / 2
+        self._text.y = self.y + self.height / 2
 
     def draw(self):
         self.draw_label()
 
     def draw_label(self):
-        self._text.x = self.x + self.width / 2
-        self._text.y = self.y + self.height / 2
         self._text.draw()
 
     def set_text(self, text):
-        self._text.text = text
+        if text != self._text.text:
+            self._text.text = text
 
     text = property(lambda self: self._text.text,
                     set_text)
@@ -0,0 +1,592 @@
+import os
+import re
+import json
+import math
+import time
+import threading
+import urllib3
+from shared import *
+from transport import getTransport
+
+class RangeDownload:
+	'''
+	A download of one file over HTTP, split into byte ranges which are fetched
+	over several pooled connections at once and written straight into a
+	preallocated file at their offsets.
+
+	The first range is requested alone. Its response says whether the server
+	supports ranges and how big the file is, and the time it takes measures
+	the throughput of one connection. The rest of the file is then split into
+	segments which take about TARGET_SEGMENT_SECONDS each at that throughput,
+	so a fast connection fetches a file in a few large segments and a slow one
+	in more, smaller segments spread over up to `connections` connections. A
+	server which ignores the Range header answers with the whole file, which
+	is streamed over the one connection as before.
+
+	Segments are handed out in order, and progress reports the bytes from the
+	start of the file which are on disc with no gaps, so a reader playing the
+	file while it downloads never reads a hole.
+
+	Each segment records how much of it is on disc. When a request or a
+	response fails, the segment is requested again from where it stopped,
+	after a delay which doubles with each consecutive failure, up to
+	MAX_RETRIES failures without progress. Server errors (5xx) are retried
+	the same way. If the server rejects the URL, eg because a signed URL
+	expired, a fresh one is fetched with refreshUrl before retrying. A
+	ranged download which stops, because it was aborted or ran out of
+	retries, leaves a PARTIAL_SUFFIX file beside the file recording its
+	segments, and the next download of the same key to the same file
+	carries on from there.
+
+	Members:
+		Private:
+			* _url: the URL downloaded
+			* _filename: the file written
+			* _aborted: a function returning True if the download should stop
+			* _progress: called with the contiguous bytes written and the total
+				size, as for Song.writeAudioToFile
+			* _refreshUrl: a function returning a fresh URL for the file, or
+				None if there is none
+			* _key: identifies the file downloaded, None to never resume
+			* _connections: the maximum number of connections used at once
+			* _total: the size of the file in bytes, None until known
+			* _ranged: True once the file is being fetched in ranges
+			* _segments: a list of [start, end, written] lists, one per range
+				of the file, in order
+			* _pending: the segments waiting to be fetched, in order
+			* _failed: True once the download has given up
+			* _failures: the number of failures since the download last made
+				progress
+			* _retries: the total number of retries
+			* _resumedBytes: the bytes found on disc from an earlier download
+			* _writeSeconds: the time spent writing to the file
+			* _lock: protects the members above
+			* _refreshLock: held while fetching a fresh URL, so that the
+				connections which find the URL rejected fetch one between them
+	'''
+
+	DEFAULT_CONNECTIONS = 3
+
+	# bytes read from the network and written to disc at a time
+	CHUNK_SIZE = 64 * 1024
+
+	# the first range, fetched alone to learn the size of the file and the
+	# throughput of a connection
+	FIRST_SEGMENT_BYTES = 256 * 1024
+
+	MIN_SEGMENT_BYTES = 256 * 1024
+	MAX_SEGMENT_BYTES = 16 * 1024 * 1024
+	TARGET_SEGMENT_SECONDS = 1.0
+
+	# consecutive failures before giving up, and the delays before retrying,
+	# in seconds: RETRY_DELAY, doubling up to MAX_RETRY_DELAY
+	MAX_RETRIES = 5
+	RETRY_DELAY = 0.5
+	MAX_RETRY_DELAY = 8.0
+
+	# statuses with which a server rejects a URL, rather than failing
+	REJECTED_STATUSES = (401, 403, 410)
+
+	PARTIAL_SUFFIX = '.part'
+
+	_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+	def __init__(self, url, filename, aborted, progress = None, refreshUrl = None, key = None,
+				 connections = DEFAULT_CONNECTIONS):
+		'''
+		:param url: the URL to download
+		:param filename: the file to write. It is overwritten, unless an
+			earlier download of the same key to it is resumed
+		:param aborted: a function returning True if the download should stop,
+			checked between chunks
+		:param progress: if not None, called after each chunk is written with
+			the number of bytes from the start of the file written so far and
+			the total size of the file in bytes (None if unknown)
+		:param refreshUrl: if not None, a function returning a fresh URL for
+			the file when the server rejects the current one
+		:param key: identifies the file, eg a song ID. If None, a stopped
+			download is not recorded and nothing is resumed
+		:param connections: the maximum number of connections to use at once
+		'''
+
+		self._url = url
+		self._filename = filename
+		self._aborted = aborted
+		self._progress = progress
+		self._refreshUrl = refreshUrl
+		self._key = key
+		self._connections = max(1, connections)
+		self._total = None
+		self._ranged = False
+		self._segments = []
+		self._pending = []
+		self._failed = False
+		self._failures = 0
+		self._retries = 0
+		self._resumedBytes = 0
+		self._writeSeconds = 0.0
+		self._lock = threading.Lock()
+		self._refreshLock = threading.Lock()
+
+	def run(self):
+		'''
+		Download the file. Returns True if the whole file was written, False if
+		the download failed or was aborted, in which case the file may be
+		incomplete.
+		'''
+
+		complete = False
+		try:
+			complete = self._run()
+		finally:
+			if complete:
+				self._removePartial()
+			elif self._ranged:
+				self._savePartial()
+		return complete
+
+	def writeSeconds(self):
+		'''
+		Return the time spent writing to the file, summed over the connections
+		'''
+		with self._lock:
+			return self._writeSeconds
+
+	def retries(self):
+		'''
+		Return the number of times a request was retried
+		'''
+		with self._lock:
+			return self._retries
+
+	def resumedBytes(self):
+		'''
+		Return the number of bytes an earlier download had already written
+		'''
+		return self._resumedBytes
+
+	def _run(self):
+		if self._loadPartial():
+			complete = self._resume()
+			if complete is not None:
+				return complete
+
+		first = [0, self.FIRST_SEGMENT_BYTES, 0]
+		response = self._open(first)
+		if response is None:
+			return False
+
+		contentRange = self._contentRange(response)
+		if response.status == 206 and contentRange and contentRange[0] == 0:
+			return self._runRanges(response, contentRange[1], contentRange[2])
+		elif response.status == 200:
+			debug('Server ignored the Range header, downloading in one stream')
+			return self._runSingle(response)
+		elif response.status in (206, 416):
+			# no usable size, or the file is empty
+			self._release(response, False)
+			response = self._open()
+			return response is not None and response.status == 200 and self._runSingle(response)
+
+		log('Unable to download audio: status %d', args = (response.status,))
+		self._release(response, False)
+		return False
+
+	def _resume(self):
+		'''
+		Carry on from the segments recorded by an earlier download. Returns
+		None if the server no longer serves the same file in ranges, so the
+		download should start again.
+		'''
+
+		unfinished = [segment for segment in self._segments if segment[2] < segment[1] - segment[0]]
+		if not unfinished:
+			return True
+
+		response = self._open(unfinished[0])
+		if response is None:
+			return False
+		contentRange = self._contentRange(response)
+		if (response.status != 206 or not contentRange or contentRange[2] != self._total or
+				contentRange[0] != unfinished[0][0] + unfinished[0][2]):
+			self._release(response, False)
+			self._removePartial()
+			with self._lock:
+				self._segments = []
+				self._resumedBytes = 0
+			return None
+
+		self._ranged = True
+		debug('Resuming download of %s with %d of %d bytes on disc',
+			  self._filename, self._resumedBytes, self._total)
+		with self._lock:
+			if self._progress:
+				self._progress(self._contiguousBytes(), self._total)
+			self._pending = unfinished[1:]
+
+		try:
+			f = open(self._filename, 'r+b')
+		except IOError as e:
+			self._release(response, False)
+			self._logIOError('open', e)
+			return False
+
+		with f:
+			f.seek(contentRange[0])
+			if not self._stream(response, f, unfinished[0]):
+				if not self._retry():
+					return False
+				with self._lock:
+					self._pending.insert(0, unfinished[0])
+		return self._fetchPending()
+
+	def _runSingle(self, response):
+		'''
+		Write the whole body of a response to the file, starting again from
+		the beginning if it fails
+		'''
+
+		total = response.headers.get('content-length')
+		with self._lock:
+			self._total = int(total) if total is not None else None
+			self._segments = [[0, self._total, 0]]
+		segment = self._segments[0]
+
+		try:
+			f = open(self._filename, 'wb')
+		except IOError as e:
+			self._release(response, False)
+			self._logIOError('open', e)
+			return False
+
+		skip = 0
+		with f:
+			while True:
+				if self._stream(response, f, segment, skip):
+					return True
+
+				# without ranges the body is requested again from the start.
+				# What is already on disc is skipped rather than rewritten,
+				# so a reader of the file never sees it shrink
+				if not self._retry():
+					return False
+				response = self._open()
+				if response is None:
+					return False
+				if response.status != 200:
+					log('Unable to download audio: status %d', args = (response.status,))
+					self._release(response, False)
+					return False
+				skip = segment[2]
+
+	def _runRanges(self, response, firstEnd, total):
+		'''
+		Write the first range from its response, then plan and fetch the rest
+		of the file
+		'''
+
+		with self._lock:
+			self._total = total
+			self._segments = [[0, firstEnd, 0]]
+		self._ranged = True
+
+		try:
+			f = open(self._filename, 'wb')
+			f.truncate(total)
+		except IOError as e:
+			self._release(response, False)
+			self._logIOError('open', e)
+			return False
+
+		start = time.time()
+		with f:
+			firstComplete = self._stream(response, f, self._segments[0])
+		elapsed = time.time() - start
+		if not firstComplete and not self._retry():
+			return False
+
+		# the throughput of one connection, from the first range
+		throughput = self._segments[0][2] / max(elapsed, 0.001)
+		segmentBytes = int(throughput * self.TARGET_SEGMENT_SECONDS)
+		segmentBytes = max(self.MIN_SEGMENT_BYTES, min(self.MAX_SEGMENT_BYTES, segmentBytes))
+		count = int(math.ceil((total - firstEnd) / float(segmentBytes)))
+		with self._lock:
+			for i in range(count):
+				segmentStart = firstEnd + i * segmentBytes
+				self._segments.append([segmentStart, min(segmentStart + segmentBytes, total), 0])
+			self._pending = self._segments[0 if not firstComplete else 1:]
+		if count:
+			debug('Downloading %d bytes in %d segments over %d connections',
+				  total, count + 1, min(len(self._pending), self._connections))
+
+		return self._fetchPending()
+
+	def _fetchPending(self):
+		'''
+		Fetch the pending segments over up to _connections connections.
+		Returns True if every segment is on disc.
+		'''
+
+		workers = []
+		for i in range(min(len(self._pending), self._connections) - 1):
+			worker = threading.Thread(target = self._work, name = 'RangeDownload')
+			worker.daemon = True
+			worker.start()
+			workers.append(worker)
+		self._work()
+		for worker in workers:
+			worker.join()
+
+		with self._lock:
+			return not self._failed and all(written == end - start
+											for start, end, written in self._segments)
+
+	def _work(self):
+		'''
+		Fetch pending segments until there are none left or the download stops
+		'''
+
+		try:
+			f = open(self._filename, 'r+b')
+		except IOError as e:
+			self._logIOError('open', e)
+			with self._lock:
+				self._failed = True
+			return
+
+		with f:
+			while True:
+				with self._lock:
+					if self._failed or self._aborted() or not self._pending:
+						return
+					segment = self._pending.pop(0)
+
+				response = self._open(segment)
+				if response is None:
+					return
+				contentRange = self._contentRange(response)
+				if (response.status != 206 or not contentRange or
+						contentRange[0] != segment[0] + segment[2]):
+					log('Unable to download range: status %d', args = (response.status,))
+					self._release(response, False)
+					with self._lock:
+						self._failed = True
+					return
+
+				f.seek(contentRange[0])
+				if self._stream(response, f, segment):
+					continue
+				if not self._retry():
+					return
+				# carry on from where it stopped
+				with self._lock:
+					self._pending.insert(0, segment)
+
+	def _open(self, segment = None):
+		'''
+		Send a GET for the file, or for the rest of the given segment,
+		retrying while the request fails or the URL is rejected. Returns the
+		response with only its headers read, or None if the download should
+		give up.
+		'''
+
+		if segment is not None:
+			end = segment[1] - 1 if segment[1] is not None else ''
+			headers = {'Range': 'bytes=%d-%s' % (segment[0] + segment[2], end)}
+		else:
+			headers = None
+
+		while True:
+			with self._lock:
+				url = self._url
+			try:
+				response = getTransport().request('GET', url, headers = headers, preload_content = False)
+			except urllib3.exceptions.HTTPError as e:
+				log('HTTP Error while requesting audio', console = True)
+				log(e, console = True)
+				if not self._retry():
+					return None
+				continue
+
+			if response.status >= 500:
+				log('Server error while requesting audio: status %d', args = (response.status,))
+				self._release(response, False)
+				if not self._retry():
+					return None
+				continue
+			if response.status not in self.REJECTED_STATUSES:
+				return response
+
+			log('Stream URL rejected: status %d', args = (response.status,))
+			self._release(response, False)
+			if not self._retry(refresh = url):
+				return None
+
+	def _retry(self, refresh = None):
+		'''
+		Wait before trying again after a failure, fetching a fresh URL first
+		if refresh is the URL which was rejected. Returns False, and marks the
+		download failed, if it should give up instead: because it was aborted
+		or the failures without progress reached MAX_RETRIES.
+		'''
+
+		with self._lock:
+			if self._failed or self._aborted():
+				self._failed = True
+				return False
+			self._failures += 1
+			if self._failures > self.MAX_RETRIES:
+				log('Giving up download of %s after %d failures', args = (self._filename, self.MAX_RETRIES))
+				self._failed = True
+				return False
+			self._retries += 1
+			delay = min(self.RETRY_DELAY * 2 ** (self._failures - 1), self.MAX_RETRY_DELAY)
+
+		debug('Retrying download of %s in %.1fs', self._filename, delay)
+		deadline = time.time() + delay
+		while True:
+			if self._aborted():
+				with self._lock:
+					self._failed = True
+				return False
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			time.sleep(min(remaining, 0.1))
+
+		if refresh is not None and self._refreshUrl is not None:
+			with self._refreshLock:
+				with self._lock:
+					current = self._url
+				# another connection may have refreshed it while we waited
+				if current == refresh:
+					url = self._refreshUrl()
+					if url:
+						with self._lock:
+							self._url = url
+		return True
+
+	def _stream(self, response, f, segment, skip = 0):
+		'''
+		Write the body of a response to the file at the current position,
+		counting the bytes in the given segment. Returns True if the whole body
+		was written.
+
+		:param skip: the bytes at the start of the body to discard
+		'''
+
+		complete = False
+		try:
+			for chunk in response.stream(self.CHUNK_SIZE):
+				if self._aborted() or self._failed:
+					break
+				if skip:
+					if len(chunk) <= skip:
+						skip -= len(chunk)
+						continue
+					chunk = chunk[skip:]
+					skip = 0
+				writeStart = time.time()
+				f.write(chunk)
+				# make the chunk visible to readers of the file before
+				# announcing it
+				f.flush()
+				writeSeconds = time.time() - writeStart
+				with self._lock:
+					self._writeSeconds += writeSeconds
+					self._failures = 0
+					segment[2] += len(chunk)
+					if self._progress:
+						self._progress(self._contiguousBytes(), self._total)
+			else:
+				complete = segment[1] is None or segment[2] == segment[1] - segment[0]
+		except urllib3.exceptions.HTTPError as e:
+			log('HTTP Error while streaming audio', console = True)
+			log(e, console = True)
+		except IOError as e:
+			# includes socket errors
+			self._logIOError('write', e)
+		finally:
+			self._release(response, complete)
+
+		return complete
+
+	def _contiguousBytes(self):
+		'''
+		Return the bytes from the start of the file which have been written,
+		up to the first gap. Caller must hold _lock
+		'''
+
+		contiguous = 0
+		for start, end, written in self._segments:
+			contiguous += written
+			if end is None or written < end - start:
+				break
+		return contiguous
+
+	def _contentRange(self, response):
+		'''
+		Return the (start, end, total) of a response's Content-Range, with end
+		exclusive, or None if it has none with a known total
+		'''
+
+		match = self._CONTENT_RANGE.match(response.headers.get('content-range', ''))
+		if not match or match.group(3) == '*':
+			return None
+		return int(match.group(1)), int(match.group(2)) + 1, int(match.group(3))
+
+	def _loadPartial(self):
+		'''
+		Load the segments recorded by an earlier download of the same key to
+		the same file. Returns True if there were any.
+		'''
+
+		if self._key is None:
+			return False
+		try:
+			with open(self._filename + self.PARTIAL_SUFFIX) as f:
+				partial = json.load(f)
+			if partial['key'] != self._key or os.path.getsize(self._filename) != partial['total']:
+				return False
+			segments = [[int(start), int(end), int(written)] for start, end, written in partial['segments']]
+		except (IOError, OSError, ValueError, KeyError, TypeError):
+			return False
+
+		with self._lock:
+			self._total = partial['total']
+			self._segments = segments
+			self._resumedBytes = sum(written for start, end, written in segments)
+		return True
+
+	def _savePartial(self):
+		'''
+		Record the segments on disc, so a later download can resume
+		'''
+
+		if self._key is None or self._total is None:
+			return
+		with self._lock:
+			partial = {'key': self._key, 'total': self._total, 'segments': self._segments}
+			data = json.dumps(partial)
+		try:
+			with open(self._filename + self.PARTIAL_SUFFIX, 'w') as f:
+				f.write(data)
+		except IOError as e:
+			self._logIOError('record', e)
+
+	def _removePartial(self):
+		try:
+			os.remove(self._filename + self.PARTIAL_SUFFIX)
+		except OSError:
+			pass
+
+	def _release(self, response, complete):
+		if not complete:
+			# drop the connection rather than reading the rest of the body,
+			# so that an aborted download stops using bandwidth immediately
+			response.close()
+		response.release_conn()
+
+	def _logIOError(self, action, e):
+		log('IOERROR: Unable to %s file %s' % (action, self._filename), console = True)
+		log('\t' + str(e), console = True)
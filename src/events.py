@@ -0,0 +1,428 @@
+import os
+import time
+import struct
+import threading
+import Queue
+from shared import *
+
+class SongStats:
+	'''
+	The totals of the events recorded for one song
+
+	Members:
+		Public:
+			* plays, skips, completes, seeks: the number of each event
+			* rating: the last rating recorded, None if there is none
+			* lastPlayed: the time of the last play event, 0 if never played
+			* skipSeconds: the sum of the positions of the skips, in seconds
+	'''
+
+	__slots__ = ('plays', 'skips', 'completes', 'seeks', 'rating', 'lastPlayed', 'skipSeconds')
+
+	FORMAT = struct.Struct('<IIIIbdd')
+
+	def __init__(self):
+		self.plays = 0
+		self.skips = 0
+		self.completes = 0
+		self.seeks = 0
+		self.rating = None
+		self.lastPlayed = 0.0
+		self.skipSeconds = 0.0
+
+	def add(self, eventType, timeStamp, position, value):
+		if eventType == EventStore.PLAY:
+			self.plays += 1
+			self.lastPlayed = max(self.lastPlayed, timeStamp)
+		elif eventType == EventStore.SKIP:
+			self.skips += 1
+			self.skipSeconds += position
+		elif eventType == EventStore.COMPLETE:
+			self.completes += 1
+		elif eventType == EventStore.SEEK:
+			self.seeks += 1
+		elif eventType == EventStore.RATE:
+			self.rating = int(value)
+
+	def pack(self):
+		rating = -1 if self.rating is None else self.rating
+		return self.FORMAT.pack(self.plays, self.skips, self.completes, self.seeks, rating,
+								self.lastPlayed, self.skipSeconds)
+
+	def unpack(self, data, offset):
+		(self.plays, self.skips, self.completes, self.seeks, rating,
+		 self.lastPlayed, self.skipSeconds) = self.FORMAT.unpack_from(data, offset)
+		self.rating = None if rating < 0 else rating
+
+class EventStore:
+	'''
+	A persistent, append-only log of what the listener did with each song:
+	plays, skips, completes, seeks and ratings, with the time of each and the
+	position in the song at which it happened.
+
+	The log file starts with a header: magic 'SSEV' and format version
+	(uint32). Each record follows as a type byte. A song record (type 0) is
+	a length (uint16) and a utf-8 song ID, and gives the song the next song
+	number, starting from 0. Any other type is an event: the song number
+	(uint32), time in seconds since the epoch (float64), position in seconds
+	(float32) and a value (float32), the new position for a seek and the
+	rating for a rating. Integers are little endian.
+
+	Records are queued by record() and written in batches by a background
+	thread, so the playback thread never waits for the disc. The totals for
+	each song are kept in memory as events are recorded. On close they are
+	saved to a summary file with the length of the log they cover, so that
+	loading the store only reads the summary and the records after it. A
+	partial record at the end of the log, left by a crash, is cut off.
+
+	Members:
+		Private:
+			* _filename: the log file. The summary is <filename>.sum
+			* _songIDs: the IDs of the songs in the log, by song number
+			* _numbers: a dictionary of songID:song number pairs
+			* _stats: a dictionary of songID:SongStats pairs
+			* _lock: protects the members above, which are updated by the
+				recording thread and read by others
+			* _queue: packed records waiting to be written
+			* _thread: the writer thread
+			* _file: the log file, only used by the writer thread
+			* _closed: True once close has been called
+	'''
+
+	MAGIC = 'SSEV'
+	SUMMARY_MAGIC = 'SSES'
+	VERSION = 1
+
+	DEFAULT_FILE = 'events.dat'
+
+	HEADER = struct.Struct('<4sI')
+	SUMMARY_HEADER = struct.Struct('<4sIQI')
+	SONG = struct.Struct('<BH')
+	EVENT = struct.Struct('<BIdff')
+
+	# event types
+	PLAY = 1
+	SKIP = 2
+	COMPLETE = 3
+	SEEK = 4
+	RATE = 5
+
+	EVENT_NAMES = {PLAY: 'play', SKIP: 'skip', COMPLETE: 'complete', SEEK: 'seek', RATE: 'rate'}
+
+	# the type of a song record
+	SONG_RECORD = 0
+
+	# records written per flush of the file
+	BATCH_SIZE = 256
+
+	def __init__(self, filename = DEFAULT_FILE):
+		'''
+		:param filename: the log file, created if it does not exist
+		'''
+
+		self._filename = filename
+		self._songIDs = []
+		self._numbers = {}
+		self._stats = {}
+		self._lock = threading.Lock()
+		self._queue = Queue.Queue()
+		self._closed = False
+
+		end = self._load()
+
+		self._file = open(self._filename, 'r+b' if end else 'wb')
+		if end:
+			self._file.seek(end)
+			self._file.truncate()
+		else:
+			self._file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+
+		self._thread = threading.Thread(target = self._write, name = 'EventStore')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def record(self, eventType, songID, position = 0.0, value = 0.0, timeStamp = None):
+		'''
+		Record an event. Returns immediately, the event is written later.
+
+		:param eventType: PLAY, SKIP, COMPLETE, SEEK or RATE
+		:param songID: the song the event happened to
+		:param position: seconds into the song at which it happened
+		:param value: the new position in seconds for SEEK, the rating for RATE
+		:param timeStamp: seconds since the epoch, by default now
+		'''
+
+		if eventType not in self.EVENT_NAMES:
+			raise ValueError('unknown event type: ' + str(eventType))
+		if timeStamp is None:
+			timeStamp = time.time()
+
+		with self._lock:
+			if self._closed:
+				return
+			number = self._numbers.get(songID)
+			if number is None:
+				number = self._addSong(songID)
+				encoded = _encode(songID)
+				self._queue.put(self.SONG.pack(self.SONG_RECORD, len(encoded)) + encoded)
+			self._stats[songID].add(eventType, timeStamp, position, value)
+			self._queue.put(self.EVENT.pack(eventType, number, timeStamp, position, value))
+
+	def stats(self, songID):
+		'''
+		Return the SongStats for a song, or None if no events were recorded for it
+		'''
+
+		with self._lock:
+			return self._stats.get(songID)
+
+	def allStats(self):
+		'''
+		Return a dictionary of songID:SongStats pairs for every song with
+		events. The SongStats must not be modified.
+		'''
+
+		with self._lock:
+			return dict(self._stats)
+
+	def skipRate(self, songID, prior = 0):
+		'''
+		Return the number of times a song was skipped divided by the number of
+		times it was played plus prior. A prior keeps songs played once or
+		twice from getting extreme rates. 0 if the song was never played.
+		'''
+
+		with self._lock:
+			stats = self._stats.get(songID)
+			if stats is None or stats.plays + prior <= 0:
+				return 0.0
+			return float(stats.skips) / (stats.plays + prior)
+
+	def skipRates(self, prior = 0):
+		'''
+		Return a dictionary of songID:skip rate pairs, as for skipRate, for
+		every song played
+		'''
+
+		with self._lock:
+			return dict((songID, float(stats.skips) / (stats.plays + prior))
+						for songID, stats in self._stats.iteritems() if stats.plays + prior > 0)
+
+	def artistSkipRates(self, songs, prior = 0):
+		'''
+		Return a dictionary of artist:skip rate pairs for the artists of the
+		given Songs: the skips of their songs divided by the plays plus prior.
+		Artists whose songs were never played are left out.
+		'''
+
+		plays = {}
+		skips = {}
+		with self._lock:
+			for song in songs:
+				stats = self._stats.get(song.id())
+				if stats is not None and stats.plays:
+					artist = song.artist()
+					plays[artist] = plays.get(artist, 0) + stats.plays
+					skips[artist] = skips.get(artist, 0) + stats.skips
+		return dict((artist, float(skips[artist]) / (plays[artist] + prior)) for artist in plays)
+
+	def ratings(self):
+		'''
+		Return a dictionary of songID:rating pairs for the songs rated
+		'''
+
+		with self._lock:
+			return dict((songID, stats.rating) for songID, stats in self._stats.iteritems()
+						if stats.rating is not None)
+
+	def numSongs(self):
+		with self._lock:
+			return len(self._stats)
+
+	def flush(self):
+		'''
+		Block until every event recorded so far has been written
+		'''
+		self._command('flush')
+
+	def close(self):
+		'''
+		Write the recorded events and the summary, and stop the writer thread
+		'''
+
+		with self._lock:
+			if self._closed:
+				return
+			self._closed = True
+		self._command('close')
+		self._thread.join()
+		self._saveSummary()
+
+	def _command(self, command):
+		if not self._thread.is_alive():
+			return
+		done = threading.Event()
+		self._queue.put((command, done))
+		done.wait()
+
+	def _write(self):
+		while True:
+			batch = [self._queue.get()]
+			try:
+				while len(batch) < self.BATCH_SIZE:
+					batch.append(self._queue.get_nowait())
+			except Queue.Empty:
+				pass
+
+			records = []
+			for record in batch:
+				if isinstance(record, tuple):
+					command, done = record
+					self._writeRecords(records)
+					records = []
+					if command == 'close':
+						self._file.close()
+						done.set()
+						return
+					done.set()
+				else:
+					records.append(record)
+			self._writeRecords(records)
+
+	def _writeRecords(self, records):
+		try:
+			self._file.write(''.join(records))
+			self._file.flush()
+		except (IOError, OSError) as e:
+			# the totals in memory are still right, and are saved on close
+			log('Unable to write the event log: ' + str(e))
+
+	def _addSong(self, songID):
+		number = len(self._songIDs)
+		self._songIDs.append(songID)
+		self._numbers[songID] = number
+		self._stats[songID] = SongStats()
+		return number
+
+	def _load(self):
+		'''
+		Read the summary and the log records after it. Returns the offset of
+		the end of the last whole record, or 0 if there is no valid log.
+		'''
+
+		if not os.path.exists(self._filename):
+			return 0
+
+		f = open(self._filename, 'rb')
+		try:
+			data = f.read(self.HEADER.size)
+			if len(data) < self.HEADER.size or self.HEADER.unpack(data) != (self.MAGIC, self.VERSION):
+				log('Ignoring event log with unknown format: ' + self._filename)
+				return 0
+
+			offset = self._loadSummary()
+			if offset is None:
+				offset = self.HEADER.size
+			f.seek(offset)
+			data = f.read()
+		finally:
+			f.close()
+
+		replayed = 0
+		position = 0
+		while position < len(data):
+			eventType = ord(data[position])
+			if eventType == self.SONG_RECORD:
+				if position + self.SONG.size > len(data):
+					break
+				eventType, length = self.SONG.unpack_from(data, position)
+				end = position + self.SONG.size + length
+				if end > len(data):
+					break
+				self._addSong(data[position + self.SONG.size:end].decode('utf-8'))
+			else:
+				end = position + self.EVENT.size
+				if end > len(data) or eventType not in self.EVENT_NAMES:
+					break
+				eventType, number, timeStamp, songPosition, value = self.EVENT.unpack_from(data, position)
+				if number >= len(self._songIDs):
+					break
+				self._stats[self._songIDs[number]].add(eventType, timeStamp, songPosition, value)
+				replayed += 1
+			position = end
+
+		if position < len(data):
+			log('Discarding %d bytes of damaged records at the end of the event log', args = (len(data) - position,))
+		log('Loaded events for %d songs, replayed %d events', args = (len(self._songIDs), replayed))
+		return offset + position
+
+	def _loadSummary(self):
+		'''
+		Read the summary file. Returns the offset in the log at which it ends,
+		or None if there is no valid summary.
+		'''
+
+		filename = self._filename + '.sum'
+		if not os.path.exists(filename):
+			return None
+
+		f = open(filename, 'rb')
+		data = f.read()
+		f.close()
+
+		try:
+			magic, version, offset, count = self.SUMMARY_HEADER.unpack_from(data, 0)
+			if magic != self.SUMMARY_MAGIC or version != self.VERSION or offset > os.path.getsize(self._filename):
+				raise ValueError('unknown format')
+
+			position = self.SUMMARY_HEADER.size
+			for i in xrange(count):
+				length, = struct.unpack_from('<H', data, position)
+				position += 2
+				if position + length > len(data):
+					raise ValueError('truncated')
+				songID = data[position:position + length].decode('utf-8')
+				position += length
+				self._addSong(songID)
+				self._stats[songID].unpack(data, position)
+				position += SongStats.FORMAT.size
+
+		except (struct.error, ValueError, UnicodeDecodeError) as e:
+			log('Ignoring damaged event summary: ' + filename)
+			log('\t' + str(e))
+			self._songIDs = []
+			self._numbers = {}
+			self._stats = {}
+			return None
+
+		return offset
+
+	def _saveSummary(self):
+		'''
+		Write the totals and the length of the log they cover. Only called once
+		the writer thread has finished.
+		'''
+
+		filename = self._filename + '.sum'
+		tempName = filename + '.tmp'
+		try:
+			f = open(tempName, 'wb')
+			f.write(self.SUMMARY_HEADER.pack(self.SUMMARY_MAGIC, self.VERSION,
+											 os.path.getsize(self._filename), len(self._songIDs)))
+			for songID in self._songIDs:
+				encoded = _encode(songID)
+				f.write(struct.pack('<H', len(encoded)))
+				f.write(encoded)
+				f.write(self._stats[songID].pack())
+			f.close()
+			if os.path.exists(filename):
+				# rename does not overwrite on Windows
+				os.remove(filename)
+			os.rename(tempName, filename)
+		except (IOError, OSError) as e:
+			log('Unable to save the event summary: ' + str(e))
+
+def _encode(songID):
+	if isinstance(songID, unicode):
+		return songID.encode('utf-8')
+	return songID
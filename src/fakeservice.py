@@ -0,0 +1,332 @@
+'''
+A local stand-in for Google Play Music, for benchmarks and for running the
+player without an account. FakeMusicServer serves synthetic MP3s over HTTP
+at a configurable bandwidth and latency, FakeMobileclient stands in for
+gmusicapi's Mobileclient, and FakeAccount for Account.
+'''
+
+import re
+import time
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, parse_qs
+from shared import *
+from Song import SongMap
+from library import LibraryStore
+from search import LibraryIndex
+from metrics import getMetrics
+
+# One frame of silent MPEG-1 Layer III audio: 128kbps, 44.1kHz, mono, no
+# CRC. The all-zero side information decodes to silence.
+FRAME_HEADER = '\xff\xfb\x90\xc0'
+FRAME_SIZE = 144 * 128000 / 44100
+FRAME = FRAME_HEADER + '\x00' * (FRAME_SIZE - len(FRAME_HEADER))
+FRAMES_PER_SECOND = 44100 / 1152.0
+
+def audioSize(durationMillis):
+	'''
+	Return the size in bytes of the synthetic MP3 for a song of the given length
+	'''
+	return int(durationMillis / 1000.0 * FRAMES_PER_SECOND) * FRAME_SIZE
+
+class FakeMusicServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''
+	An HTTP server on localhost serving /audio/<songID>?expire=<time> with a
+	synthetic MP3 for each song. Requests after the expire time are refused
+	with 403, like Google's signed URLs. Connections are kept alive. A single
+	byte range in a Range header is answered with 206, unless acceptRanges
+	is False, in which case the header is ignored.
+
+	Members:
+		Public:
+			* bandwidth: the bytes per second sent on each connection, 0 for
+				unlimited
+			* latency: seconds to wait before sending response headers
+			* urlLifetime: seconds for which a stream URL is valid
+			* acceptRanges: whether Range headers are honoured
+
+		Private:
+			* _sizes: a dictionary of songID:audio size pairs for the songs served
+			* _thread: the thread running the server
+			* _lock: protects the counters
+	'''
+
+	daemon_threads = True
+
+	# bytes written to a connection at a time
+	CHUNK_SIZE = 16 * 1024
+
+	def __init__(self, bandwidth = 0, latency = 0, urlLifetime = 3600, port = 0, acceptRanges = True):
+		'''
+		:param bandwidth: the bytes per second sent on each connection, 0 for
+			unlimited
+		:param latency: seconds to wait before sending response headers
+		:param urlLifetime: seconds for which a stream URL is valid
+		:param port: the port to listen on, 0 to pick a free one
+		:param acceptRanges: if False, Range headers are ignored and the whole
+			song is always sent
+		'''
+
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _AudioRequestHandler)
+		self.bandwidth = bandwidth
+		self.latency = latency
+		self.urlLifetime = urlLifetime
+		self.acceptRanges = acceptRanges
+		self._sizes = {}
+		self._lock = threading.Lock()
+		self._requests = 0
+		self._bytesSent = 0
+		self._thread = None
+
+	def start(self):
+		'''
+		Serve requests on a background thread
+		'''
+		self._thread = threading.Thread(target = self.serve_forever, name = 'FakeMusicServer')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def addSong(self, songID, durationMillis):
+		self._sizes[songID] = audioSize(durationMillis)
+
+	def url(self, songID):
+		'''
+		Return a signed stream URL for the given song
+		'''
+		return 'http://127.0.0.1:%d/audio/%s?expire=%d' % (
+			self.server_address[1], songID, int(time.time() + self.urlLifetime))
+
+	def stats(self):
+		'''
+		Return a dictionary with the number of requests and bytes served
+		'''
+		with self._lock:
+			return {'requests': self._requests, 'bytesSent': self._bytesSent}
+
+	def _count(self, requests = 0, bytesSent = 0):
+		with self._lock:
+			self._requests += requests
+			self._bytesSent += bytesSent
+
+class _AudioRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	# a single range, eg bytes=0-1023, bytes=1024- or bytes=-1024
+	_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+	def do_GET(self):
+		server = self.server
+		server._count(requests = 1)
+
+		url = urlparse(self.path)
+		songID = url.path.rsplit('/', 1)[-1]
+		expire = parse_qs(url.query).get('expire', ['0'])[0]
+
+		if server.latency:
+			time.sleep(server.latency)
+
+		if songID not in server._sizes:
+			self._refuse(404)
+			return
+		if int(expire) < time.time():
+			self._refuse(403)
+			return
+
+		size = server._sizes[songID]
+		byteRange = self.headers.get('Range') if server.acceptRanges else None
+		if byteRange is None:
+			self.send_response(200)
+			self.send_header('Content-Type', 'audio/mpeg')
+			self.send_header('Content-Length', str(size))
+			self.send_header('Accept-Ranges', 'bytes' if server.acceptRanges else 'none')
+			self.end_headers()
+			self._sendAudio(0, size)
+			return
+
+		match = self._RANGE.match(byteRange)
+		if not match:
+			self._refuse(416)
+			return
+		start, last = match.groups()
+		if start:
+			start = int(start)
+			end = min(int(last) + 1, size) if last else size
+		else:
+			# a suffix range, the last N bytes
+			start = max(size - int(last), 0)
+			end = size
+		if start >= end:
+			self._refuse(416)
+			return
+
+		self.send_response(206)
+		self.send_header('Content-Type', 'audio/mpeg')
+		self.send_header('Content-Length', str(end - start))
+		self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+		self.end_headers()
+		self._sendAudio(start, end)
+
+	def _sendAudio(self, start, end):
+		'''
+		Send bytes [start, end) of the synthetic MP3 at the server's bandwidth
+		'''
+
+		server = self.server
+		began = time.time()
+		sent = 0
+		position = start
+		while position < end:
+			length = min(server.CHUNK_SIZE, end - position)
+			offset = position % FRAME_SIZE
+			chunk = (FRAME * (2 + length / FRAME_SIZE))[offset:offset + length]
+			try:
+				self.wfile.write(chunk)
+			except IOError:
+				# the client hung up, eg because the download was aborted
+				break
+			position += length
+			sent += length
+			server._count(bytesSent = length)
+
+			if server.bandwidth:
+				ahead = sent / float(server.bandwidth) - (time.time() - began)
+				if ahead > 0:
+					time.sleep(ahead)
+
+	def _refuse(self, status):
+		self.send_response(status)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		debug('FakeMusicServer: ' + format, *args)
+
+class FakeMobileclient:
+	'''
+	A stand-in for gmusicapi's Mobileclient with a generated library. Songs
+	are spread over a fixed number of artists, albums and genres so that
+	shuffling has something to work with.
+
+	Members:
+		Private:
+			* _server: the FakeMusicServer serving the songs' audio
+			* _tracks: the track dictionaries, in the format of the API
+			* _urlLatency: seconds to wait in get_stream_url, to simulate the
+				round trip to Google
+	'''
+
+	ARTISTS = 200
+	ALBUMS_PER_ARTIST = 3
+	GENRES = ('Rock', 'Pop', 'Jazz', 'Classical', 'Hip Hop', 'Electronic', 'Folk', 'Country')
+
+	def __init__(self, server, numSongs, durationMillis = 30000, urlLatency = 0, seed = 0):
+		'''
+		:param server: the FakeMusicServer to serve the songs' audio from
+		:param numSongs: the number of songs in the library
+		:param durationMillis: the length of every song
+		:param urlLatency: seconds to wait in get_stream_url
+		:param seed: seed for the generated metadata
+		'''
+
+		self._server = server
+		self._urlLatency = urlLatency
+		self._tracks = []
+
+		generator = random.Random(seed)
+		now = int(time.time() * 1000000)
+		for i in range(numSongs):
+			artist = generator.randrange(self.ARTISTS)
+			album = generator.randrange(self.ALBUMS_PER_ARTIST)
+			songID = 'fake-%08d' % i
+			self._tracks.append({
+				'id': songID,
+				'title': 'Song %d' % i,
+				'artist': 'Artist %d' % artist,
+				'album': 'Album %d-%d' % (artist, album),
+				'albumArtist': 'Artist %d' % artist,
+				'genre': self.GENRES[artist % len(self.GENRES)],
+				'year': 1960 + (artist * 7 + album) % 60,
+				'trackNumber': i % 12 + 1,
+				'durationMillis': str(durationMillis),
+				'estimatedSize': str(audioSize(durationMillis)),
+				'rating': str(generator.choice((0, 0, 0, 1, 5))),
+				'playCount': generator.randrange(50),
+				'lastModifiedTimestamp': str(now),
+			})
+			server.addSong(songID, durationMillis)
+
+	def get_all_songs(self, incremental = False, include_deleted = None, updated_after = None):
+		if updated_after is not None:
+			# the generated library never changes
+			return []
+		return list(self._tracks)
+
+	def get_stream_url(self, song_id, device_id = None):
+		if self._urlLatency:
+			time.sleep(self._urlLatency)
+		return self._server.url(song_id)
+
+class FakeAccount:
+	'''
+	A stand-in for Account backed by a FakeMobileclient. Supports the parts
+	of Account's interface used by the player.
+
+	Members:
+		Private:
+			* _mobile: the FakeMobileclient
+			* _store: the LibraryStore of the generated library
+			* _index: a LibraryIndex of the generated library
+			* _urlRequests: the number of stream URLs requested
+	'''
+
+	def __init__(self, mobile):
+		self._mobile = mobile
+		self._store = LibraryStore()
+		self._index = LibraryIndex()
+		self._urlRequests = 0
+
+	def isAuthenticated(self):
+		return True
+
+	def logout(self):
+		return True
+
+	def deviceID(self):
+		return 'fake-device'
+
+	def getAllSongs(self):
+		'''
+		Return a dictionary of songID:Song pairs for each song in the library.
+		The search index is built on a thread, as by Account.
+		'''
+
+		# a build from an earlier call reads the store
+		self._index.waitUntilBuilt()
+		for track in self._mobile.get_all_songs():
+			self._store.put(track)
+		self._index.rebuild(self._store, background = True)
+		return SongMap(self._store, self)
+
+	def search(self, query, limit = LibraryIndex.DEFAULT_LIMIT):
+		return self._index.search(query, limit)
+
+	def libraryIndex(self):
+		return self._index
+
+	def getStreamUrl(self, songID, deviceID = None):
+		self._urlRequests += 1
+		with getMetrics().span('streamUrl', song = songID):
+			return self._mobile.get_stream_url(songID, deviceID)
+
+	def invalidateStreamUrl(self, songID):
+		pass
+
+	def cacheStats(self):
+		return {'hits': 0, 'misses': self._urlRequests, 'size': 0}
@@ -0,0 +1,410 @@
+'''
+Runs a SongQueue without a window, controlled over HTTP on localhost, so
+that many players can run on one host and be driven by scripts.
+
+Usage:
+	python headless.py [--port PORT] [--port-file FILE] [--directory DIRECTORY]
+		[--cache DIRECTORY] [--silent] [--username USERNAME | --songs N]
+		[--progressive] [--memory-buffers MB [--persist-memory-buffers]]
+
+Without --username, plays a generated library served by a local
+FakeMusicServer. Each player keeps its buffers, event log and output.txt
+in its directory, so players sharing a host need a directory each. The
+control API listens on 127.0.0.1, on a free port unless --port is given,
+and answers with JSON:
+	* GET /status: the current song, whether it is playing, the position
+		in it, the songs before and after it and the playback counters
+	* POST /play, /pause, /toggle, /next, /previous
+	* POST /jump?offset=N: play the song N places after the current song,
+		or before it if N is negative
+	* POST /jump?song=ID: play the given song now
+	* POST /seek?position=SECONDS
+	* POST /quit: stop the player
+Commands answer once they have been carried out, with the status after them.
+Once the player has stopped, or if a command is not carried out within
+PlaybackEngine.COMMAND_TIMEOUT seconds, the answer is 503.
+'''
+
+import os
+import sys
+import json
+import Queue
+import getpass
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, parse_qs
+
+import pyglet
+# there is no window, so no GL context is needed
+pyglet.options['shadow_window'] = False
+
+from shared import *
+
+class EngineUnavailable(Exception):
+	'''
+	Raised by PlaybackEngine.call when the engine has stopped, or did not
+	get to a command in time
+	'''
+	pass
+
+class PlaybackEngine:
+	'''
+	Runs a SongQueue and pyglet's clock on the thread which calls run(),
+	without a window. SongQueue is not thread safe, so other threads, such
+	as the control server's, queue their commands with call() and the
+	engine carries them out between ticks of the clock.
+
+	Members:
+		Private:
+			* _queue: the SongQueue played
+			* _commands: a Queue of (function, args, result) tuples waiting to
+				be carried out, where result is a _Result
+			* _exit: set by stop() to end run()
+	'''
+
+	# the longest the engine sleeps between ticks of the clock, in seconds
+	MAX_SLEEP = 0.05
+
+	# status lists this many songs before and after the current song
+	STATUS_SONGS = 5
+
+	# the longest call waits for a command to be carried out, in seconds.
+	# Starting a song waits for it to buffer, so this allows for a download
+	COMMAND_TIMEOUT = 30.0
+
+	def __init__(self, queue):
+		'''
+		:param queue: the SongQueue to play. The caller closes it after run
+			returns
+		'''
+
+		self._queue = queue
+		self._commands = Queue.Queue()
+		self._exit = False
+
+	def run(self):
+		'''
+		Play until stop is called
+		'''
+
+		while not self._exit:
+			pyglet.clock.tick()
+
+			# the media players post their events, such as the end of a song,
+			# to pyglet's event loop, which is not running without a window
+			pyglet.app.platform_event_loop.dispatch_posted_events()
+
+			timeout = pyglet.clock.get_sleep_time(True)
+			if timeout is None or timeout > self.MAX_SLEEP:
+				timeout = self.MAX_SLEEP
+			try:
+				function, args, result = self._commands.get(timeout = max(timeout, 0))
+			except Queue.Empty:
+				continue
+
+			try:
+				result.value = function(*args)
+			except Exception as e:
+				log('Headless command %s failed: %s' % (function.__name__, e), console = True)
+				result.error = e
+			result.done.set()
+
+		# nobody is left to carry out the commands still queued
+		while True:
+			try:
+				function, args, result = self._commands.get_nowait()
+			except Queue.Empty:
+				break
+			result.error = EngineUnavailable('the player has stopped')
+			result.done.set()
+
+	def call(self, function, *args):
+		'''
+		Carry out a function on the engine's thread and return its result.
+		Called from other threads. An exception raised by the function is
+		raised here. Raises EngineUnavailable if the engine has stopped, or
+		if the function is not carried out within COMMAND_TIMEOUT seconds, in
+		which case it may still be carried out later.
+		'''
+
+		if self._exit:
+			raise EngineUnavailable('the player has stopped')
+		result = _Result()
+		self._commands.put((function, args, result))
+		if not result.done.wait(self.COMMAND_TIMEOUT):
+			raise EngineUnavailable('the player did not answer within %g seconds' % self.COMMAND_TIMEOUT)
+		if result.error is not None:
+			raise result.error
+		return result.value
+
+	def stop(self):
+		self._exit = True
+
+	def play(self):
+		if not self._queue.isPlaying():
+			self._queue.togglePlay()
+
+	def pause(self):
+		if self._queue.isPlaying():
+			self._queue.togglePlay()
+
+	def toggle(self):
+		self._queue.togglePlay()
+
+	def next(self):
+		self._queue.playNext()
+
+	def previous(self):
+		self._queue.playPrevious()
+
+	def jump(self, offset = None, songID = None):
+		'''
+		Play the song offset places from the current song, or the song with
+		the given ID. Returns False if there is no such song.
+		'''
+
+		if songID is not None:
+			return self._queue.playSong(songID)
+		return self._queue.jumpTo(offset)
+
+	def seek(self, position):
+		return self._queue.seek(position)
+
+	def status(self):
+		'''
+		Return a dictionary describing the player, which can be written as JSON
+		'''
+
+		info = self._queue.getCurrentSongInfo()
+		return {
+			'playing': bool(self._queue.isPlaying()),
+			'song': _songInfo(info) if info else None,
+			'time': self._queue.playbackTime(),
+			'upcoming': [_songInfo(song.data) for song in self._queue.upcoming(self.STATUS_SONGS)],
+			'history': [_songInfo(song.data) for song in self._queue.history(self.STATUS_SONGS)],
+			'prefetching': self._queue.isPrefetching(),
+			'underruns': self._queue.underruns(),
+			'transitions': self._queue.transitionStats(),
+		}
+
+class _Result:
+	def __init__(self):
+		self.value = None
+		self.error = None
+		self.done = threading.Event()
+
+def _songInfo(info):
+	return dict((name, info.get(name)) for name in ('id', 'title', 'artist', 'album', 'durationMillis'))
+
+class ControlServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''
+	An HTTP server on localhost taking commands for a PlaybackEngine. See
+	the description of the API at the top of this file.
+
+	Members:
+		Public:
+			* engine: the PlaybackEngine controlled
+
+		Private:
+			* _thread: the thread running the server
+	'''
+
+	daemon_threads = True
+
+	def __init__(self, engine, port = 0):
+		'''
+		:param engine: the PlaybackEngine to control
+		:param port: the port to listen on, 0 to pick a free one
+		'''
+
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _ControlRequestHandler)
+		self.engine = engine
+		self._thread = None
+
+	def port(self):
+		return self.server_address[1]
+
+	def start(self):
+		'''
+		Serve requests on a background thread
+		'''
+		self._thread = threading.Thread(target = self.serve_forever, name = 'ControlServer')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+class _ControlRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	# the commands taking no arguments, by path
+	COMMANDS = ('play', 'pause', 'toggle', 'next', 'previous')
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		if url.path != '/status':
+			self._reply(404, {'error': 'unknown path ' + url.path})
+			return
+		engine = self.server.engine
+		try:
+			self._reply(200, engine.call(engine.status))
+		except EngineUnavailable as e:
+			self._reply(503, {'error': str(e)})
+
+	def do_POST(self):
+		# the arguments are in the query, but a body left unread would be
+		# taken for the next request on the connection
+		self._discardBody()
+
+		url = urlparse(self.path)
+		command = url.path.strip('/')
+		query = parse_qs(url.query)
+		engine = self.server.engine
+
+		try:
+			if command in self.COMMANDS:
+				result = engine.call(getattr(engine, command))
+			elif command == 'jump' and 'song' in query:
+				result = engine.call(engine.jump, None, query['song'][0])
+			elif command == 'jump' and 'offset' in query:
+				result = engine.call(engine.jump, int(query['offset'][0]))
+			elif command == 'seek' and 'position' in query:
+				result = engine.call(engine.seek, float(query['position'][0]))
+			elif command == 'quit':
+				engine.stop()
+				self._reply(200, {'ok': True})
+				return
+			else:
+				self._reply(400, {'error': 'unknown command or missing argument: ' + self.path})
+				return
+			status = engine.call(engine.status)
+		except EngineUnavailable as e:
+			self._reply(503, {'error': str(e)})
+			return
+		except ValueError as e:
+			self._reply(400, {'error': str(e)})
+			return
+		except Exception as e:
+			self._reply(500, {'error': str(e)})
+			return
+
+		self._reply(200, {'ok': result is not False, 'status': status})
+
+	def _discardBody(self):
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+		except ValueError:
+			# where the body ends is unknown, so the connection cannot be reused
+			self.close_connection = 1
+			return
+		while length > 0:
+			data = self.rfile.read(min(length, 64 * 1024))
+			if not data:
+				break
+			length -= len(data)
+
+	def _reply(self, status, body):
+		data = json.dumps(body)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		debug('ControlServer: ' + format, *args)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = 'Run a player without a window, controlled over HTTP')
+	parser.add_argument('--port', type = int, default = 0, help = 'port for the control API, 0 for any')
+	parser.add_argument('--port-file', dest = 'portFile',
+						help = 'file to write the port of the control API to, once it is listening')
+	parser.add_argument('--directory', default = '.',
+						help = 'directory for the buffers, event log and output.txt')
+	parser.add_argument('--cache', help = 'directory of the audio cache, which players may share')
+	parser.add_argument('--silent', action = 'store_true', help = 'play to a null audio sink')
+	parser.add_argument('--username', help = 'Google account to play, instead of a generated library')
+	parser.add_argument('--songs', type = int, default = 200, help = 'size of the generated library')
+	parser.add_argument('--duration', type = float, default = 180.0,
+						help = 'length of each generated song in seconds')
+	parser.add_argument('--progressive', action = 'store_true')
+	parser.add_argument('--memory-buffers', dest = 'memoryBuffers', type = int, default = 0, metavar = 'MB',
+						help = 'download songs into up to MB megabytes of memory instead of to disc')
+	parser.add_argument('--persist-memory-buffers', dest = 'persistMemoryBuffers', action = 'store_true',
+						help = 'also keep songs downloaded into memory in the audio cache on disc')
+	parser.add_argument('--seed', type = int)
+	args = parser.parse_args(argv)
+
+	if args.silent:
+		# must be set before pyglet.media is first used
+		pyglet.options['audio'] = ('silent',)
+
+	# relative to where we were started, before moving to the directory
+	cache = os.path.abspath(args.cache) if args.cache else None
+	portFile = os.path.abspath(args.portFile) if args.portFile else None
+	if not os.path.exists(args.directory):
+		os.makedirs(args.directory)
+	os.chdir(args.directory)
+
+	# imported after the audio driver is chosen
+	from audiocache import configureAudioCache
+	from audiomemory import configureAudioMemory
+	from albumart import disableArtCache
+	from metrics import getMetrics
+	from events import EventStore
+	from SongQueue import SongQueue
+
+	if cache:
+		configureAudioCache(cache)
+	if args.memoryBuffers:
+		configureAudioMemory(args.memoryBuffers * 1024 * 1024, persist = args.persistMemoryBuffers)
+	# there is no window to show album art in
+	disableArtCache()
+
+	server = None
+	if args.username:
+		from Account import Account
+		account = Account(args.username, getpass.getpass('Password:'))
+		if not account.isAuthenticated():
+			log('Unable to log in as ' + args.username, console = True)
+			return 1
+	else:
+		from fakeservice import FakeMusicServer, FakeMobileclient, FakeAccount
+		server = FakeMusicServer()
+		server.start()
+		account = FakeAccount(FakeMobileclient(server, args.songs, int(args.duration * 1000),
+											   seed = args.seed or 0))
+
+	events = EventStore()
+	getMetrics().startExport()
+	queue = SongQueue(account.getAllSongs(), progressive = args.progressive, seed = args.seed,
+					  events = events)
+	engine = PlaybackEngine(queue)
+	control = ControlServer(engine, args.port)
+	control.start()
+
+	log('Control API listening on 127.0.0.1:%d' % control.port(), console = True)
+	if portFile:
+		with open(portFile, 'w') as f:
+			f.write(str(control.port()) + '\n')
+
+	try:
+		engine.run()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		control.stop()
+		queue.close()
+		events.close()
+		getMetrics().stopExport()
+		if server is not None:
+			server.stop()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,571 @@
+import os
+import sys
+import mmap
+import struct
+import datetime
+from array import array
+from shared import *
+
+try:
+	import numpy
+except ImportError:
+	# scans fall back to plain python loops
+	numpy = None
+
+class LibraryStore:
+	'''
+	A compact, column oriented store of the tracks in a library. Each track
+	is a row. Strings are interned in a single table and their columns hold
+	indices into it, so an artist or album shared by many tracks is stored
+	once. Numeric fields are kept in typed arrays, which can be scanned as a
+	whole (with NumPy, if installed) without touching the other columns.
+
+	Rows are never moved while the store is in use, so a row number is a
+	stable handle for a track. Removed rows are marked dead and dropped by
+	compact().
+
+	A store read from a snapshot only copies the columns and the string
+	table as a whole. The list of strings and the dictionaries from strings
+	and track IDs are built the first time they are needed, eg to add a
+	track or find one by ID, so loading does not visit each track.
+
+	Members:
+		Private:
+			* _strings: the interned strings, utf-8 encoded, or None until
+				built from _stringData. Index 0 is ''
+			* _stringIndex: a dictionary of string:index pairs for _strings,
+				or None until built
+			* _stringData, _stringOffsets: the string table as read, all the
+				strings in one str and an array of the offset of each string
+				in it followed by the end of the last. None if not read
+			* _columns: a dictionary of field name:array pairs, one element per row
+			* _rows: a dictionary of trackID:row pairs for the live rows, or
+				None until built from the columns
+			* _live: the number of live rows
+	'''
+
+	# fields stored as indices into the string table
+	STRING_COLUMNS = ('id', 'title', 'artist', 'album', 'albumArtist', 'genre', 'albumArtUrl')
+
+	# fields stored as numbers, and the array type code for each
+	NUMERIC_COLUMNS = (
+		('durationMillis', 'i'),
+		('year', 'h'),
+		('trackNumber', 'h'),
+		('rating', 'b'),
+		('playCount', 'i'),
+		('recentTimestamp', 'd'),	# last played, microseconds since the epoch
+		('estimatedSize', 'i'),
+		('alive', 'b'),				# 0 for removed rows
+	)
+
+	STRING_TYPE = 'I'
+
+	def __init__(self):
+		self._strings = ['']
+		self._stringIndex = {'': 0}
+		self._stringData = None
+		self._stringOffsets = None
+		self._columns = {}
+		for name in self.STRING_COLUMNS:
+			self._columns[name] = array(self.STRING_TYPE)
+		for name, typeCode in self.NUMERIC_COLUMNS:
+			self._columns[name] = array(typeCode)
+		self._rows = {}
+		self._live = 0
+
+	def __len__(self):
+		'''
+		The number of live tracks
+		'''
+		return self._live
+
+	def numRows(self):
+		'''
+		The number of rows, including removed ones
+		'''
+		return len(self._columns['alive'])
+
+	def put(self, track):
+		'''
+		Add a track dictionary, as returned by the API, or replace the track
+		with the same ID. Returns the track's row.
+		'''
+
+		trackID = _key(track.get('id') or track.get('nid'))
+		values = {
+			'id': trackID,
+			'title': track.get('title'),
+			'artist': track.get('artist'),
+			'album': track.get('album'),
+			'albumArtist': track.get('albumArtist'),
+			'genre': track.get('genre'),
+			'albumArtUrl': (track.get('albumArtRef') or [{}])[0].get('url'),
+		}
+
+		rows = self._rowIndex()
+		if trackID in rows:
+			row = rows[trackID]
+			for name in self.STRING_COLUMNS:
+				self._columns[name][row] = self.intern(values[name])
+		else:
+			row = self.numRows()
+			rows[trackID] = row
+			self._live += 1
+			for name in self.STRING_COLUMNS:
+				self._columns[name].append(self.intern(values[name]))
+			for name, typeCode in self.NUMERIC_COLUMNS:
+				self._columns[name].append(0)
+
+		for name, typeCode in self.NUMERIC_COLUMNS:
+			if name != 'alive':
+				self._columns[name][row] = _number(track.get(name), typeCode)
+		self._columns['alive'][row] = 1
+
+		return row
+
+	def remove(self, trackID):
+		'''
+		Remove the track with the given ID. Returns False if there is no such track.
+		'''
+
+		row = self._rowIndex().pop(_key(trackID), None)
+		if row is None:
+			return False
+		self._columns['alive'][row] = 0
+		self._live -= 1
+		return True
+
+	def row(self, trackID):
+		'''
+		Return the row of the track with the given ID, or None
+		'''
+		return self._rowIndex().get(_key(trackID))
+
+	def rows(self):
+		'''
+		Return a list of the live rows, in the order they were added
+		'''
+		alive = self._columns['alive']
+		if self._live == len(alive):
+			return range(len(alive))
+		if numpy is not None:
+			return numpy.flatnonzero(self.numpyColumn('alive')).tolist()
+		return [row for row in xrange(len(alive)) if alive[row]]
+
+	def intern(self, string):
+		'''
+		Return the index of the given string in the string table, adding it if
+		needed. None is stored as ''.
+		'''
+
+		if string is None:
+			return 0
+		if isinstance(string, unicode):
+			string = string.encode('utf-8')
+		self._loadStrings()
+		index = self._stringIndex.get(string)
+		if index is None:
+			index = len(self._strings)
+			self._strings.append(string)
+			self._stringIndex[string] = index
+		return index
+
+	def string(self, index):
+		'''
+		Return the utf-8 encoded string at the given index of the string table
+		'''
+		if self._strings is None:
+			offsets = self._stringOffsets
+			return self._stringData[offsets[index]:offsets[index + 1]]
+		return self._strings[index]
+
+	def get(self, row, name):
+		'''
+		Return the value of a field for a row. String fields are returned
+		as unicode.
+		'''
+
+		value = self._columns[name][row]
+		if name in self.STRING_COLUMNS:
+			return self.string(value).decode('utf-8')
+		return value
+
+	def column(self, name):
+		'''
+		Return the array holding the given field for every row, including
+		removed rows. For string fields these are indices into the string
+		table. The array must not be modified.
+		'''
+		return self._columns[name]
+
+	def numpyColumn(self, name):
+		'''
+		Return a NumPy view of a column, without copying it. The view is only
+		valid until the next track is added. Requires NumPy.
+		'''
+
+		column = self._columns[name]
+		return numpy.frombuffer(column, dtype = numpy.dtype(column.typecode))
+
+	def select(self, name, minimum = None, maximum = None):
+		'''
+		Return a list of the live rows whose value for a numeric field lies
+		between minimum and maximum inclusive. None means no limit.
+		'''
+
+		if numpy is not None and self.numRows():
+			values = self.numpyColumn(name)
+			mask = self.numpyColumn('alive') != 0
+			if minimum is not None:
+				mask &= values >= minimum
+			if maximum is not None:
+				mask &= values <= maximum
+			return numpy.flatnonzero(mask).tolist()
+
+		values = self._columns[name]
+		alive = self._columns['alive']
+		return [row for row in xrange(len(values)) if alive[row]
+				and (minimum is None or values[row] >= minimum)
+				and (maximum is None or values[row] <= maximum)]
+
+	def track(self, row):
+		'''
+		Return a dictionary for a row, with the same keys as the API
+		'''
+
+		track = {}
+		for name in self.STRING_COLUMNS:
+			track[name] = self.get(row, name)
+		for name, typeCode in self.NUMERIC_COLUMNS:
+			if name != 'alive':
+				track[name] = self._columns[name][row]
+		track['albumArtRef'] = [{'url': track.pop('albumArtUrl')}]
+		return track
+
+	def compact(self):
+		'''
+		Drop removed rows and unused strings. Invalidates row numbers, so must
+		not be called while songs refer to the store.
+		'''
+
+		if self._live == self.numRows():
+			return
+
+		self._loadStrings()
+		old = self._columns
+		oldStrings = self._strings
+		live = self.rows()
+
+		self.__init__()
+		for name in self.STRING_COLUMNS:
+			column = self._columns[name]
+			for row in live:
+				column.append(self.intern(oldStrings[old[name][row]]))
+		for name, typeCode in self.NUMERIC_COLUMNS:
+			column = self._columns[name]
+			for row in live:
+				column.append(old[name][row])
+
+		ids = self._columns['id']
+		for row in xrange(len(live)):
+			self._rows[self._strings[ids[row]]] = row
+		self._live = len(live)
+
+	def write(self, f):
+		'''
+		Write the store to an open file: the string table as a count (uint32),
+		count + 1 offsets (uint32) and the strings, then for each column its
+		byte length (uint64) and contents in native byte order.
+		'''
+
+		self._loadStrings()
+		offsets = [0]
+		for string in self._strings:
+			offsets.append(offsets[-1] + len(string))
+		f.write(struct.pack('<I', len(self._strings)))
+		f.write(struct.pack('<%dI' % len(offsets), *offsets))
+		for string in self._strings:
+			f.write(string)
+
+		for name in self._columnOrder():
+			data = self._columns[name].tostring()
+			f.write(struct.pack('<Q', len(data)))
+			f.write(data)
+
+	def read(self, data, offset):
+		'''
+		Read a store written by write from a buffer (eg a memory map) at the
+		given offset. Returns the offset of the end of the store.
+		'''
+
+		count, = struct.unpack_from('<I', data, offset)
+		offset += 4
+		offsets = array('I')
+		offsets.fromstring(data[offset:offset + 4 * (count + 1)])
+		if len(offsets) != count + 1:
+			raise ValueError('truncated string table')
+		if sys.byteorder != 'little':
+			offsets.byteswap()
+		offset += 4 * (count + 1)
+		self._stringOffsets = offsets
+		self._stringData = data[offset:offset + offsets[-1]]
+		self._strings = None
+		self._stringIndex = None
+		offset += offsets[-1]
+
+		for name in self._columnOrder():
+			length, = struct.unpack_from('<Q', data, offset)
+			offset += 8
+			column = array(self._columns[name].typecode)
+			column.fromstring(data[offset:offset + length])
+			self._columns[name] = column
+			offset += length
+
+		self._rows = None
+		self._live = self._columns['alive'].count(1)
+
+		return offset
+
+	def _rowIndex(self):
+		'''
+		Return _rows, building it from the columns if the store was read
+		'''
+
+		if self._rows is None:
+			ids = self._columns['id']
+			self._rows = dict((self.string(ids[row]), row) for row in self.rows())
+		return self._rows
+
+	def _loadStrings(self):
+		'''
+		Build _strings and _stringIndex, if the store was read
+		'''
+
+		if self._strings is None:
+			offsets = self._stringOffsets
+			data = self._stringData
+			self._strings = [data[offsets[i]:offsets[i + 1]] for i in xrange(len(offsets) - 1)]
+			self._stringIndex = dict((string, i) for i, string in enumerate(self._strings))
+			self._stringData = None
+			self._stringOffsets = None
+
+	def _columnOrder(self):
+		return list(self.STRING_COLUMNS) + [name for name, typeCode in self.NUMERIC_COLUMNS]
+
+def _key(trackID):
+	'''
+	Track IDs are stored utf-8 encoded, like the rest of the string table
+	'''
+
+	if isinstance(trackID, unicode):
+		return trackID.encode('utf-8')
+	return trackID
+
+def _number(value, typeCode):
+	'''
+	Convert a field from the API, which may be a string, to a number for an
+	array of the given type. Missing or malformed values become 0.
+	'''
+
+	try:
+		if typeCode == 'd':
+			return float(value)
+		return int(value)
+	except (TypeError, ValueError):
+		return 0
+
+class LibrarySnapshot:
+	'''
+	A copy of the user's track list kept on disc between sessions, so that
+	on startup only the tracks changed since the last sync have to be
+	fetched from Google. The tracks are held in a LibraryStore.
+
+	The snapshot file starts with a little endian header: magic 'SSLS',
+	format version (uint32), and the newest lastModifiedTimestamp seen, in
+	microseconds (int64). The LibraryStore follows, in the format written by
+	LibraryStore.write. The file is memory-mapped when loaded, so each column
+	is read with a single copy, and it is written to a temporary file and
+	renamed on save, so a crash never leaves a half-written snapshot.
+
+	Members:
+		Private:
+			* _filename: the snapshot file
+			* _store: the LibraryStore holding the tracks
+			* _lastSync: the newest lastModifiedTimestamp among the tracks,
+				in microseconds, 0 if the snapshot is empty
+			* _dirty: True if the tracks changed since the snapshot was
+				loaded or saved
+			* _index: a LibraryIndex kept up to date with the changes applied,
+				or None
+	'''
+
+	MAGIC = 'SSLS'
+
+	# version 1 stored each track as a JSON record
+	VERSION = 2
+
+	DEFAULT_FILE = 'library.dat'
+
+	HEADER = struct.Struct('<4sIq')
+
+	def __init__(self, filename = DEFAULT_FILE):
+		'''
+		:param filename: the snapshot file. It is not read until load is called
+		'''
+
+		self._filename = filename
+		self._store = LibraryStore()
+		self._lastSync = 0
+		self._dirty = False
+		self._index = None
+
+	def setIndex(self, index, background = False):
+		'''
+		Keep the given LibraryIndex up to date as changes are applied. The
+		index is rebuilt from the tracks already in the snapshot, on a thread
+		if background is True. See LibraryIndex.rebuild.
+		'''
+
+		self._index = index
+		if index is not None:
+			index.rebuild(self._store, background)
+
+	def load(self):
+		'''
+		Read the snapshot file. Returns False, leaving the snapshot empty, if
+		the file does not exist or is not a valid snapshot.
+		'''
+
+		self._store = LibraryStore()
+		self._lastSync = 0
+		self._dirty = False
+
+		if not os.path.exists(self._filename) or os.path.getsize(self._filename) < self.HEADER.size:
+			return False
+
+		f = open(self._filename, 'rb')
+		try:
+			data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		finally:
+			f.close()
+
+		try:
+			magic, version, lastSync = self.HEADER.unpack_from(data, 0)
+			if magic != self.MAGIC or version != self.VERSION:
+				log('Ignoring library snapshot with unknown format: ' + self._filename)
+				return False
+
+			self._store.read(data, self.HEADER.size)
+			self._lastSync = lastSync
+
+		except (struct.error, ValueError, IndexError) as e:
+			log('Ignoring damaged library snapshot: ' + self._filename)
+			log('\t' + str(e))
+			self._store = LibraryStore()
+			self._lastSync = 0
+			return False
+
+		finally:
+			data.close()
+
+		return True
+
+	def save(self):
+		'''
+		Write the snapshot file, if the tracks changed since it was loaded.
+		Compacts the store, so must be called before any songs refer to it.
+		'''
+
+		if not self._dirty:
+			return
+
+		# compacting moves the rows an index may still be reading
+		if self._index is not None:
+			self._index.waitUntilBuilt()
+		self._store.compact()
+
+		tempName = self._filename + '.tmp'
+		f = open(tempName, 'wb')
+		f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self._lastSync))
+		self._store.write(f)
+		f.close()
+
+		if os.path.exists(self._filename):
+			# rename does not overwrite on Windows
+			os.remove(self._filename)
+		os.rename(tempName, self._filename)
+		self._dirty = False
+
+	def store(self):
+		'''
+		Return the LibraryStore holding the tracks
+		'''
+		return self._store
+
+	def lastSync(self):
+		return self._lastSync
+
+	def apply(self, changes):
+		'''
+		Apply a list of changed track dictionaries, as returned by the API.
+		Tracks marked deleted are removed, others are added or replaced.
+		Returns the number of tracks changed.
+		'''
+
+		# the index is changed first, so if it is still being built from the
+		# store the store is not changed until it is done
+		for track in changes:
+			if track.get('deleted'):
+				if self._index is not None:
+					self._index.remove(track['id'])
+				if self._store.remove(track['id']):
+					self._dirty = True
+			else:
+				if self._index is not None:
+					self._index.put(track)
+				self._store.put(track)
+				self._dirty = True
+
+			modified = int(track.get('lastModifiedTimestamp', 0))
+			if modified > self._lastSync:
+				self._lastSync = modified
+
+		return len(changes)
+
+	def replace(self, tracks):
+		'''
+		Replace the contents of the snapshot with the given track dictionaries
+		'''
+
+		self._store = LibraryStore()
+		self._lastSync = 0
+		self._dirty = True
+		if self._index is not None:
+			self._index.clear()
+		self.apply(tracks)
+
+	def sync(self, mobile):
+		'''
+		Bring the snapshot up to date using the given Mobileclient. If the
+		snapshot is empty, or the installed gmusicapi cannot list changes since
+		a time, the whole library is fetched instead. Returns the number of
+		tracks fetched.
+		'''
+
+		if len(self._store):
+			since = datetime.datetime.utcfromtimestamp(self._lastSync / 1000000.0)
+			try:
+				changes = mobile.get_all_songs(updated_after = since, include_deleted = True)
+			except TypeError:
+				# this gmusicapi does not support incremental listing
+				changes = None
+
+			if changes is not None:
+				log('Library sync: ' + str(len(changes)) + ' changes since last session')
+				return self.apply(changes)
+
+		tracks = mobile.get_all_songs()
+		log('Library sync: fetched all ' + str(len(tracks)) + ' tracks')
+		self.replace(tracks)
+		return len(tracks)
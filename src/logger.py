@@ -0,0 +1,226 @@
+import os
+import time
+import threading
+import Queue
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+class AsyncLogger:
+	'''
+	A log file written by a single background thread. Callers on any thread
+	only put a record on a queue, so logging never waits for file I/O.
+	Messages are formatted on the writer thread: a message with args is
+	formatted with message % args, and a callable message is called, only
+	when the record is written, and never if its level is filtered out.
+
+	When the file grows past maxBytes it is renamed to <filename>.1, older
+	files are shifted up to <filename>.<backupCount>, and a new file started.
+
+	Members:
+		Private:
+			* _filename: the log file
+			* _level: records below this level are dropped
+			* _maxBytes: the size at which the file is rotated, 0 to never rotate
+			* _backupCount: the number of rotated files to keep
+			* _queue: records waiting to be written
+			* _thread: the writer thread
+			* _file: the open log file, only used by the writer thread
+			* _stats: counters for stats(), updated by the callers of log()
+				and by the writer thread
+			* _statsLock: protects _stats
+	'''
+
+	DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+	DEFAULT_BACKUP_COUNT = 3
+
+	# records written per flush of the file
+	BATCH_SIZE = 256
+
+	def __init__(self, filename, level = INFO, maxBytes = DEFAULT_MAX_BYTES,
+				 backupCount = DEFAULT_BACKUP_COUNT):
+		'''
+		:param filename: the log file, appended to if it exists
+		:param level: records below this level are dropped
+		:param maxBytes: the size at which the file is rotated, 0 to never rotate
+		:param backupCount: the number of rotated files to keep
+		'''
+
+		self._filename = filename
+		self._level = level
+		self._maxBytes = maxBytes
+		self._backupCount = backupCount
+		self._queue = Queue.Queue()
+		self._file = None
+		self._closed = False
+
+		self._statsLock = threading.Lock()
+		self._stats = {
+			'records': 0,
+			'dropped': 0,
+			'rotations': 0,
+			'callSeconds': 0.0,
+			'maxCallSeconds': 0.0,
+			'queueSeconds': 0.0,
+			'maxQueueSeconds': 0.0,
+		}
+
+		self._thread = threading.Thread(target = self._write, name = 'AsyncLogger')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def setLevel(self, level):
+		self._level = level
+
+	def log(self, message = None, args = (), level = INFO):
+		'''
+		Queue a record. A message of None writes an empty line.
+		'''
+
+		start = time.time()
+		if level < self._level:
+			with self._statsLock:
+				self._stats['dropped'] += 1
+			return
+		self._queue.put((start, level, message, args, None))
+
+		elapsed = time.time() - start
+		with self._statsLock:
+			self._stats['callSeconds'] += elapsed
+			if elapsed > self._stats['maxCallSeconds']:
+				self._stats['maxCallSeconds'] = elapsed
+
+	def flush(self):
+		'''
+		Block until every record queued so far has been written
+		'''
+		self._command('flush')
+
+	def clear(self):
+		'''
+		Erase the log file, after writing the records queued so far
+		'''
+		self._command('clear')
+
+	def close(self):
+		'''
+		Write the queued records and stop the writer thread
+		'''
+
+		if not self._closed:
+			self._closed = True
+			self._command('close')
+			self._thread.join()
+
+	def stats(self):
+		'''
+		Return a dictionary describing the logger's latency:
+			* records: the number of records written
+			* dropped: the number of records below the level
+			* rotations: the number of times the file was rotated
+			* pending: the number of records waiting to be written
+			* meanCallSeconds, maxCallSeconds: time spent by callers in log()
+			* meanQueueSeconds, maxQueueSeconds: time from log() to the record
+				being written
+		'''
+
+		with self._statsLock:
+			stats = dict(self._stats)
+		queued = stats['records'] + stats['dropped']
+		stats['meanCallSeconds'] = stats.pop('callSeconds') / queued if queued else 0.0
+		written = stats['records']
+		stats['meanQueueSeconds'] = stats.pop('queueSeconds') / written if written else 0.0
+		stats['pending'] = self._queue.qsize()
+		return stats
+
+	def _command(self, command):
+		if not self._thread.is_alive():
+			return
+		done = threading.Event()
+		self._queue.put((time.time(), None, None, None, (command, done)))
+		done.wait()
+
+	def _write(self):
+		self._open('a')
+		while True:
+			batch = [self._queue.get()]
+			try:
+				while len(batch) < self.BATCH_SIZE:
+					batch.append(self._queue.get_nowait())
+			except Queue.Empty:
+				pass
+
+			for timeStamp, level, message, args, command in batch:
+				if command is not None:
+					name, done = command
+					self._file.flush()
+					if name == 'clear':
+						self._file.close()
+						self._open('w')
+					done.set()
+					if name == 'close':
+						self._file.close()
+						return
+					continue
+
+				self._file.write(self._format(timeStamp, level, message, args))
+				queued = time.time() - timeStamp
+				with self._statsLock:
+					self._stats['records'] += 1
+					self._stats['queueSeconds'] += queued
+					if queued > self._stats['maxQueueSeconds']:
+						self._stats['maxQueueSeconds'] = queued
+
+			self._file.flush()
+			if self._maxBytes and self._file.tell() >= self._maxBytes:
+				self._rotate()
+
+	def _format(self, timeStamp, level, message, args):
+		if message is None:
+			return '\n'
+
+		try:
+			if callable(message):
+				message = message()
+			if args:
+				message = message % args
+			if isinstance(message, unicode):
+				message = message.encode('utf-8')
+			else:
+				message = str(message)
+		except Exception as e:
+			# a bad record must not stop the writer
+			message = 'Unable to format log message %r %r: %s' % (message, args, e)
+
+		line = time.ctime(timeStamp) + ' '
+		if level != INFO:
+			line += LEVEL_NAMES.get(level, str(level)) + ': '
+		return line + message + '\n'
+
+	def _open(self, mode):
+		self._file = open(self._filename, mode)
+		self._file.seek(0, os.SEEK_END)
+
+	def _rotate(self):
+		self._file.close()
+		if self._backupCount:
+			for i in range(self._backupCount - 1, 0, -1):
+				source = self._filename + '.' + str(i)
+				if os.path.exists(source):
+					_replace(source, self._filename + '.' + str(i + 1))
+			_replace(self._filename, self._filename + '.1')
+			self._open('a')
+		else:
+			self._open('w')
+		with self._statsLock:
+			self._stats['rotations'] += 1
+
+def _replace(source, destination):
+	# rename does not overwrite on Windows
+	if os.path.exists(destination):
+		os.remove(destination)
+	os.rename(source, destination)
@@ -0,0 +1,324 @@
+import os
+import time
+import bisect
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from shared import *
+
+class Histogram:
+	'''
+	Counts of durations in fixed buckets, from which percentiles are
+	estimated. Adding a duration costs a binary search over the bucket
+	bounds, and the memory used does not grow with the number of durations.
+
+	Members:
+		Private:
+			* _bounds: the upper bound of each bucket but the last, in seconds,
+				ascending. The last bucket has no upper bound
+			* _counts: the number of durations in each bucket
+			* _count, _sum, _max: of all the durations
+	'''
+
+	# from a millisecond to a minute, about three buckets per factor of ten
+	DEFAULT_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+					  1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+	def __init__(self, bounds = DEFAULT_BOUNDS):
+		self._bounds = bounds
+		self._counts = [0] * (len(bounds) + 1)
+		self._count = 0
+		self._sum = 0.0
+		self._max = 0.0
+
+	def add(self, seconds):
+		self._counts[bisect.bisect_left(self._bounds, seconds)] += 1
+		self._count += 1
+		self._sum += seconds
+		if seconds > self._max:
+			self._max = seconds
+
+	def merge(self, other):
+		'''
+		Add the durations counted by another Histogram with the same bounds
+		'''
+
+		for i, count in enumerate(other._counts):
+			self._counts[i] += count
+		self._count += other._count
+		self._sum += other._sum
+		self._max = max(self._max, other._max)
+
+	def count(self):
+		return self._count
+
+	def sum(self):
+		return self._sum
+
+	def buckets(self):
+		'''
+		Return a list of (upper bound, cumulative count) pairs. The bound of
+		the last is None
+		'''
+
+		ret = []
+		total = 0
+		for i, count in enumerate(self._counts):
+			total += count
+			ret.append((self._bounds[i] if i < len(self._bounds) else None, total))
+		return ret
+
+	def percentile(self, fraction):
+		'''
+		Return an estimate of the given percentile, as a fraction between 0
+		and 1, interpolating within its bucket. None if there are no durations.
+		'''
+
+		if not self._count:
+			return None
+
+		rank = fraction * self._count
+		total = 0
+		for i, count in enumerate(self._counts):
+			if count and total + count >= rank:
+				lower = self._bounds[i - 1] if i > 0 else 0.0
+				upper = self._bounds[i] if i < len(self._bounds) else self._max
+				estimate = lower + (upper - lower) * (rank - total) / count
+				return min(estimate, self._max)
+			total += count
+		return self._max
+
+	def summary(self):
+		'''
+		Return a dictionary with the count, mean, p50, p95, p99 and max, in
+		seconds
+		'''
+
+		return {
+			'count': self._count,
+			'mean': self._sum / self._count if self._count else None,
+			'p50': self.percentile(0.5),
+			'p95': self.percentile(0.95),
+			'p99': self.percentile(0.99),
+			'max': self._max if self._count else None,
+		}
+
+class Metrics:
+	'''
+	Timings of the steps between a song being chosen and it being heard,
+	such as fetching its stream URL, downloading it and decoding it. Each
+	step is a named span. The durations of each span are kept in a Histogram
+	per buffer, and the last duration of each span for the most recent songs.
+
+	A span is attributed to the song and buffer given to it, or else to those
+	set for the calling thread with attribute(), so code that does not know
+	which buffer it is working for, such as a download, still gets both.
+
+	The metrics are available as a dictionary from snapshot(), and can be
+	written periodically to a file in the Prometheus text format by a
+	background thread, started with startExport().
+
+	Use getMetrics() to get the process-wide instance.
+
+	Members:
+		Private:
+			* _histograms: a dictionary of (span, buffer name):Histogram
+				pairs. The buffer name is None for spans outside a buffer
+			* _songs: an OrderedDict of songID:{span: seconds} pairs for the
+				most recent songs, least recent first
+			* _context: thread local, the (song ID, buffer name) set by
+				attribute() for the thread
+			* _lock: protects _histograms and _songs
+			* _exportThread: the thread writing the export file, None if not
+				exporting
+			* _stopExport: set to stop the export thread
+	'''
+
+	# the number of songs whose spans are kept for snapshot()
+	SONG_HISTORY = 100
+
+	DEFAULT_EXPORT_FILE = 'metrics.txt'
+	DEFAULT_EXPORT_INTERVAL = 10.0
+
+	# the prefix of the names in the export file
+	EXPORT_PREFIX = 'smartshuffle_'
+
+	def __init__(self):
+		self._histograms = {}
+		self._songs = OrderedDict()
+		self._context = threading.local()
+		self._lock = threading.Lock()
+		self._exportThread = None
+		self._stopExport = threading.Event()
+
+	def observe(self, span, seconds, song = None, buffer = None):
+		'''
+		Record a duration for a span. Song and buffer default to those set
+		for the thread with attribute().
+
+		:param span: the name of the span, eg 'download'
+		:param seconds: the duration
+		:param song: the ID of the song the span was for
+		:param buffer: the name of the buffer the span was for
+		'''
+
+		contextSong, contextBuffer = getattr(self._context, 'value', (None, None))
+		if song is None:
+			song = contextSong
+		if buffer is None:
+			buffer = contextBuffer
+
+		with self._lock:
+			histogram = self._histograms.get((span, buffer))
+			if histogram is None:
+				histogram = self._histograms[(span, buffer)] = Histogram()
+			histogram.add(seconds)
+
+			if song is not None:
+				spans = self._songs.pop(song, None)
+				if spans is None:
+					spans = {}
+					if len(self._songs) >= self.SONG_HISTORY:
+						self._songs.popitem(last = False)
+				spans[span] = seconds
+				self._songs[song] = spans
+
+	@contextmanager
+	def span(self, name, song = None, buffer = None):
+		'''
+		Time the body of a with statement as a span. The span is recorded
+		even if the body raises.
+		'''
+
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.observe(name, time.time() - start, song, buffer)
+
+	@contextmanager
+	def attribute(self, song = None, buffer = None):
+		'''
+		Attribute the spans recorded by the calling thread in the body of a
+		with statement to the given song ID and buffer name
+		'''
+
+		previous = getattr(self._context, 'value', (None, None))
+		self._context.value = (song, buffer)
+		try:
+			yield
+		finally:
+			self._context.value = previous
+
+	def snapshot(self):
+		'''
+		Return a dictionary of the metrics so far:
+			* spans: a dictionary of span:summary pairs, with the count, mean,
+				p50, p95, p99 and max of every duration of the span in seconds,
+				and under 'buffers' the same for each buffer
+			* songs: a dictionary of songID:{span: seconds} pairs with the last
+				duration of each span for the most recent songs
+		'''
+
+		with self._lock:
+			totals = {}
+			buffers = {}
+			for (span, buffer), histogram in self._histograms.iteritems():
+				if span not in totals:
+					totals[span] = Histogram()
+					buffers[span] = {}
+				totals[span].merge(histogram)
+				if buffer is not None:
+					buffers[span][buffer] = histogram.summary()
+			songs = dict((song, dict(spans)) for song, spans in self._songs.iteritems())
+
+		spans = {}
+		for span, histogram in totals.iteritems():
+			spans[span] = histogram.summary()
+			spans[span]['buffers'] = buffers[span]
+		return {'spans': spans, 'songs': songs}
+
+	def exposition(self):
+		'''
+		Return the histograms in the Prometheus text format, with an estimate
+		of the median and the 95th and 99th percentiles of each span
+		'''
+
+		name = self.EXPORT_PREFIX + 'span_seconds'
+		lines = ['# TYPE ' + name + ' histogram']
+		quantiles = []
+		with self._lock:
+			totals = {}
+			for (span, buffer), histogram in sorted(self._histograms.iteritems()):
+				labels = 'span="%s"' % span
+				if buffer is not None:
+					labels += ',buffer="%s"' % buffer
+				for bound, count in histogram.buckets():
+					le = '+Inf' if bound is None else repr(bound)
+					lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, count))
+				lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum()))
+				lines.append('%s_count{%s} %d' % (name, labels, histogram.count()))
+				totals.setdefault(span, Histogram()).merge(histogram)
+
+		quantileName = self.EXPORT_PREFIX + 'span_seconds_quantile'
+		lines.append('# TYPE ' + quantileName + ' gauge')
+		for span, histogram in sorted(totals.iteritems()):
+			for fraction in (0.5, 0.95, 0.99):
+				lines.append('%s{span="%s",quantile="%s"} %r' %
+							 (quantileName, span, fraction, histogram.percentile(fraction)))
+		return '\n'.join(lines) + '\n'
+
+	def writeExposition(self, filename):
+		'''
+		Write exposition() to a file. Written to a temporary file first, so
+		a reader never sees a half-written file.
+		'''
+
+		tempName = filename + '.tmp'
+		try:
+			f = open(tempName, 'w')
+			f.write(self.exposition())
+			f.close()
+			if os.path.exists(filename):
+				# rename does not overwrite on Windows
+				os.remove(filename)
+			os.rename(tempName, filename)
+		except (IOError, OSError) as e:
+			log('Unable to write metrics: ' + str(e))
+
+	def startExport(self, filename = DEFAULT_EXPORT_FILE, interval = DEFAULT_EXPORT_INTERVAL):
+		'''
+		Write the exposition to the given file every interval seconds on a
+		background thread, until stopExport is called
+		'''
+
+		self.stopExport()
+		self._stopExport.clear()
+		self._exportThread = threading.Thread(target = self._export, args = (filename, interval),
+											  name = 'MetricsExport')
+		self._exportThread.daemon = True
+		self._exportThread.start()
+
+	def stopExport(self):
+		'''
+		Stop the export thread, after it writes the file one last time
+		'''
+
+		if self._exportThread is not None:
+			self._stopExport.set()
+			self._exportThread.join()
+			self._exportThread = None
+
+	def _export(self, filename, interval):
+		while not self._stopExport.wait(interval):
+			self.writeExposition(filename)
+		self.writeExposition(filename)
+
+
+_metrics = Metrics()
+
+def getMetrics():
+	'''
+	Return the process-wide Metrics
+	'''
+	return _metrics
@@ -2,20 +2,16 @@ from shared import *
 from Account import Account
 from SongPlayer import SongPlayer
 import pyglet
+import getpass
 
 if __name__ == '__main__':
 	clearLog()
 
-<<<<<<< HEAD
 	user = raw_input('Username:')
-	pword = raw_input('Password:')
+	pword = getpass.getpass('Password:')
 
 	log('Logging in', console = True)
 	account = Account(user, pword)
-=======
-	log('Logging in', console = True)
-	account = Account('jbearer95', 'j09211995')
->>>>>>> master
 	assert(account.isAuthenticated())
 	log('Login successful', console = True)
 	log()
@@ -0,0 +1,218 @@
+import random
+
+class _Node(object):
+	__slots__ = ('key', 'priority', 'left', 'right', 'parent', 'size')
+
+	def __init__(self, key, priority):
+		self.key = key
+		self.priority = priority
+		self.left = None
+		self.right = None
+		self.parent = None
+		self.size = 1
+
+class PlayQueue:
+	'''
+	An ordered sequence of distinct keys, such as song IDs, supporting
+	lookup by key in O(1) and access, insertion, removal and moves by
+	position in O(log n).
+
+	The sequence is kept in an implicit treap: a binary tree whose in-order
+	traversal is the sequence, balanced by random priorities, where each
+	node knows the size of its subtree. The position of a node is found by
+	walking up to the root through parent links, so a dictionary from keys to
+	nodes gives the position of any key in O(log n).
+
+	Members:
+		Private:
+			* _root: the root of the treap, None when empty
+			* _nodes: a dictionary of key:node pairs
+			* _random: source of the nodes' priorities
+	'''
+
+	def __init__(self, keys = (), seed = None):
+		'''
+		:param keys: the initial sequence
+		:param seed: seed for the tree's balancing, which never affects the order
+		'''
+
+		self._root = None
+		self._nodes = {}
+		self._random = random.Random(seed)
+		for key in keys:
+			self.append(key)
+
+	def __len__(self):
+		return len(self._nodes)
+
+	def __contains__(self, key):
+		return key in self._nodes
+
+	def __iter__(self):
+		stack = []
+		node = self._root
+		while stack or node is not None:
+			while node is not None:
+				stack.append(node)
+				node = node.left
+			node = stack.pop()
+			yield node.key
+			node = node.right
+
+	def __getitem__(self, index):
+		return self.get(index)
+
+	def get(self, index):
+		'''
+		Return the key at the given position. Negative positions count from
+		the end. Raises IndexError if there is no such position.
+		'''
+
+		index = self._normalize(index)
+		node = self._root
+		while True:
+			leftSize = _size(node.left)
+			if index < leftSize:
+				node = node.left
+			elif index == leftSize:
+				return node.key
+			else:
+				index -= leftSize + 1
+				node = node.right
+
+	def index(self, key):
+		'''
+		Return the position of the given key. Raises KeyError if it is not
+		in the queue.
+		'''
+
+		node = self._nodes[key]
+		index = _size(node.left)
+		while node.parent is not None:
+			if node is node.parent.right:
+				index += _size(node.parent.left) + 1
+			node = node.parent
+		return index
+
+	def slice(self, start, stop):
+		'''
+		Return a list of the keys from position start up to but not including
+		stop, clamped to the queue
+		'''
+
+		start = max(0, start)
+		stop = min(len(self), stop)
+		return [self.get(i) for i in range(start, stop)]
+
+	def insert(self, index, key):
+		'''
+		Insert a key before the given position. Positions past the end append.
+		Raises ValueError if the key is already in the queue.
+		'''
+
+		if key in self._nodes:
+			raise ValueError('%r is already in the queue' % (key,))
+		index = max(0, min(len(self), index))
+
+		node = _Node(key, self._random.random())
+		self._nodes[key] = node
+		left, right = _split(self._root, index)
+		self._setRoot(_merge(_merge(left, node), right))
+
+	def append(self, key):
+		self.insert(len(self), key)
+
+	def remove(self, key):
+		'''
+		Remove a key and return the position it had. Raises KeyError if it is
+		not in the queue.
+		'''
+
+		index = self.index(key)
+		left, right = _split(self._root, index)
+		node, right = _split(right, 1)
+		del self._nodes[key]
+		self._setRoot(_merge(left, right))
+		return index
+
+	def pop(self, index = -1):
+		'''
+		Remove and return the key at the given position
+		'''
+
+		key = self.get(index)
+		self.remove(key)
+		return key
+
+	def move(self, key, index):
+		'''
+		Move a key so that it is at the given position afterwards
+		'''
+
+		self.remove(key)
+		self.insert(index, key)
+
+	def _normalize(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError('queue index out of range')
+		return index
+
+	def _setRoot(self, root):
+		self._root = root
+		if root is not None:
+			root.parent = None
+
+def _size(node):
+	if node is None:
+		return 0
+	return node.size
+
+def _update(node):
+	node.size = 1 + _size(node.left) + _size(node.right)
+	if node.left is not None:
+		node.left.parent = node
+	if node.right is not None:
+		node.right.parent = node
+
+def _split(node, count):
+	'''
+	Split a tree into a tree of its first count nodes and a tree of the rest.
+	The parents of the returned roots are not updated.
+	'''
+
+	if node is None:
+		return None, None
+	if _size(node.left) < count:
+		left, right = _split(node.right, count - _size(node.left) - 1)
+		node.right = left
+		_update(node)
+		if right is not None:
+			right.parent = None
+		return node, right
+	else:
+		left, right = _split(node.left, count)
+		node.left = right
+		_update(node)
+		if left is not None:
+			left.parent = None
+		return left, node
+
+def _merge(left, right):
+	'''
+	Join two trees, all of whose nodes in left come before those in right
+	'''
+
+	if left is None:
+		return right
+	if right is None:
+		return left
+	if left.priority > right.priority:
+		left.right = _merge(left.right, right)
+		_update(left)
+		return left
+	else:
+		right.left = _merge(left, right.left)
+		_update(right)
+		return right
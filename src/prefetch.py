@@ -0,0 +1,241 @@
+import heapq
+import threading
+from shared import *
+from songbuffer import SongBuffer
+from bufferstore import getBufferStore
+
+class PrefetchManager:
+	'''
+	Keeps a SongBuffer for each song in a window around the current song,
+	filling them with a bounded pool of worker threads. The window holds the
+	current song, up to lookahead songs after it and up to lookbehind songs
+	before it. Buffers are filled in priority order: the current song first,
+	then alternately the songs after and before it, nearest first.
+
+	The buffers come from a BufferStore shared by every session in the
+	process, so a song in the windows of several sessions is downloaded and
+	decoded once. When a song leaves the window it is released, and its
+	download aborted and its buffer deleted if no other session wants it.
+	Songs other than the current song are only buffered if the store admits
+	them within the manager's memory budget.
+
+	If the current song is waiting and every worker is busy, the lowest
+	priority download which no other session wants is aborted to make room
+	for it, and requeued.
+
+	Members:
+		Private:
+			* _store: the BufferStore holding the buffers
+			* _lookahead: the number of songs after the current song to buffer
+			* _lookbehind: the number of songs before the current song to buffer
+			* _progressive, _prebufferSeconds: passed on to each SongBuffer
+			* _buffers: a dictionary of songID:SongBuffer pairs for the window,
+				acquired from _store
+			* _priorities: a dictionary of songID:priority pairs for the window,
+				lower numbers are fetched first
+			* _pending: a heap of (priority, songID) pairs waiting for a worker
+			* _inFlight: a dictionary of songID:SongBuffer pairs being updated
+			* _retired: buffers which left the window while being updated, to
+				be released by the worker when it finishes, once for each time
+				they left. A buffer may come back into the window before then
+			* _workers: the worker threads
+			* _closed: set when the manager is shutting down
+			* _lock: a condition protecting all of the above, notified when
+				there is work for the workers
+	'''
+
+	DEFAULT_LOOKAHEAD = 1
+	DEFAULT_LOOKBEHIND = 1
+	DEFAULT_WORKERS = 2
+	DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+	def __init__(self, store = None, lookahead = DEFAULT_LOOKAHEAD,
+				 lookbehind = DEFAULT_LOOKBEHIND, workers = DEFAULT_WORKERS,
+				 progressive = False, prebufferSeconds = SongBuffer.DEFAULT_PREBUFFER_SECONDS,
+				 memoryBudget = DEFAULT_MEMORY_BUDGET):
+		'''
+		:param store: the BufferStore to take buffers from, by default the
+			process-wide one
+		:param lookahead: the number of songs after the current song to buffer
+		:param lookbehind: the number of songs before the current song to buffer
+		:param workers: the maximum number of songs to download at once
+		:param progressive: see SongBuffer
+		:param prebufferSeconds: see SongBuffer
+		:param memoryBudget: the maximum total decoded size of the songs in
+			the window, in bytes. The current song is buffered regardless
+		'''
+
+		self._store = store if store is not None else getBufferStore()
+		self._store.register(self, memoryBudget)
+		self._lookahead = lookahead
+		self._lookbehind = lookbehind
+		self._progressive = progressive
+		self._prebufferSeconds = prebufferSeconds
+
+		self._buffers = {}
+		self._priorities = {}
+		self._pending = []
+		self._inFlight = {}
+		self._retired = []
+		self._closed = False
+		self._lock = threading.Condition()
+
+		self._workers = []
+		for i in range(max(1, workers)):
+			worker = threading.Thread(target = self._work, name = 'PrefetchWorker-' + str(i))
+			worker.daemon = True
+			worker.start()
+			self._workers.append(worker)
+
+	def lookahead(self):
+		return self._lookahead
+
+	def lookbehind(self):
+		return self._lookbehind
+
+	def setWindow(self, current, after, before):
+		'''
+		Move the window. Buffers for songs which stay in the window are kept.
+
+		:param current: the current Song
+		:param after: the Songs after the current song, nearest first. Only
+			the first lookahead are buffered
+		:param before: the Songs before the current song, nearest first. Only
+			the first lookbehind are buffered
+		'''
+
+		wanted = {current.id(): (current, 0, 'CURRENT')}
+		for i, song in enumerate(after[:self._lookahead]):
+			wanted.setdefault(song.id(), (song, 2 * i + 1, 'NEXT+' + str(i)))
+		for i, song in enumerate(before[:self._lookbehind]):
+			wanted.setdefault(song.id(), (song, 2 * i + 2, 'PREVIOUS-' + str(i)))
+
+		with self._lock:
+			# songs leaving the window
+			for songID in self._buffers.keys():
+				if songID not in wanted:
+					self._retire(songID)
+
+			self._priorities = {}
+			for songID, (song, priority, name) in wanted.iteritems():
+				self._priorities[songID] = priority
+				if songID not in self._buffers:
+					self._buffers[songID] = self._store.acquire(self, song, self._progressive,
+																self._prebufferSeconds)
+				self._buffers[songID].name = name
+
+			self._pending = [(priority, songID) for songID, priority in self._priorities.iteritems()
+							 if songID not in self._inFlight]
+			heapq.heapify(self._pending)
+
+			self._preemptFor(current.id())
+			self._lock.notifyAll()
+
+	def isBusy(self):
+		'''
+		Return True if any buffer in the window is waiting for or being
+		downloaded
+		'''
+
+		with self._lock:
+			return bool(self._pending or self._inFlight)
+
+	def getBuffer(self, song):
+		'''
+		Return the buffer for the given song, or None if it is not in the window
+		'''
+
+		with self._lock:
+			return self._buffers.get(song.id())
+
+	def close(self):
+		'''
+		Abort all downloads, stop the workers and release the buffers
+		'''
+
+		with self._lock:
+			self._closed = True
+			for songID in self._buffers.keys():
+				self._retire(songID)
+			self._pending = []
+			self._lock.notifyAll()
+
+		for worker in self._workers:
+			worker.join()
+
+		self._retired = []
+		self._store.unregister(self)
+
+	def _retire(self, songID):
+		'''
+		Remove a song from the window. Caller must hold _lock
+		'''
+
+		buffer = self._buffers.pop(songID)
+		self._priorities.pop(songID, None)
+		if songID in self._inFlight:
+			# the worker releases it when the update returns. Another
+			# session may still want the download
+			if not self._store.isShared(songID, self._progressive):
+				buffer.abort()
+			self._retired.append(buffer)
+		else:
+			self._store.release(self, songID, self._progressive)
+
+	def _preemptFor(self, songID):
+		'''
+		If the given song needs a worker and all of them are busy with lower
+		priority songs, abort the lowest priority one. Its worker requeues it.
+		Caller must hold _lock.
+		'''
+
+		if songID in self._inFlight or not self._buffers[songID].needsUpdate():
+			return
+		if len(self._inFlight) < len(self._workers):
+			return
+
+		# aborting a download another session wants would cost it the song
+		victims = [inFlightID for inFlightID in self._inFlight
+				   if not self._store.isShared(inFlightID, self._progressive)]
+		if not victims:
+			return
+		victim = max(victims, key = lambda inFlightID: self._priorities.get(inFlightID, -1))
+		if self._priorities.get(victim, -1) > self._priorities[songID]:
+			log('Preempting buffer ' + str(self._inFlight[victim].name))
+			self._inFlight[victim].abort()
+
+	def _work(self):
+		while True:
+			with self._lock:
+				while not self._closed and not self._pending:
+					self._lock.wait()
+				if self._closed:
+					return
+
+				priority, songID = heapq.heappop(self._pending)
+				buffer = self._buffers.get(songID)
+				if buffer is None or not buffer.needsUpdate():
+					continue
+				if not self._store.admit(self, songID, self._progressive, force = priority == 0):
+					# considered again when the window moves
+					continue
+				self._inFlight[songID] = buffer
+
+			try:
+				buffer.update()
+			except Exception as e:
+				# the buffer is marked failed, so nobody waits for it. The
+				# worker carries on with the other songs
+				log('Update of buffer %s failed: %s' % (buffer.name, e), console = True)
+			finally:
+				with self._lock:
+					del self._inFlight[songID]
+					while buffer in self._retired:
+						# if the song came back into the window it was
+						# acquired again, so the buffer survives this
+						self._retired.remove(buffer)
+						self._store.release(self, songID, self._progressive)
+					if self._buffers.get(songID) is buffer and buffer.needsUpdate() and not buffer.hasFailed():
+						# preempted, try again when a worker is free
+						heapq.heappush(self._pending, (self._priorities[songID], songID))
+						self._lock.notifyAll()
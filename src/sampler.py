@@ -0,0 +1,253 @@
+import random
+
+try:
+	import numpy
+except ImportError:
+	# the weights and tree are lists, rebuilt with a plain python loop
+	numpy = None
+
+class WeightedSampler:
+	'''
+	Draws items at random with probability proportional to their weights,
+	without replacement. The items are the integers 0 to n - 1.
+
+	The weights of the items still in the sample are kept in a Fenwick tree,
+	where each node holds the sum of a range of weights whose length is the
+	lowest set bit of its position. A draw walks down the tree from the
+	largest power of two, and changing one weight walks up it, so both cost
+	O(log n). Replacing every weight at once rebuilds the tree in O(n).
+
+	A drawn item is out of the sample, with weight 0 in the tree, until it is
+	put back or the sample is reset. Its weight is remembered, and may still
+	be changed while it is out.
+
+	Adding and subtracting floats in the tree accumulates rounding error, so
+	the tree is rebuilt from the weights after every n updates.
+
+	Members:
+		Private:
+			* _weights: the weight of each item, an array of floats if NumPy
+				is installed, else a list
+			* _out: a bytearray, 1 for the items drawn
+			* _numOut: the number of items drawn
+			* _tree: the Fenwick tree, n + 1 sums in the same kind of sequence
+				as _weights. _tree[0] is unused
+			* _total: the sum of the weights of the items in the sample
+			* _top: the largest power of two no greater than n
+			* _updates: the number of updates since the tree was built
+			* _random: the random number generator
+	'''
+
+	def __init__(self, weights = (), seed = None):
+		'''
+		:param weights: the initial weight of each item, none negative
+		:param seed: if given, the same seed and calls give the same draws
+		'''
+
+		self._random = random.Random(seed)
+		self._out = bytearray()
+		self.reweight(weights)
+
+	def __len__(self):
+		return len(self._weights)
+
+	def remaining(self):
+		'''
+		The number of items which have not been drawn
+		'''
+		return len(self._weights) - self._numOut
+
+	def total(self):
+		'''
+		The sum of the weights of the items which have not been drawn
+		'''
+		return self._total
+
+	def weight(self, item):
+		return self._weights[item]
+
+	def isDrawn(self, item):
+		return bool(self._out[item])
+
+	def setWeight(self, item, weight):
+		'''
+		Change the weight of one item
+		'''
+
+		weight = float(weight)
+		if weight < 0:
+			raise ValueError('negative weight for item ' + str(item) + ': ' + str(weight))
+		old = self._weights[item]
+		self._weights[item] = weight
+		if not self._out[item]:
+			self._add(item, weight - old)
+
+	def reweight(self, weights):
+		'''
+		Replace the weight of every item, keeping which items have been drawn.
+		If the number of items changes, every item is put back.
+		'''
+
+		if numpy is not None:
+			weights = numpy.array(weights, dtype = numpy.float64)
+			if len(weights) and weights.min() < 0:
+				raise ValueError('negative weight')
+		else:
+			weights = [float(weight) for weight in weights]
+			if any(weight < 0 for weight in weights):
+				raise ValueError('negative weight')
+
+		self._weights = weights
+		if len(self._out) != len(weights):
+			self._out = bytearray(len(weights))
+		if numpy is not None:
+			self._numOut = int(numpy.count_nonzero(numpy.frombuffer(self._out, dtype = numpy.uint8)))
+		else:
+			self._numOut = sum(self._out)
+
+		self._top = 1
+		while self._top * 2 <= len(weights):
+			self._top *= 2
+		self._build()
+
+	def draw(self):
+		'''
+		Remove a random item from the sample and return it, or return None if
+		every item has been drawn. Items with weight 0 are only drawn once
+		every other item has been.
+		'''
+
+		if self._numOut == len(self._weights):
+			return None
+
+		item = None
+		if self._total > 0:
+			item = self._find(self._random.random() * self._total)
+			if item is None:
+				# the sums have drifted from the weights
+				self._build()
+				if self._total > 0:
+					item = self._find(self._random.random() * self._total)
+
+		if item is None:
+			# every item left has weight 0
+			remaining = [i for i in xrange(len(self._weights)) if not self._out[i]]
+			item = remaining[int(self._random.random() * len(remaining))]
+
+		self._take(item)
+		return item
+
+	def sample(self, count):
+		'''
+		Draw up to count items, fewer only if the sample runs out. Returns a
+		list of the items in the order drawn.
+		'''
+
+		ret = []
+		for i in xrange(min(count, self.remaining())):
+			ret.append(self.draw())
+		return ret
+
+	def take(self, item):
+		'''
+		Remove an item from the sample as if it had been drawn. Returns False
+		if it was drawn already.
+		'''
+
+		if self._out[item]:
+			return False
+		self._take(item)
+		return True
+
+	def putBack(self, item):
+		'''
+		Return a drawn item to the sample. Returns False if it was not drawn.
+		'''
+
+		if not self._out[item]:
+			return False
+		self._out[item] = 0
+		self._numOut -= 1
+		self._add(item, self._weights[item])
+		return True
+
+	def reset(self):
+		'''
+		Put every item back
+		'''
+
+		self._out = bytearray(len(self._weights))
+		self._numOut = 0
+		self._build()
+
+	def _take(self, item):
+		self._out[item] = 1
+		self._numOut += 1
+		self._add(item, -self._weights[item])
+
+	def _find(self, target):
+		'''
+		Return the item in the sample whose range of the cumulative weights
+		contains target, or None if the sums are inconsistent with the weights
+		'''
+
+		tree = self._tree
+		n = len(self._weights)
+		position = 0
+		step = self._top
+		while step:
+			next = position + step
+			if next <= n and tree[next] <= target:
+				position = next
+				target -= tree[next]
+			step >>= 1
+
+		# position is the number of items before the one found
+		if position < n and not self._out[position] and self._weights[position] > 0:
+			return position
+		return None
+
+	def _add(self, item, delta):
+		if not delta:
+			return
+		self._total += delta
+		tree = self._tree
+		n = len(self._weights)
+		position = item + 1
+		while position <= n:
+			tree[position] += delta
+			position += position & -position
+
+		self._updates += 1
+		if self._updates > n:
+			self._build()
+
+	def _build(self):
+		'''
+		Rebuild the tree from the weights of the items in the sample
+		'''
+
+		n = len(self._weights)
+		self._updates = 0
+
+		if numpy is not None:
+			# node i holds cumulative[i] - cumulative[i - lowest bit of i]
+			weights = self._weights.copy()
+			if n:
+				weights[numpy.frombuffer(self._out, dtype = numpy.uint8) != 0] = 0
+			cumulative = numpy.concatenate(([0.0], numpy.cumsum(weights)))
+			positions = numpy.arange(n + 1)
+			self._tree = cumulative - cumulative[positions - (positions & -positions)]
+			self._total = float(cumulative[-1])
+			return
+
+		tree = [0.0] * (n + 1)
+		for item in xrange(n):
+			if not self._out[item]:
+				tree[item + 1] += self._weights[item]
+		for position in xrange(1, n + 1):
+			parent = position + (position & -position)
+			if parent <= n:
+				tree[parent] += tree[position]
+		self._tree = tree
+		self._total = sum(weight for item, weight in enumerate(self._weights) if not self._out[item])
@@ -0,0 +1,609 @@
+import re
+import bisect
+import heapq
+import itertools
+import threading
+import unicodedata
+from shared import *
+from library import _key
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+def normalize(text):
+	'''
+	Return text lower cased and without accents, for matching. Accepts utf-8
+	encoded strings and unicode, returns unicode.
+	'''
+
+	if not text:
+		return u''
+	if not isinstance(text, unicode):
+		text = text.decode('utf-8', 'replace')
+	text = unicodedata.normalize('NFKD', text.lower())
+	return u''.join(c for c in text if not unicodedata.combining(c))
+
+def tokenize(text):
+	'''
+	Return the words of text, normalized
+	'''
+	return _TOKEN.findall(normalize(text))
+
+class LibraryIndex:
+	'''
+	An in-memory search index over the tracks of a library, keyed by track ID.
+
+	Every word of a track's title, artist, album and genre is a token with a
+	posting: a dictionary of trackID:score pairs, where the score is the
+	weight of the most important field containing the word. The tokens are
+	also kept sorted, so the tokens starting with a prefix are found with a
+	binary search. There are secondary indexes from each field's whole
+	normalized value to its tracks, for lookups such as all the songs by an
+	artist.
+
+	A query matches tracks containing all of its words. The last word is
+	taken as a prefix unless the query ends in a space, so results can be
+	shown while the user types; a last word too short to be a prefix is
+	ignored until it is complete. Tracks are ranked by the sum of their
+	scores for each word, doubled for whole word matches, plus a small boost
+	for popular and thumbs up tracks.
+
+	A query of one word merges the postings of the matching tokens in rank
+	order, and stops once it has enough results. A word's score takes one of
+	a few values, so a query of several words groups each word's tracks by
+	score and intersects the groups, as sets, in order of their total score
+	until no remaining group can reach the results. If one word matches only
+	a few tracks and the others many, its tracks are checked against the
+	other words one by one instead, and so are the tracks with every whole
+	word of a query ending in a prefix, if they are few and the prefix
+	matches many rare tokens. The ranked postings are cached, and for
+	common words built with the index, so a word found in every track costs
+	no more than a rare one.
+
+	The index is built once from a LibraryStore and then kept up to date
+	with put and remove as tracks change. Building the index of a large
+	library takes seconds, so it can be built on a thread; until it is done
+	every other method waits for it.
+
+	Members:
+		Private:
+			* _lock: a Condition notified when a build on a thread is done
+			* _building: True while the index is being built on a thread
+			* _postings: a dictionary of token:posting pairs
+			* _tokens: the tokens, sorted
+			* _ranked: a dictionary of (token, multiplier):list pairs, caching
+				each posting as (-(score * multiplier + boost), trackID) pairs,
+				sorted. Entries are dropped when their posting changes
+			* _levelCache: a dictionary of (token, multiplier):{score:set of
+				trackIDs} pairs, caching common postings grouped by score.
+				Entries are dropped when their posting changes
+			* _fields: a dictionary of field name:{normalized value:set of
+				trackIDs} pairs, the secondary indexes
+			* _values: a dictionary of trackID:{field name:(normalized value,
+				tokens)} pairs, to find a track's entries when it changes and to
+				check a track against a query
+			* _boosts: a dictionary of trackID:boost pairs
+			* _byBoost: every trackID, largest boost first, or None until
+				needed after a change
+	'''
+
+	# fields searched, and the score of a word found in each
+	FIELDS = (('title', 3.0), ('artist', 2.0), ('album', 1.5), ('genre', 1.0))
+
+	# multipliers of the score for a whole word and a prefix match
+	WORD_MATCH = 2
+	PREFIX_MATCH = 1
+
+	# prefixes shorter than this only match whole words, since they would
+	# match most of the library
+	MIN_PREFIX_LENGTH = 2
+
+	# a query of several words is answered by checking the tracks of its
+	# rarest word against the others when it matches at most SCAN_SIZE
+	# tracks, and the others SCAN_RATIO times as many
+	SCAN_SIZE = 500
+	SCAN_RATIO = 8
+
+	# a query ending in a prefix is answered by checking the tracks with all
+	# its whole words against the prefix when that is cheaper than grouping
+	# the tracks of the prefix's rare tokens by score. Checking a track costs
+	# about SCAN_COST times as much as grouping one
+	SCAN_COST = 12
+
+	# postings of at least this many tracks are ranked when the index is built
+	COMMON_TOKEN_SIZE = 1000
+
+	DEFAULT_LIMIT = 20
+
+	def __init__(self, store = None):
+		'''
+		:param store: a LibraryStore whose live tracks are indexed
+		'''
+
+		self._lock = threading.Condition()
+		self._building = False
+		self._clear()
+		if store is not None:
+			self._build(store)
+
+	def __len__(self):
+		self.waitUntilBuilt()
+		return len(self._values)
+
+	def rebuild(self, store, background = False):
+		'''
+		Replace the contents of the index with the live tracks of a
+		LibraryStore. If background is True the index is built on a thread,
+		and the store must not change until it is done.
+		'''
+
+		with self._lock:
+			while self._building:
+				self._lock.wait()
+			self._building = True
+
+		if background:
+			thread = threading.Thread(target = self._rebuild, args = (store,), name = 'LibraryIndexBuild')
+			thread.daemon = True
+			thread.start()
+		else:
+			self._rebuild(store)
+
+	def waitUntilBuilt(self):
+		'''
+		Block until a build started by rebuild is done
+		'''
+
+		with self._lock:
+			while self._building:
+				self._lock.wait()
+
+	def clear(self):
+		self.waitUntilBuilt()
+		self._clear()
+
+	def _clear(self):
+		self._postings = {}
+		self._tokens = []
+		self._ranked = {}
+		self._levelCache = {}
+		self._fields = dict((name, {}) for name, weight in self.FIELDS)
+		self._values = {}
+		self._boosts = {}
+		self._byBoost = None
+
+	def put(self, track):
+		'''
+		Index a track dictionary, as returned by the API, replacing any track
+		with the same ID
+		'''
+
+		self.waitUntilBuilt()
+		trackID = _key(track.get('id') or track.get('nid'))
+		self.remove(trackID)
+		values = {}
+		for name, weight in self.FIELDS:
+			value = normalize(track.get(name))
+			values[name] = (value, _TOKEN.findall(value))
+		self._add(trackID, values, _boost(_number(track.get('playCount')), _number(track.get('rating'))))
+
+	def remove(self, trackID):
+		'''
+		Remove a track from the index. Returns False if it is not indexed.
+		'''
+
+		self.waitUntilBuilt()
+		trackID = _key(trackID)
+		values = self._values.pop(trackID, None)
+		if values is None:
+			return False
+		del self._boosts[trackID]
+		self._byBoost = None
+
+		for name, weight in self.FIELDS:
+			value, tokens = values[name]
+			tracks = self._fields[name].get(value)
+			if tracks is not None:
+				tracks.discard(trackID)
+				if not tracks:
+					del self._fields[name][value]
+
+			for token in tokens:
+				posting = self._postings.get(token)
+				if posting is None or posting.pop(trackID, None) is None:
+					continue
+				self._invalidate(token)
+				if not posting:
+					del self._postings[token]
+					del self._tokens[bisect.bisect_left(self._tokens, token)]
+		return True
+
+	def lookup(self, name, value):
+		'''
+		Return a list of the IDs of the tracks whose field has the given value,
+		ignoring case and accents. name is one of 'title', 'artist', 'album'
+		or 'genre'.
+		'''
+
+		self.waitUntilBuilt()
+		return list(self._fields[name].get(normalize(value), ()))
+
+	def search(self, query, limit = DEFAULT_LIMIT):
+		'''
+		Return a list of up to limit IDs of the tracks matching query, best first
+		'''
+
+		self.waitUntilBuilt()
+		terms = tokenize(query)
+		if not terms:
+			return []
+		typing = not query[-1:].isspace()
+
+		# a last word too short to be a prefix is left out until it is a whole
+		# word, so the results for the words before it stay while typing
+		if typing and len(terms) > 1 and len(terms[-1]) < self.MIN_PREFIX_LENGTH \
+				and terms[-1] not in self._postings:
+			terms.pop()
+			typing = False
+
+		# for each word, whether it is a prefix, and the (token, multiplier)
+		# pairs it matches
+		prefixes = [typing and i == len(terms) - 1 and len(term) >= self.MIN_PREFIX_LENGTH
+					for i, term in enumerate(terms)]
+		matches = [self._matches(term, prefix) for term, prefix in zip(terms, prefixes)]
+		if len(matches) == 1:
+			return self._best(matches[0], limit)
+
+		sizes = [sum(len(self._postings[token]) for token, multiplier in tokens) for tokens in matches]
+		driver = min(xrange(len(terms)), key = sizes.__getitem__)
+		if not sizes[driver]:
+			return []
+		if sizes[driver] <= self.SCAN_SIZE and sizes[driver] * self.SCAN_RATIO <= sum(sizes) - sizes[driver]:
+			return self._scan(terms, prefixes, matches[driver], driver, limit)
+		if prefixes[-1]:
+			ret = self._narrow(terms, matches, limit)
+			if ret is not None:
+				return ret
+
+		# each word's score takes one of a few values, so the tracks are
+		# grouped by their score for each word, and the groups intersected in
+		# order of their total score until no group left can reach the top
+		levels = [sorted(self._levels(tokens).iteritems(), reverse = True) for tokens in matches]
+		combinations = sorted(((sum(score for score, tracks in combination), combination)
+							   for combination in itertools.product(*levels)),
+							  key = lambda item: item[0], reverse = True)
+
+		# a track is in the level of each of its scores for a word, so it is
+		# found again in worse combinations after its best one
+		boosts = self._boosts
+		best = []
+		seen = set()
+		for total, combination in combinations:
+			if len(best) == limit and total + MAX_BOOST <= best[0][0]:
+				break
+			groups = sorted((tracks for score, tracks in combination), key = len)
+			common = groups[0].intersection(*groups[1:])
+			for trackID in self._mostBoosted(common, limit + len(seen)):
+				if trackID in seen:
+					continue
+				seen.add(trackID)
+				entry = (total + boosts[trackID], trackID)
+				if len(best) < limit:
+					heapq.heappush(best, entry)
+				elif entry > best[0]:
+					heapq.heapreplace(best, entry)
+				else:
+					break
+
+		best.sort(reverse = True)
+		return [trackID for score, trackID in best]
+
+	def _matches(self, term, prefix):
+		'''
+		Return a list of (token, multiplier) pairs for the tokens matching a
+		word of a query: the word itself, and if prefix is True the tokens
+		starting with it
+		'''
+
+		ret = []
+		if term in self._postings:
+			ret.append((term, self.WORD_MATCH))
+		if prefix:
+			# the tokens starting with term sort before term with its last
+			# character incremented
+			start = bisect.bisect_right(self._tokens, term)
+			end = bisect.bisect_left(self._tokens, term[:-1] + unichr(ord(term[-1]) + 1), start)
+			ret.extend(itertools.izip(self._tokens[start:end], itertools.repeat(self.PREFIX_MATCH)))
+		return ret
+
+	def _scan(self, terms, prefixes, tokens, driver, limit):
+		'''
+		Return the IDs of the limit best tracks for a query of several words,
+		checking the tracks matching the word at index driver, whose matching
+		tokens are given, against the other words
+		'''
+
+		others = [(term, prefix) for i, (term, prefix) in enumerate(zip(terms, prefixes)) if i != driver]
+		boosts = self._boosts
+		entries = []
+		seen = set()
+		for score, tracks in sorted(self._levels(tokens).iteritems(), reverse = True):
+			for trackID in tracks:
+				if trackID in seen:
+					continue
+				seen.add(trackID)
+				total = score
+				for term, prefix in others:
+					termScore = self._score(trackID, term, prefix)
+					if not termScore:
+						break
+					total += termScore
+				else:
+					entries.append((total + boosts[trackID], trackID))
+		return [trackID for score, trackID in heapq.nlargest(limit, entries)]
+
+	def _narrow(self, terms, matches, limit):
+		'''
+		Return the IDs of the limit best tracks for a query of several words
+		ending in a prefix, found by checking the tracks with every whole
+		word against the prefix, or None if grouping the words' tracks by
+		score would be cheaper. A short prefix can match thousands of rare
+		tokens, which would all have to be grouped, while the whole words
+		together may match only a few tracks.
+		'''
+
+		tokens = matches[-1]
+		expansion = sum(len(self._postings[token]) for token, multiplier in tokens
+						if (token, multiplier) not in self._levelCache)
+
+		# the tracks with every whole word, estimated as if the words were
+		# independent, before finding them
+		whole = sorted((len(self._postings[term]), term) for term in terms[:-1])
+		together = float(whole[0][0])
+		for size, term in whole[1:]:
+			together *= size / float(len(self._values))
+		if together * self.SCAN_COST > expansion:
+			return None
+
+		tracks = set(self._postings[whole[0][1]])
+		for size, term in whole[1:]:
+			levels = self._levelCache.get((term, self.WORD_MATCH))
+			if levels is None:
+				tracks.intersection_update(self._postings[term])
+			else:
+				# a common word: its cached groups are sets, so only the
+				# smaller side of each intersection is walked
+				tracks = set().union(*[tracks & group for group in levels.itervalues()])
+		if len(tracks) * self.SCAN_COST > expansion:
+			return None
+
+		boosts = self._boosts
+		entries = []
+		for trackID in tracks:
+			total = self._score(trackID, terms[-1], True)
+			if total:
+				for term in terms[:-1]:
+					total += self._postings[term][trackID] * self.WORD_MATCH
+				entries.append((total + boosts[trackID], trackID))
+		return [trackID for score, trackID in heapq.nlargest(limit, entries)]
+
+	def _score(self, trackID, term, prefix):
+		'''
+		Return a track's score for a word of a query, the same as it would get
+		from the postings, or 0 if the word does not match it
+		'''
+
+		best = 0
+		values = self._values[trackID]
+		for name, weight in self.FIELDS:
+			for token in values[name][1]:
+				if token == term:
+					score = weight * self.WORD_MATCH
+				elif prefix and token.startswith(term):
+					score = weight * self.PREFIX_MATCH
+				else:
+					continue
+				if score > best:
+					best = score
+		return best
+
+	def _mostBoosted(self, tracks, limit):
+		'''
+		Return the limit tracks with the largest boosts from a set, largest first
+		'''
+
+		if len(tracks) * len(tracks) <= limit * len(self._boosts):
+			return heapq.nlargest(limit, tracks, key = self._boosts.__getitem__)
+
+		# a large set: walk every track in order of boost, expecting to find
+		# enough members of the set long before the end
+		if self._byBoost is None:
+			self._byBoost = sorted(self._boosts, key = self._boosts.__getitem__, reverse = True)
+		ret = []
+		for trackID in self._byBoost:
+			if trackID in tracks:
+				ret.append(trackID)
+				if len(ret) == limit:
+					break
+		return ret
+
+	def _levels(self, tokens):
+		'''
+		Return a dictionary of score:set of trackIDs pairs grouping the tracks
+		matching the given (token, multiplier) pairs by score. A track matching
+		several tokens is in the set of each of its scores.
+		'''
+
+		if len(tokens) == 1:
+			return self._tokenLevels(*tokens[0])
+
+		# the tracks of rare tokens are added to shared sets one by one,
+		# rather than grouped for each token and merged, since a prefix can
+		# match thousands of tokens of a track or two
+		groups = {}
+		rare = {}
+		for token, multiplier in tokens:
+			posting = self._postings[token]
+			if len(posting) < self.COMMON_TOKEN_SIZE:
+				for trackID, score in posting.iteritems():
+					tracks = rare.get(score * multiplier)
+					if tracks is None:
+						tracks = rare[score * multiplier] = set()
+					tracks.add(trackID)
+				continue
+			for score, tracks in self._tokenLevels(token, multiplier).iteritems():
+				groups.setdefault(score, []).append(tracks)
+		for score, tracks in rare.iteritems():
+			groups.setdefault(score, []).append(tracks)
+
+		# a level made of one set is used as it is rather than copied, since
+		# for a common word it can be most of the library; the sets may be
+		# cached, so none is modified
+		levels = {}
+		for score, sets in groups.iteritems():
+			levels[score] = sets[0] if len(sets) == 1 else set().union(*sets)
+		return levels
+
+	def _tokenLevels(self, token, multiplier):
+		'''
+		Return the posting of token grouped by score, as for _levels. Cached
+		for common tokens.
+		'''
+
+		levels = self._levelCache.get((token, multiplier))
+		if levels is not None:
+			return levels
+
+		levels = {}
+		for trackID, score in self._postings[token].iteritems():
+			levels.setdefault(score * multiplier, set()).add(trackID)
+		if len(self._postings[token]) >= self.COMMON_TOKEN_SIZE:
+			self._levelCache[(token, multiplier)] = levels
+		return levels
+
+	def _best(self, tokens, limit):
+		'''
+		Return the IDs of the limit best tracks in the postings of the given
+		(token, multiplier) pairs, merging their ranked postings
+		'''
+
+		ret = []
+		seen = set()
+		for key, trackID in heapq.merge(*[self._rank(token, multiplier) for token, multiplier in tokens]):
+			if trackID not in seen:
+				seen.add(trackID)
+				ret.append(trackID)
+				if len(ret) == limit:
+					break
+		return ret
+
+	def _rank(self, token, multiplier):
+		'''
+		Return the posting of token as a sorted list of
+		(-(score * multiplier + boost), trackID) pairs
+		'''
+
+		ranked = self._ranked.get((token, multiplier))
+		if ranked is None:
+			boosts = self._boosts
+			ranked = sorted((-(score * multiplier + boosts[trackID]), trackID)
+							for trackID, score in self._postings[token].iteritems())
+			self._ranked[(token, multiplier)] = ranked
+		return ranked
+
+	def _invalidate(self, token):
+		for multiplier in (self.WORD_MATCH, self.PREFIX_MATCH):
+			self._ranked.pop((token, multiplier), None)
+			self._levelCache.pop((token, multiplier), None)
+
+	def _add(self, trackID, values, boost, sort = True):
+		'''
+		Index a track's (normalized value, tokens) pairs for each field. If sort is
+		False new tokens are appended to _tokens, and the caller must sort it.
+		'''
+
+		self._values[trackID] = values
+		self._boosts[trackID] = boost
+		self._byBoost = None
+		for name, weight in self.FIELDS:
+			value, tokens = values[name]
+			self._fields[name].setdefault(value, set()).add(trackID)
+			for token in tokens:
+				posting = self._postings.get(token)
+				if posting is None:
+					posting = self._postings[token] = {}
+					if sort:
+						bisect.insort(self._tokens, token)
+					else:
+						self._tokens.append(token)
+				elif sort:
+					self._invalidate(token)
+				if weight > posting.get(trackID, 0):
+					posting[trackID] = weight
+
+	def _rebuild(self, store):
+		'''
+		Build the index from a store, while _building keeps every other
+		method waiting
+		'''
+
+		try:
+			self._clear()
+			self._build(store)
+		finally:
+			with self._lock:
+				self._building = False
+				self._lock.notifyAll()
+
+	def _build(self, store):
+		'''
+		Index every live track of a store. Each distinct string is normalized
+		and split once, however many tracks share it.
+		'''
+
+		normalized = {}
+		columns = dict((name, store.column(name)) for name, weight in self.FIELDS)
+		ids = store.column('id')
+		playCounts = store.column('playCount')
+		ratings = store.column('rating')
+
+		for row in store.rows():
+			values = {}
+			for name, weight in self.FIELDS:
+				index = columns[name][row]
+				entry = normalized.get(index)
+				if entry is None:
+					value = normalize(store.string(index))
+					entry = normalized[index] = (value, _TOKEN.findall(value))
+				values[name] = entry
+			# the tokens are sorted once at the end rather than inserted in order
+			self._add(store.string(ids[row]), values, _boost(playCounts[row], ratings[row]), sort = False)
+		self._tokens.sort()
+		self._byBoost = sorted(self._boosts, key = self._boosts.__getitem__, reverse = True)
+
+		for token, posting in self._postings.iteritems():
+			if len(posting) >= self.COMMON_TOKEN_SIZE:
+				for multiplier in (self.WORD_MATCH, self.PREFIX_MATCH):
+					self._rank(token, multiplier)
+					self._tokenLevels(token, multiplier)
+
+		log('Indexed %d tracks, %d words', args = (len(self._values), len(self._tokens)))
+
+# the largest result of _boost
+MAX_BOOST = 0.75
+
+def _boost(playCount, rating):
+	'''
+	A small score for popular and thumbs up tracks, to order otherwise equal
+	results. Never outweighs a matching word.
+	'''
+
+	boost = min(playCount, 100) / 200.0
+	if rating == 5:
+		boost += 0.25
+	return boost
+
+def _number(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return 0
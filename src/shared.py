@@ -1,10 +1,27 @@
-import time
+import atexit
+import threading
+from logger import AsyncLogger, DEBUG, INFO, WARNING, ERROR
 
 OUTPUT_FILE = 'output.txt'
 
-def log(message = None, console = False):
+_logger = None
+_loggerLock = threading.Lock()
+
+def getLogger():
+	'''
+	Return the AsyncLogger writing to OUTPUT_FILE, starting it if needed
+	'''
+	global _logger
+	with _loggerLock:
+		if _logger is None:
+			_logger = AsyncLogger(OUTPUT_FILE)
+			atexit.register(_logger.close)
+		return _logger
+
+def log(message = None, console = False, level = INFO, args = ()):
 	'''
-	print a message with a timestamp to output.txt
+	print a message with a timestamp to output.txt. The message is written by
+	a background thread, so this never waits for the file.
 
 	:param message: the message to write. If absent, a newline is printed
 
@@ -12,25 +29,35 @@ def log(message = None, console = False):
 	console in addition to the file. This allows output.txt to accumulate a
 	complete record of the run, while only information directed to the user
 	is printed to the console.
+
+	:param level: one of DEBUG, INFO, WARNING or ERROR. Messages below the
+	logger's level are dropped
+
+	:param args: if given, the message is formatted as message % args when it
+	is written, so callers on hot paths do not pay for formatting
 	'''
 
-	f = open(OUTPUT_FILE, 'a')
-	if message:
-		timeStamp = time.ctime(time.time())	
-		f.write(timeStamp + ' ' + str(message) + '\n')
+	getLogger().log(message, args, level)
 
-		if console:
-			print message
-	else:
-		f.write('\n')
+	if message is None:
 		print
+	elif console:
+		if args:
+			print message % args
+		else:
+			print message
+
+def debug(message, *args):
+	log(message, level = DEBUG, args = args)
+
+def warning(message, *args):
+	log(message, level = WARNING, args = args)
 
-	f.close()
+def error(message, *args):
+	log(message, level = ERROR, args = args)
 
 def clearLog():
 	'''
 	Erase the contents of the log
 	'''
-	f = open(OUTPUT_FILE, 'w')
-	f.write('')
-	f.close()
\ No newline at end of file
+	getLogger().clear()
@@ -0,0 +1,267 @@
+import time
+from shared import *
+from sampler import WeightedSampler
+
+try:
+	import numpy
+except ImportError:
+	# songs are drawn uniformly, without scoring
+	numpy = None
+
+class ShuffleEngine:
+	'''
+	Chooses the songs to play, learning from what the listener skips. Each
+	song has a penalty, and is drawn with probability proportional to
+	exp(-penalty) times a base weight from its rating and how recently it was
+	last played. Skipping a song adds its similarity to every song in the
+	library to their penalties, so songs like it become less likely;
+	listening to a song to the end takes some back. Penalties decay with
+	each event, so old skips are forgotten.
+
+	Similarity is a weighted sum of a shared artist, album and genre, and of
+	how close the release years are. It is computed for the whole library at
+	once over arrays of interned string codes, so recording an event or
+	drawing a song costs a few vectorized passes even for 100k songs.
+
+	Skips from past sessions, read from an EventStore, lower the base weight
+	of the songs and artists skipped most often.
+
+	Every song is drawn once before any song is drawn again. The weights are
+	kept in a WeightedSampler, so drawing a song costs O(log n); they are
+	replaced as a whole after each event.
+
+	Without NumPy songs are drawn uniformly and events are only counted.
+
+	Members:
+		Private:
+			* _songs: the Songs, indexed by their position in the arrays below
+			* _index: a dictionary of songID:index pairs
+			* _artist, _album, _genre: arrays of string codes for each song.
+				Code 0 is an unknown value, which is never similar to anything
+			* _year: an array of release years, 0 if unknown
+			* _base: an array of each song's weight before penalties
+			* _penalty: an array of each song's penalty
+			* _sampler: a WeightedSampler over the song indices, holding the
+				songs drawn in this cycle
+			* _skips, _completes: the number of events recorded
+	'''
+
+	# contribution of each shared attribute to the similarity of two songs
+	ARTIST_WEIGHT = 1.0
+	ALBUM_WEIGHT = 0.5
+	GENRE_WEIGHT = 0.3
+	YEAR_WEIGHT = 0.2
+
+	# songs released this many years apart or more have no year similarity
+	YEAR_WINDOW = 5
+
+	# multiples of a song's similarity added to the penalties on a skip, and
+	# taken away when a song is played to the end
+	SKIP_PENALTY = 1.0
+	COMPLETE_REWARD = 0.25
+
+	# penalties are multiplied by this on every event
+	DECAY = 0.98
+
+	# the largest penalty, so a song is never ruled out entirely
+	MAX_PENALTY = 10.0
+
+	# base weights for songs rated thumbs up and thumbs down
+	THUMBS_UP_WEIGHT = 2.0
+	THUMBS_DOWN_WEIGHT = 0.1
+
+	# songs played less than this many seconds ago have their base weight
+	# scaled down in proportion, to no less than RECENT_WEIGHT
+	RECENT_WINDOW = 7 * 24 * 3600
+	RECENT_WEIGHT = 0.2
+
+	# a song's base weight is scaled by exp(-weight * rate) for its own and
+	# its artist's past skip rates, where a rate is skips / (plays + PRIOR)
+	SONG_HISTORY_WEIGHT = 1.5
+	ARTIST_HISTORY_WEIGHT = 1.0
+	HISTORY_PRIOR = 2
+
+	def __init__(self, songs, seed = None, history = None):
+		'''
+		:param songs: the Songs to choose from
+		:param seed: if given, the same seed and events give the same songs
+		:param history: an EventStore of past sessions, or None. Ratings and
+			plays recorded in it take precedence over the library's
+		'''
+
+		self._songs = list(songs)
+		self._index = dict((song.id(), i) for i, song in enumerate(self._songs))
+		self._skips = 0
+		self._completes = 0
+
+		if numpy is None:
+			self._sampler = WeightedSampler([1.0] * len(self._songs), seed = seed)
+			return
+
+		self._artist = self._codes('artist')
+		self._album = self._codes('album')
+		self._genre = self._codes('genre')
+		self._year = self._numbers('year').astype(numpy.float64)
+
+		rating = self._numbers('rating')
+		# recentTimestamp is in microseconds, 0 if never played
+		played = self._numbers('recentTimestamp') / 1000000.0
+		if history is not None:
+			for songID, stats in history.allStats().iteritems():
+				index = self._index.get(songID)
+				if index is not None:
+					if stats.rating is not None:
+						rating[index] = stats.rating
+					played[index] = max(played[index], stats.lastPlayed)
+
+		self._base = numpy.ones(len(self._songs))
+		self._base[rating == 5] = self.THUMBS_UP_WEIGHT
+		self._base[rating == 1] = self.THUMBS_DOWN_WEIGHT
+
+		age = time.time() - played
+		recent = (played > 0) & (age < self.RECENT_WINDOW)
+		self._base[recent] *= numpy.maximum(age[recent] / self.RECENT_WINDOW, self.RECENT_WEIGHT)
+
+		if history is not None:
+			self._base *= numpy.exp(-self._historyPenalty(history))
+
+		self._penalty = numpy.zeros(len(self._songs))
+		self._sampler = WeightedSampler(self._base, seed = seed)
+
+	def __len__(self):
+		return len(self._songs)
+
+	def next(self, count = 1):
+		'''
+		Draw songs which have not been drawn in this cycle, starting a new
+		cycle if every song has been drawn. Returns a list of up to count
+		Songs, fewer only if the library is smaller.
+		'''
+
+		ret = []
+		for i in xrange(min(count, len(self._songs))):
+			if not self._sampler.remaining():
+				log('Every song has been played, starting a new shuffle cycle')
+				self._sampler.reset()
+			ret.append(self._songs[self._sampler.draw()])
+		return ret
+
+	def putBack(self, song):
+		'''
+		Return a drawn song which was not played, so it can be drawn again in
+		this cycle
+		'''
+
+		index = self._index.get(song.id())
+		if index is not None:
+			self._sampler.putBack(index)
+
+	def recordSkip(self, song):
+		'''
+		Penalize songs similar to a song which the listener skipped
+		'''
+
+		self._skips += 1
+		self._update(song, self.SKIP_PENALTY)
+
+	def recordComplete(self, song):
+		'''
+		Reduce the penalties of songs similar to a song which was played to the end
+		'''
+
+		self._completes += 1
+		self._update(song, -self.COMPLETE_REWARD)
+
+	def weight(self, song):
+		'''
+		Return the relative probability of drawing the given song, ignoring
+		whether it has been drawn already
+		'''
+
+		return self._sampler.weight(self._index[song.id()])
+
+	def stats(self):
+		return {
+			'songs': len(self._songs),
+			'skips': self._skips,
+			'completes': self._completes,
+			'drawn': len(self._songs) - self._sampler.remaining(),
+		}
+
+	def similarity(self, song):
+		'''
+		Return an array of the similarity of every song to the given song
+		'''
+
+		i = self._index[song.id()]
+		similarity = numpy.zeros(len(self._songs))
+		for codes, weight in ((self._artist, self.ARTIST_WEIGHT), (self._album, self.ALBUM_WEIGHT),
+							  (self._genre, self.GENRE_WEIGHT)):
+			if codes[i]:
+				similarity += weight * (codes == codes[i])
+		if self._year[i]:
+			closeness = 1.0 - numpy.abs(self._year - self._year[i]) / self.YEAR_WINDOW
+			closeness[self._year == 0] = 0
+			similarity += self.YEAR_WEIGHT * numpy.maximum(closeness, 0)
+		return similarity
+
+	def _update(self, song, scale):
+		if numpy is None or song.id() not in self._index:
+			return
+		self._penalty *= self.DECAY
+		self._penalty += scale * self.similarity(song)
+		numpy.clip(self._penalty, 0, self.MAX_PENALTY, out = self._penalty)
+		self._sampler.reweight(self._base * numpy.exp(-self._penalty))
+
+	def _historyPenalty(self, history):
+		'''
+		Return an array of penalties for the songs, and the artists, which
+		were skipped often in the events recorded by history
+		'''
+
+		plays = numpy.zeros(len(self._songs))
+		skips = numpy.zeros(len(self._songs))
+		for songID, stats in history.allStats().iteritems():
+			index = self._index.get(songID)
+			if index is not None:
+				plays[index] = stats.plays
+				skips[index] = stats.skips
+
+		penalty = self.SONG_HISTORY_WEIGHT * skips / (plays + self.HISTORY_PRIOR)
+
+		artistRate = numpy.bincount(self._artist, weights = skips) / \
+					 (numpy.bincount(self._artist, weights = plays) + self.HISTORY_PRIOR)
+		artistRate[0] = 0
+		penalty += self.ARTIST_HISTORY_WEIGHT * artistRate[self._artist]
+		return penalty
+
+	def _codes(self, name):
+		'''
+		Return an array of the string codes of a field for each song. Codes
+		are shared between songs from different stores.
+		'''
+
+		stores = set(id(song.store()) for song in self._songs)
+		if len(stores) == 1:
+			store = self._songs[0].store()
+			rows = numpy.array([song.row() for song in self._songs], dtype = numpy.intp)
+			return store.numpyColumn(name)[rows].astype(numpy.int64)
+
+		codes = {'': 0}
+		ret = numpy.zeros(len(self._songs), dtype = numpy.int64)
+		for i, song in enumerate(self._songs):
+			value = song.store().string(song.store().column(name)[song.row()])
+			ret[i] = codes.setdefault(value, len(codes))
+		return ret
+
+	def _numbers(self, name):
+		'''
+		Return an array of the values of a numeric field for each song
+		'''
+
+		stores = set(id(song.store()) for song in self._songs)
+		if len(stores) == 1:
+			store = self._songs[0].store()
+			rows = numpy.array([song.row() for song in self._songs], dtype = numpy.intp)
+			return store.numpyColumn(name)[rows]
+		return numpy.array([song.store().column(name)[song.row()] for song in self._songs])
@@ -1,12 +1,37 @@
 import shutil
 import os
+import threading
+import time
 import pyglet
 from shared import *
+from audiocache import getAudioCache
+from audiomemory import getAudioMemory
+from albumart import getArtCache
+from metrics import getMetrics
 
 class SongBuffer:
 	'''
 	Class to handle the buffering of a song to prepare for playback. On update,
 	writes its song to file along with associated files such as album art.
+	Songs are looked up in the shared AudioCache first, and downloaded songs
+	are moved into it, so a song is only downloaded once across sessions.
+	While the buffer reads a file from the AudioCache it pins the entry, so
+	the file is not evicted from under it.
+	Once the audio is ready, the song's album art is prepared in the shared
+	ArtCache, so the window can show it without waiting.
+
+	If the memory backend is enabled with configureAudioMemory, a song which
+	fits in its budget is downloaded into memory and decoded from there, so
+	the disc is not on the way to playing it. It is only copied into the
+	AudioCache, once it is playable, if the backend persists songs.
+	Otherwise, or if the song is too big, it is written to the buffer's
+	directory. A song which turns out bigger than its room in memory while
+	it downloads is started again on disc.
+
+	In progressive mode the song becomes playable as soon as prebufferSeconds
+	of it are on disc, and getSource returns a streaming source reading the
+	file while the rest of it is downloaded. Otherwise the song is playable
+	once it is completely downloaded and decoded.
 
 	Members:
 		Public:
@@ -16,45 +41,79 @@ class SongBuffer:
 			* _song: a song object
 			* _filepath: a folder in which to write the buffer's data
 			* _needsUpdate: flag to determine when to rewrite the data
-			* _source: an avbin source for the song
+			* _source: an avbin source for the song. Not used in progressive mode
+			* _audioPath: the file holding the song's audio, either in the
+				audio cache, in memory or in _filepath
+			* _memoryKey: the key of the song's file in the AudioMemory, None
+				if it is not in memory
+			* _cacheKey: the key of the AudioCache entry the buffer has pinned
+				while it reads the entry's file, None if it has none pinned
+			* _progressive: whether the buffer is in progressive mode
+			* _prebufferSeconds: the seconds of audio which must be on disc
+				before the song is playable in progressive mode
+			* _bytesWritten: the number of bytes of the song on disc
+			* _totalBytes: the size of the song in bytes, None if unknown
+			* _complete: True when the whole song is on disc
+			* _failed: True if the last update of the current song failed
+			* _updating: True while a thread is running update
+			* _aborted: an Event set by abort to stop the download of the
+				current update. Each song an update loads gets a new one, so
+				an abort only ever stops the download it was meant for
+			* _progress: a condition protecting the members above, notified
+				whenever they change
 	'''
 
 	'''
 	Filename constants
 	'''
 	AUDIO_FILE = 'audio.mp3'
-	ALBUM_ART_FILE = 'album-art.bmp' #TODO: is this the right extension?
+	# album art is served as JPEG. The extension is only a hint, pyglet tries
+	# its other decoders if the JPEG decoder fails
+	ALBUM_ART_FILE = 'album-art.jpg'
+
+	DEFAULT_PREBUFFER_SECONDS = 5
+
+	# bitrate assumed when estimating the seconds of audio on disc for a
+	# song whose size or duration is unknown. Google serves 320kbps MP3s
+	DEFAULT_BYTES_PER_SECOND = 320 * 1000 / 8
 
-	def __init__(self, path, song = None, debugName = None):
+	def __init__(self, path, song = None, debugName = None, progressive = False,
+				 prebufferSeconds = DEFAULT_PREBUFFER_SECONDS):
 
 		'''
 		:param path: a directory to which the buffe will write its data
 		:param song: the song to store. If song is None, nothing happens.
-<<<<<<< HEAD
 			If song is not None, the buffer will update at the next call to update
-=======
-			If song is not None, the buffer writes to disc immediately
->>>>>>> master
 		:param debugName: the name of the buffer when it writes debug log
 			messages. If debugName is None, the buffer will not write to the log
+		:param progressive: if True, the song can be played before it is
+			completely downloaded
+		:param prebufferSeconds: in progressive mode, the seconds of audio
+			which must be downloaded before the song can be played
 		'''
 
 		self._song = song
 		self._filepath = path
 		self.name = debugName
-<<<<<<< HEAD
 		self._source = None
-=======
->>>>>>> master
+		self._audioPath = None
+		self._memoryKey = None
+		self._cacheKey = None
+		self._progressive = progressive
+		self._prebufferSeconds = prebufferSeconds
+		self._bytesWritten = 0
+		self._totalBytes = None
+		self._complete = False
+		self._failed = False
+		self._updating = False
+		self._aborted = threading.Event()
+		self._progress = threading.Condition()
 		if self._filepath[-1] != '/':
 			# path must be a directory ending in a slash
 			self._filepath += '/'
 
-<<<<<<< HEAD
 		# TODO: something seems to be broken here, the directory is not being created
 		# causing IOError #2 when the song tries to write to the file
-=======
->>>>>>> master
 		osPath = os.path.dirname(self._filepath)
 		if not os.path.exists(osPath):
 			# make a new directory if needed
@@ -64,26 +123,52 @@ class SongBuffer:
 			# without a song, the buffer cannot be updated
 			self._needsUpdate = False
 		else:
-<<<<<<< HEAD
 			# update at the next call to update
 			self._needsUpdate = True
-=======
-			# if given a song, write it to disc
-			self._needsUpdate = True
-			self.update()
->>>>>>> master
 
 	def close(self):
 		'''
-		Delete the directory created by the buffer. No need for it to persist,
-		so deleting it saves space on the user's hard drive.
+		Delete the directory created by the buffer, and the song's file if it
+		is in memory. No need for them to persist, so deleting them saves
+		space on the user's hard drive.
 		'''
 
+		self._releaseMemory()
+		self._releaseCache()
 		shutil.rmtree(self._filepath)
 
 	def getSource(self):
+		'''
+		Return a source for the song, or None if it is not playable yet. In
+		progressive mode each call returns a new streaming source, which reads
+		whatever part of the song is on disc at the time.
+		'''
+
+		if self._progressive:
+			with self._progress:
+				if not self._isPlayable():
+					return None
+				path = self._audioPath
+				song = self._song
+			with getMetrics().span('decode', song = song.id(), buffer = self.name):
+				return pyglet.media.load(path, streaming = True)
+
 		return self._source
 
+	def song(self):
+		return self._song
+
+	def decodedBytes(self):
+		'''
+		Return the size in bytes of the decoded song held in memory, None if
+		it has not been decoded
+		'''
+
+		source = self._source
+		if source is None:
+			return None
+		return int(source.duration * source.audio_format.bytes_per_second)
+
 	def getFile(self, filename):
 		'''
 		Return a path to the given filename. Filename should be a valid SongBuffer
@@ -94,25 +179,427 @@ class SongBuffer:
 
 	def setSong(self, song):
 		if song != self._song:
-			self._needsUpdate = True
-			self._song = song
+			# the old song is no longer wanted, stop downloading it
+			self.abort()
+			with self._progress:
+				self._needsUpdate = True
+				self._song = song
+				self._source = None
+				self._resetProgress()
+				self._progress.notifyAll()
+			self._releaseMemory()
+			self._releaseCache()
+
+	def abort(self):
+		'''
+		Stop an update in progress. The buffer will update again at the next
+		call to update
+		'''
+		with self._progress:
+			self._aborted.set()
+
+	def needsUpdate(self):
+		'''
+		Return True if the buffer's song has not been loaded yet
+		'''
+		return self._needsUpdate
+
+	def isComplete(self):
+		'''
+		Return True if the whole song is on disc
+		'''
+		return self._complete
+
+	def hasFailed(self):
+		'''
+		Return True if the last attempt to update the buffer failed
+		'''
+		return self._failed
+
+	def isPlayableFrom(self, position):
+		'''
+		Return True if the song can be played from the given position in
+		seconds without waiting for more of it to download
+		'''
+
+		with self._progress:
+			return self._isPlayable(position + self._prebufferSeconds)
+
+	def bufferedSeconds(self):
+		'''
+		Return an estimate of the seconds of audio on disc, from the start of
+		the song
+		'''
+
+		with self._progress:
+			return self._bufferedSeconds()
+
+	def waitUntilPlayable(self, seconds = None, timeout = None):
+		'''
+		Block until the song can be played. Returns True if it can, False if
+		the update of the song failed or the timeout expired first.
+
+		:param seconds: in progressive mode, wait for this many seconds of
+			audio rather than prebufferSeconds, eg to resume from a position
+			after an underrun
+		:param timeout: the maximum time to wait in seconds, None to wait for
+			as long as it takes
+		'''
+
+		if timeout is not None:
+			deadline = time.time() + timeout
+
+		with self._progress:
+			while not self._isPlayable(seconds):
+				if self._failed:
+					return False
+				if timeout is None:
+					self._progress.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						return False
+					self._progress.wait(remaining)
+			return True
 
 	def update(self):
 		'''
-		Write the buffer's contents to file. Overwrite existing files
+		Write the buffer's contents to file. Overwrite existing files. If
+		another thread is already updating the buffer, eg for another session
+		sharing it, waits for that update instead of repeating it.
 		'''
 
-		if self._needsUpdate:
+		with self._progress:
+			while self._updating:
+				self._progress.wait()
+			if not self._needsUpdate:
+				return
+			self._updating = True
 
-			if self.name:
-				log('Updating buffer ' + self.name)
+		try:
+			# the song may be changed while we are working on it
+			while self._needsUpdate:
+				# the spans of the update are the buffer's, under its name
+				# at the start of the update
+				with self._progress:
+					song = self._song
+					aborted = self._aborted = threading.Event()
+				with getMetrics().attribute(song.id(), self.name):
+					if not self._updateSong(song, aborted):
+						break
+		except Exception:
+			# waiters would otherwise wait for an update which never ends
+			with self._progress:
+				self._failed = True
+			raise
+		finally:
+			with self._progress:
+				self._updating = False
+				self._progress.notifyAll()
+
+	def _updateSong(self, song, aborted):
+		'''
+		Download and load the given song. Returns False if the download failed
+		or was aborted, or the song could not be decoded, while the song was
+		still the buffer's song, True otherwise.
+
+		:param aborted: the Event which abort sets to stop this download
+		'''
+
+		if self.name:
+			log('Updating buffer %s', args = (self.name,))
+
+		# the cached file is pinned until the song is decoded, or in
+		# progressive mode until the buffer is done playing it
+		cache = getAudioCache()
+		path = cache.lookup(song.id(), pin = True)
+		if path is not None:
+			self._holdCacheEntry(song)
+		with self._progress:
+			if song is not self._song:
+				return True
+			self._resetProgress()
+
+		inMemory = False
+		if path is None:
+			path = self._reserveMemory(song)
+			inMemory = path is not None
+			if not inMemory:
+				path = self.getFile(self.AUDIO_FILE)
+			with self._progress:
+				self._audioPath = path
+
+			written = self._writeAudio(song, path, aborted, inMemory)
+			if written is None:
+				# too big for memory after all
+				inMemory = False
+				path = self.getFile(self.AUDIO_FILE)
+				with self._progress:
+					if song is not self._song:
+						return True
+					self._resetProgress()
+					self._audioPath = path
+				written = self._writeAudio(song, path, aborted, False)
+
+			if not written:
+				with self._progress:
+					if song is not self._song:
+						# aborted because the song was changed
+						return True
+					# leave _needsUpdate set so we try again. An aborted
+					# download is not a failure, whoever aborted it will
+					# restart it if it is still wanted
+					if not aborted.is_set():
+						self._failed = True
+					self._progress.notifyAll()
+				if self.name:
+					log('Abandoned update of buffer %s', args = (self.name,))
+				return False
+
+			if not inMemory:
+				# keep the song for next time. If it does not fit in the
+				# cache, play it from the buffer's directory
+				stored = cache.store(song.id(), path, pin = True)
+				if stored is not None:
+					self._holdCacheEntry(song)
+					path = stored
+		elif self.name:
+			log('Found song in audio cache: buffer %s', args = (self.name,))
 
-			self._song.writeAudioToFile(self.getFile(self.AUDIO_FILE))
-			self._source = pyglet.media.load(self.getFile(self.AUDIO_FILE), streaming = False)
+		source = None
+		if not self._progressive:
+			try:
+				with getMetrics().span('decode'):
+					source = pyglet.media.load(path, streaming = False)
+			except (pyglet.media.MediaException, IOError, OSError) as e:
+				log('Unable to decode song for buffer %s: %s', args = (self.name, e))
+				self._releaseCache()
+				if inMemory:
+					self._releaseMemory()
+				with self._progress:
+					if song is not self._song:
+						return True
+					# a song which does not decode will not decode next time,
+					# so unlike an abort this is a failure
+					self._failed = True
+					self._progress.notifyAll()
+				return False
 
-			# TODO: album art
+		with self._progress:
+			if song is not self._song:
+				# the song was changed while we were downloading
+				return True
 
+			self._audioPath = path
+			self._source = source
+			self._complete = True
 			self._needsUpdate = False
+			self._progress.notifyAll()
 
+		if not self._progressive:
+			# the decoded source does not read the file
+			self._releaseCache()
+
+		if inMemory:
+			self._storeFromMemory(song, path)
+
+		self._updateArt(song)
+
+		if self.name:
+			log('Finished updating buffer %s', args = (self.name,))
+		return True
+
+	def _writeAudio(self, song, path, aborted, inMemory):
+		'''
+		Download the song to the given path. Returns True if it was written,
+		False if the download failed or was aborted, or None if the song is
+		in memory and outgrew its reservation there, in which case the
+		reservation has been released.
+		'''
+
+		spilled = threading.Event()
+		def onProgress(written, total):
+			if inMemory and not spilled.is_set() and not self._fitsInMemory(written, total):
+				spilled.set()
+			self._onProgress(song, written, total)
+
+		if song.writeAudioToFile(path, onProgress, aborted = lambda: aborted.is_set() or spilled.is_set()):
+			return True
+		if not spilled.is_set() or aborted.is_set():
+			return False
+
+		if self.name:
+			log('Song is bigger than its room in memory, writing it to disc: buffer %s', args = (self.name,))
+		self._releaseMemory()
+		return None
+
+	def _fitsInMemory(self, written, total):
+		'''
+		Resize the song's reservation in memory to its real size, once the
+		server has said what it is, or to the bytes written so far if they
+		pass the estimate. Returns False if it does not fit.
+		'''
+
+		memory = getAudioMemory()
+		key = self._memoryKey
+		if memory is None or key is None:
+			return True
+		with self._progress:
+			# a song which may be playing from memory cannot be moved, so it
+			# stays there over the budget
+			playing = self._progressive and self._isPlayable()
+		if total is not None:
+			return memory.resize(key, total, force = playing)
+		return memory.resize(key, written, exact = False, force = playing)
+
+	def _updateArt(self, song):
+		'''
+		Prepare the song's album art, if it has any. Failing to get it does
+		not fail the update, the song plays without it.
+		'''
+
+		art = getArtCache()
+		url = song.albumArtUrl()
+		if art is None or not url or song is not self._song:
+			return
+		if not art.prepare(url, self.getFile(self.ALBUM_ART_FILE), song.writeAlbumArtToFile):
 			if self.name:
-				log('Finished updating buffer ' + self.name)
+				log('Unable to prepare album art: buffer %s', args = (self.name,))
+
+	def _reserveMemory(self, song):
+		'''
+		Return a path in memory to download the song to, or None if the
+		memory backend is not enabled or the song does not fit in its budget
+		'''
+
+		memory = getAudioMemory()
+		if memory is None:
+			return None
+
+		duration = song.duration()
+		if duration is None:
+			# assume a four minute song
+			duration = 4 * 60 * 1000
+		key = song.id() + ('-progressive' if self._progressive else '')
+		path = memory.reserve(key, int(duration / 1000.0 * self.DEFAULT_BYTES_PER_SECOND))
+		if path is None:
+			if self.name:
+				log('Song does not fit in memory, writing it to disc: buffer %s', args = (self.name,))
+			return None
+		self._memoryKey = key
+		return path
+
+	def _storeFromMemory(self, song, path):
+		'''
+		Keep a song which was downloaded into memory in the AudioCache for
+		next time, now that it is playable, if the memory backend persists
+		songs. A decoded song no longer needs its file, so the file is moved
+		out of memory, or deleted if it is not kept. In progressive mode the
+		song is played from the file, so it is copied and stays in memory
+		until the buffer is closed.
+		'''
+
+		memory = getAudioMemory()
+		if memory is None or not memory.persists():
+			if not self._progressive:
+				self._releaseMemory()
+			return
+
+		cache = getAudioCache()
+		if not self._progressive:
+			stored = cache.store(song.id(), path)
+			if stored is None:
+				# too big for the cache, keep it in memory
+				return
+			with self._progress:
+				if song is self._song:
+					self._audioPath = stored
+			self._releaseMemory()
+			return
+
+		copy = self.getFile(self.AUDIO_FILE)
+		try:
+			shutil.copyfile(path, copy)
+		except (IOError, OSError) as e:
+			log('Unable to copy song out of memory: ' + str(e))
+			return
+		if cache.store(song.id(), copy) is None:
+			os.remove(copy)
+
+	def _holdCacheEntry(self, song):
+		'''
+		Keep the pin on the song's AudioCache entry until _releaseCache, or
+		give it up at once if the song is no longer the buffer's
+		'''
+
+		with self._progress:
+			if song is self._song and self._cacheKey is None:
+				self._cacheKey = song.id()
+				return
+		getAudioCache().unpin(song.id())
+
+	def _releaseCache(self):
+		with self._progress:
+			key = self._cacheKey
+			self._cacheKey = None
+		if key is not None:
+			getAudioCache().unpin(key)
+
+	def _releaseMemory(self):
+		memory = getAudioMemory()
+		key = self._memoryKey
+		self._memoryKey = None
+		if memory is not None and key is not None:
+			memory.release(key)
+
+	def _onProgress(self, song, written, total):
+		with self._progress:
+			if song is self._song:
+				self._bytesWritten = written
+				self._totalBytes = total
+				self._progress.notifyAll()
+
+	def _resetProgress(self):
+		'''
+		Caller must hold _progress
+		'''
+		self._bytesWritten = 0
+		self._totalBytes = None
+		self._complete = False
+		self._failed = False
+
+	def _bufferedSeconds(self):
+		'''
+		Caller must hold _progress
+		'''
+
+		duration = None
+		if self._song is not None:
+			duration = self._song.duration()
+
+		if self._complete:
+			if duration is not None:
+				return duration / 1000.0
+			return float('inf')
+
+		if self._totalBytes and duration:
+			bytesPerSecond = self._totalBytes * 1000.0 / duration
+		else:
+			bytesPerSecond = self.DEFAULT_BYTES_PER_SECOND
+		return self._bytesWritten / float(bytesPerSecond)
+
+	def _isPlayable(self, seconds = None):
+		'''
+		Caller must hold _progress
+		'''
+
+		if self._song is None:
+			return False
+		if not self._progressive:
+			return self._complete and self._source is not None
+		if self._complete:
+			return True
+
+		if seconds is None:
+			seconds = self._prebufferSeconds
+		return self._audioPath is not None and self._bufferedSeconds() >= seconds
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+from audiocache import AudioCache
+
+class AudioCacheTest(unittest.TestCase):
+	def setUp(self):
+		self._directory = tempfile.mkdtemp()
+		self._cacheDirectory = os.path.join(self._directory, 'cache')
+
+	def tearDown(self):
+		shutil.rmtree(self._directory, ignore_errors = True)
+
+	def makeFile(self, name, size):
+		path = os.path.join(self._directory, name)
+		with open(path, 'wb') as f:
+			f.write('x' * size)
+		return path
+
+	def indexKeys(self):
+		with open(os.path.join(self._cacheDirectory, AudioCache.INDEX_FILE)) as f:
+			return [line.split('\t')[0] for line in f]
+
+	def testStoreAndLookup(self):
+		cache = AudioCache(self._cacheDirectory, budget = 100)
+		path = cache.store('a', self.makeFile('a', 10))
+		self.assertEqual(cache.lookup('a'), path)
+		self.assertTrue(os.path.exists(path))
+		self.assertEqual(cache.lookup('b'), None)
+		stats = cache.stats()
+		self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 10))
+
+	def testEvictsLeastRecentlyUsed(self):
+		cache = AudioCache(self._cacheDirectory, budget = 30)
+		for key in 'abc':
+			cache.store(key, self.makeFile(key, 10))
+		cache.lookup('a')
+		cache.store('d', self.makeFile('d', 10))
+		self.assertFalse(cache.contains('b'))
+		self.assertTrue(cache.contains('a'))
+		self.assertEqual(cache.size(), 30)
+
+	def testLookupSavesIndexLazily(self):
+		cache = AudioCache(self._cacheDirectory, budget = 100)
+		for key in 'ab':
+			cache.store(key, self.makeFile(key, 10))
+		cache.lookup('a')
+		self.assertEqual(self.indexKeys(), ['a', 'b'])
+		cache.close()
+		self.assertEqual(self.indexKeys(), ['b', 'a'])
+
+		# the order is kept from one session to the next
+		cache = AudioCache(self._cacheDirectory, budget = 20)
+		cache.store('c', self.makeFile('c', 10))
+		self.assertEqual(self.indexKeys(), ['a', 'c'])
+
+	def testPinnedEntriesAreNotEvicted(self):
+		cache = AudioCache(self._cacheDirectory, budget = 20)
+		path = cache.store('a', self.makeFile('a', 10), pin = True)
+		cache.store('b', self.makeFile('b', 10))
+		cache.store('c', self.makeFile('c', 10))
+		self.assertTrue(os.path.exists(path))
+		self.assertFalse(cache.contains('b'))
+
+		# with every other entry pinned there is no room
+		self.assertEqual(cache.lookup('c', pin = True), cache._path('c'))
+		filename = self.makeFile('d', 10)
+		self.assertEqual(cache.store('d', filename), None)
+		self.assertTrue(os.path.exists(filename))
+
+		cache.unpin('a')
+		self.assertTrue(cache.store('d', filename) is not None)
+		self.assertFalse(cache.contains('a'))
+		self.assertTrue(cache.contains('c'))
+
+	def testStoringPinnedKeyKeepsCachedFile(self):
+		cache = AudioCache(self._cacheDirectory, budget = 100)
+		path = cache.store('a', self.makeFile('a', 10), pin = True)
+		filename = self.makeFile('a2', 12)
+		self.assertEqual(cache.store('a', filename), path)
+		self.assertFalse(os.path.exists(filename))
+		self.assertEqual(os.path.getsize(path), 10)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from audiomemory import AudioMemory
+
+class AudioMemoryTest(unittest.TestCase):
+	def setUp(self):
+		# any directory will do in place of a memory file system
+		self._parent = tempfile.mkdtemp()
+		self._memory = AudioMemory(budget = 100, parent = self._parent)
+
+	def tearDown(self):
+		self._memory.close()
+		shutil.rmtree(self._parent, ignore_errors = True)
+
+	def testReserve(self):
+		path = self._memory.reserve('a', 60)
+		self.assertTrue(path.startswith(self._parent))
+		self.assertEqual(self._memory.reserve('a', 60), path)
+		self.assertEqual(self._memory.reserve('b', 50), None)
+		stats = self._memory.stats()
+		self.assertEqual((stats['files'], stats['bytes'], stats['fallbacks']), (1, 60, 1))
+
+	def testResizeToRealSize(self):
+		self._memory.reserve('a', 60)
+		self.assertTrue(self._memory.resize('a', 30))
+		self.assertTrue(self._memory.reserve('b', 70) is not None)
+		self.assertFalse(self._memory.resize('a', 40))
+		self.assertEqual(self._memory.stats()['bytes'], 100)
+		self.assertEqual(self._memory.stats()['spills'], 1)
+		self.assertFalse(self._memory.resize('unknown', 10))
+
+	def testResizeAtLeast(self):
+		self._memory.reserve('a', 60)
+		self.assertTrue(self._memory.resize('a', 10, exact = False))
+		self.assertEqual(self._memory.stats()['bytes'], 60)
+		self.assertTrue(self._memory.resize('a', 90, exact = False))
+		self.assertEqual(self._memory.stats()['bytes'], 90)
+		self.assertFalse(self._memory.resize('a', 110, exact = False))
+		self.assertTrue(self._memory.resize('a', 110, exact = False, force = True))
+		self.assertEqual(self._memory.reserve('b', 1), None)
+
+	def testRelease(self):
+		path = self._memory.reserve('a', 60)
+		for filename in (path, path + '.part'):
+			open(filename, 'w').close()
+		self._memory.release('a')
+		self.assertFalse(os.path.exists(path))
+		self.assertFalse(os.path.exists(path + '.part'))
+		self.assertEqual(self._memory.stats()['bytes'], 0)
+
+if __name__ == '__main__':
+	unittest.main()
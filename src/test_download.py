@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+from download import RangeDownload
+from fakeservice import FakeMusicServer, FRAME, FRAME_SIZE, audioSize
+
+# long enough to be fetched in several segments
+DURATION_MILLIS = 30000
+SEGMENT_BYTES = 64 * 1024
+
+def servedAudio(durationMillis):
+	'''
+	Return the bytes FakeMusicServer serves for a song of the given length
+	'''
+	return FRAME * (audioSize(durationMillis) / FRAME_SIZE)
+
+class RangeDownloadTest(unittest.TestCase):
+	def setUp(self):
+		self._directory = tempfile.mkdtemp()
+		self._filename = os.path.join(self._directory, 'song.mp3')
+
+	def tearDown(self):
+		shutil.rmtree(self._directory, ignore_errors = True)
+
+	def startServer(self, **options):
+		server = FakeMusicServer(**options)
+		server.addSong('a', DURATION_MILLIS)
+		server.start()
+		self.addCleanup(server.stop)
+		return server
+
+	def makeDownload(self, url, aborted = lambda: False, **options):
+		download = RangeDownload(url, self._filename, aborted, **options)
+		# small segments, so that even a fast connection fetches several
+		download.FIRST_SEGMENT_BYTES = SEGMENT_BYTES
+		download.MIN_SEGMENT_BYTES = download.MAX_SEGMENT_BYTES = SEGMENT_BYTES
+		return download
+
+	def downloaded(self):
+		with open(self._filename, 'rb') as f:
+			return f.read()
+
+	def testRangedDownload(self):
+		server = self.startServer()
+		progress = []
+		download = self.makeDownload(server.url('a'), progress = lambda written, total: progress.append((written, total)))
+		self.assertTrue(download.run())
+
+		audio = servedAudio(DURATION_MILLIS)
+		self.assertTrue(self.downloaded() == audio)
+		self.assertEqual(server.stats()['requests'], (len(audio) + SEGMENT_BYTES - 1) / SEGMENT_BYTES)
+		self.assertEqual(progress[-1], (len(audio), len(audio)))
+		# a reader of the file never sees the contiguous bytes shrink
+		self.assertEqual([written for written, total in progress], sorted(written for written, total in progress))
+		self.assertFalse(os.path.exists(self._filename + RangeDownload.PARTIAL_SUFFIX))
+
+	def testServerIgnoringRanges(self):
+		server = self.startServer(acceptRanges = False)
+		download = self.makeDownload(server.url('a'), key = 'a')
+		self.assertTrue(download.run())
+
+		self.assertTrue(self.downloaded() == servedAudio(DURATION_MILLIS))
+		self.assertEqual(server.stats()['requests'], 1)
+		# a download in one stream cannot be resumed, so nothing is recorded
+		self.assertFalse(os.path.exists(self._filename + RangeDownload.PARTIAL_SUFFIX))
+
+	def testResumeAfterAbort(self):
+		server = self.startServer(bandwidth = 256 * 1024)
+		stopped = []
+		def progress(written, total):
+			if written >= 2 * SEGMENT_BYTES:
+				stopped.append(True)
+		download = self.makeDownload(server.url('a'), lambda: bool(stopped), progress = progress, key = 'a')
+		self.assertFalse(download.run())
+		self.assertTrue(os.path.exists(self._filename + RangeDownload.PARTIAL_SUFFIX))
+
+		requests = server.stats()['requests']
+		download = self.makeDownload(server.url('a'), key = 'a')
+		self.assertTrue(download.run())
+		audio = servedAudio(DURATION_MILLIS)
+		self.assertTrue(download.resumedBytes() >= 2 * SEGMENT_BYTES)
+		# the segments already on disc are not fetched again
+		segments = (len(audio) + SEGMENT_BYTES - 1) / SEGMENT_BYTES
+		self.assertTrue(server.stats()['requests'] - requests <= segments - 2)
+		self.assertTrue(self.downloaded() == audio)
+		self.assertFalse(os.path.exists(self._filename + RangeDownload.PARTIAL_SUFFIX))
+
+	def testRejectedUrlIsRefreshed(self):
+		server = self.startServer()
+		# the first URL has already expired, so the server answers 403
+		server.urlLifetime = -60
+		url = server.url('a')
+		server.urlLifetime = 3600
+		refreshed = []
+		def refreshUrl():
+			refreshed.append(True)
+			return server.url('a')
+		download = self.makeDownload(url, refreshUrl = refreshUrl)
+		download.RETRY_DELAY = 0.01
+		self.assertTrue(download.run())
+
+		self.assertEqual(len(refreshed), 1)
+		self.assertEqual(download.retries(), 1)
+		self.assertTrue(self.downloaded() == servedAudio(DURATION_MILLIS))
+
+if __name__ == '__main__':
+	unittest.main()
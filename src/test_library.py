@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from library import LibraryStore, LibrarySnapshot
+from Song import SongMap
+
+def track(trackID, title, **fields):
+	fields.update({'id': trackID, 'title': title})
+	return fields
+
+class LibrarySnapshotTest(unittest.TestCase):
+	def setUp(self):
+		self._directory = tempfile.mkdtemp()
+		self._filename = os.path.join(self._directory, 'library.dat')
+
+	def tearDown(self):
+		shutil.rmtree(self._directory, ignore_errors = True)
+
+	def saved(self, tracks):
+		snapshot = LibrarySnapshot(self._filename)
+		snapshot.replace(tracks)
+		snapshot.save()
+		snapshot = LibrarySnapshot(self._filename)
+		self.assertTrue(snapshot.load())
+		return snapshot
+
+	def testLoadDoesNotIndexRows(self):
+		store = self.saved([track('a', u'Alpha'), track('b', u'B\xe9ta', durationMillis = '1000')]).store()
+		self.assertEqual(store._rows, None)
+		self.assertEqual(store._strings, None)
+		self.assertEqual(len(store), 2)
+		self.assertEqual(store.get(1, 'title'), u'B\xe9ta')
+		self.assertEqual(store.get(1, 'durationMillis'), 1000)
+		self.assertEqual(store._rows, None)
+
+		self.assertEqual(store.row('b'), 1)
+		self.assertEqual(store.row('c'), None)
+
+	def testChangesAfterLoad(self):
+		snapshot = self.saved([track('a', u'Alpha'), track('b', u'Beta'), track('c', u'Gamma')])
+		snapshot.apply([{'id': 'b', 'deleted': True}, track('d', u'Alpha', year = '1999')])
+		store = snapshot.store()
+		self.assertEqual(len(store), 3)
+		self.assertEqual(store.rows(), [0, 2, 3])
+		self.assertEqual(store.get(store.row('d'), 'title'), u'Alpha')
+		snapshot.save()
+
+		snapshot = LibrarySnapshot(self._filename)
+		self.assertTrue(snapshot.load())
+		store = snapshot.store()
+		self.assertEqual(len(store), 3)
+		self.assertEqual(store.row('d'), 2)
+		self.assertEqual(store.get(2, 'year'), 1999)
+
+	def testDamagedSnapshot(self):
+		self.saved([track('a', u'Alpha')])
+		with open(self._filename, 'r+b') as f:
+			f.truncate(LibrarySnapshot.HEADER.size + 6)
+		snapshot = LibrarySnapshot(self._filename)
+		self.assertFalse(snapshot.load())
+		self.assertEqual(len(snapshot.store()), 0)
+
+class SongMapTest(unittest.TestCase):
+	def testSongsAreCreatedOnUse(self):
+		store = LibraryStore()
+		for trackID in 'abc':
+			store.put(track(trackID, trackID.upper()))
+		store.remove('b')
+		songs = SongMap(store, None)
+		self.assertEqual(len(songs), 2)
+		self.assertEqual(songs._songs, {})
+		self.assertEqual(songs['c'].title(), u'C')
+		self.assertTrue(songs['c'] is songs['c'])
+		self.assertEqual(len(songs._songs), 1)
+		self.assertFalse('b' in songs)
+		self.assertRaises(KeyError, lambda: songs['b'])
+		self.assertEqual(songs.get('b'), None)
+		self.assertEqual(sorted(songs.keys()), ['a', 'c'])
+		self.assertEqual(sorted(song.id() for song in songs.itervalues()), [u'a', u'c'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,104 @@
+import random
+import unittest
+from playqueue import PlayQueue
+
+class PlayQueueTest(unittest.TestCase):
+	'''
+	Tests of PlayQueue against a list holding the same sequence
+	'''
+
+	def assertMatches(self, queue, expected):
+		self.assertEqual(list(queue), expected)
+		self.assertEqual(len(queue), len(expected))
+		for index, key in enumerate(expected):
+			self.assertEqual(queue[index], key)
+			self.assertEqual(queue.index(key), index)
+			self.assertTrue(key in queue)
+
+	def testInitialKeys(self):
+		self.assertMatches(PlayQueue(range(10), seed = 1), range(10))
+		self.assertMatches(PlayQueue(), [])
+
+	def testInsert(self):
+		queue = PlayQueue(['a', 'c'], seed = 1)
+		queue.insert(1, 'b')
+		queue.insert(0, 'start')
+		queue.insert(100, 'end')
+		queue.insert(-5, 'first')
+		self.assertMatches(queue, ['first', 'start', 'a', 'b', 'c', 'end'])
+
+	def testInsertExistingKey(self):
+		queue = PlayQueue(['a', 'b'], seed = 1)
+		self.assertRaises(ValueError, queue.insert, 0, 'b')
+		self.assertMatches(queue, ['a', 'b'])
+
+	def testRemove(self):
+		queue = PlayQueue('abcde', seed = 1)
+		self.assertEqual(queue.remove('c'), 2)
+		self.assertEqual(queue.remove('a'), 0)
+		self.assertEqual(queue.remove('e'), 2)
+		self.assertMatches(queue, ['b', 'd'])
+		self.assertFalse('c' in queue)
+		self.assertRaises(KeyError, queue.remove, 'c')
+		self.assertRaises(KeyError, queue.index, 'c')
+
+	def testPop(self):
+		queue = PlayQueue('abcd', seed = 1)
+		self.assertEqual(queue.pop(), 'd')
+		self.assertEqual(queue.pop(0), 'a')
+		self.assertMatches(queue, ['b', 'c'])
+
+	def testMove(self):
+		queue = PlayQueue('abcde', seed = 1)
+		queue.move('a', 3)
+		self.assertMatches(queue, ['b', 'c', 'd', 'a', 'e'])
+		queue.move('e', 0)
+		self.assertMatches(queue, ['e', 'b', 'c', 'd', 'a'])
+
+	def testGet(self):
+		queue = PlayQueue('abc', seed = 1)
+		self.assertEqual(queue.get(-1), 'c')
+		self.assertEqual(queue.get(-3), 'a')
+		self.assertRaises(IndexError, queue.get, 3)
+		self.assertRaises(IndexError, queue.get, -4)
+		self.assertRaises(IndexError, PlayQueue().get, 0)
+
+	def testSlice(self):
+		queue = PlayQueue(range(10), seed = 1)
+		self.assertEqual(queue.slice(2, 5), [2, 3, 4])
+		self.assertEqual(queue.slice(-3, 2), [0, 1])
+		self.assertEqual(queue.slice(8, 20), [8, 9])
+		self.assertEqual(queue.slice(5, 5), [])
+
+	def testSeedDoesNotAffectOrder(self):
+		for seed in range(5):
+			self.assertMatches(PlayQueue(range(50), seed = seed), range(50))
+
+	def testRandomOperations(self):
+		generator = random.Random(0)
+		queue = PlayQueue(seed = 0)
+		expected = []
+		nextKey = 0
+		for i in range(2000):
+			operation = generator.random()
+			if operation < 0.5 or not expected:
+				index = generator.randint(0, len(expected))
+				queue.insert(index, nextKey)
+				expected.insert(index, nextKey)
+				nextKey += 1
+			elif operation < 0.75:
+				key = generator.choice(expected)
+				self.assertEqual(queue.remove(key), expected.index(key))
+				expected.remove(key)
+			else:
+				key = generator.choice(expected)
+				index = generator.randint(0, len(expected) - 1)
+				queue.move(key, index)
+				expected.remove(key)
+				expected.insert(index, key)
+			if i % 100 == 0:
+				self.assertMatches(queue, expected)
+		self.assertMatches(queue, expected)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,111 @@
+import gc
+import random
+import time
+import unittest
+from library import LibraryStore
+from search import LibraryIndex, tokenize
+
+WORDS = ('blue', 'moon', 'love', 'night', 'heart', 'fire', 'rain', 'city', 'dream', 'baby',
+		 'river', 'sky', 'gold', 'sweet', 'light')
+
+def generateLibrary(numTracks, seed = 0):
+	'''
+	Return a LibraryStore of tracks whose titles mix a few common words, many
+	rare ones and the track's number, so that a short number prefix matches
+	thousands of rare tokens
+	'''
+
+	generator = random.Random(seed)
+	store = LibraryStore()
+	for i in range(numTracks):
+		words = [generator.choice(WORDS) if generator.random() < 0.4 else 'w%d' % generator.randrange(2000)
+				 for j in range(generator.randint(1, 3))]
+		artist = generator.randrange(200)
+		store.put({
+			'id': 't%d' % i,
+			'title': ' '.join(words) + ' %d' % i,
+			'artist': 'Artist %d' % artist,
+			'album': 'Album %d-%d' % (artist, generator.randrange(3)),
+			'genre': generator.choice(('Rock', 'Pop', 'Jazz', 'Folk')),
+			'playCount': generator.randrange(50),
+			'rating': generator.choice(('0', '5')),
+		})
+	return store
+
+class LibraryIndexTest(unittest.TestCase):
+	def expected(self, index, query, limit = LibraryIndex.DEFAULT_LIMIT):
+		'''
+		Return the scores of the best tracks for a query whose last word is a
+		prefix, checking every track
+		'''
+
+		terms = tokenize(query)
+		scores = []
+		for trackID in index._values:
+			wordScores = [index._score(trackID, term, i == len(terms) - 1) for i, term in enumerate(terms)]
+			if all(wordScores):
+				scores.append(sum(wordScores) + index._boosts[trackID])
+		return sorted(scores, reverse = True)[:limit]
+
+	def scores(self, index, trackIDs, query):
+		terms = tokenize(query)
+		return [sum(index._score(trackID, term, i == len(terms) - 1) for i, term in enumerate(terms))
+				+ index._boosts[trackID] for trackID in trackIDs]
+
+	def testPrefix(self):
+		index = LibraryIndex()
+		for trackID, title in enumerate((u'Blue', u'Bluegrass', u'Blues', u'Blv', u'Bl\xfc')):
+			index.put({'id': str(trackID), 'title': title})
+		# accents are ignored, so Bl\xfc is the whole word blu
+		self.assertEqual(sorted(index.search('blu')), ['0', '1', '2', '4'])
+		self.assertEqual(index.search('blu '), ['4'])
+		self.assertEqual(index.search('blue ')[0], '0')
+
+	def testQueriesEndingInPrefix(self):
+		index = LibraryIndex(generateLibrary(5000))
+		for query in ('blue moon 12', 'moon 12', 'rock blue 12', 'artist 27', 'artist 1 12', 'love w1',
+					  'sky gold', 'album 27 w1'):
+			results = index.search(query)
+			self.assertEqual(len(set(results)), len(results))
+			for expected, score in zip(self.expected(index, query), self.scores(index, results, query)):
+				self.assertAlmostEqual(expected, score)
+			self.assertEqual(len(results), len(self.expected(index, query)))
+
+	def testRebuildInBackground(self):
+		store = generateLibrary(2000)
+		index = LibraryIndex()
+		index.rebuild(store, background = True)
+		# searching and changing the index wait for the build
+		self.assertEqual(index.search('blue moon 1'), LibraryIndex(store).search('blue moon 1'))
+		index.rebuild(store, background = True)
+		index.put({'id': 'new', 'title': 'Blue Moon 1'})
+		self.assertEqual(len(index), len(store) + 1)
+		self.assertTrue('new' in index.search('blue moon 1'))
+
+	def testFirstKeystrokeTime(self):
+		'''
+		Each keystroke of a search over 100k tracks is answered within
+		BUDGET. The rankings cached by a search are dropped before each run,
+		so every run is as slow as the first, and the fastest of a few runs
+		is taken so the time is the search's rather than the machine's.
+		'''
+
+		BUDGET = 0.010
+		index = LibraryIndex(generateLibrary(100000))
+		ranked = dict(index._ranked)
+		slowest = (0, None)
+		# the garbage from building the index is not the search's
+		gc.collect()
+		for query in ('blue moon 12', 'rock blue 12', 'artist 27', 'artist 12', 'artist 1 12', 'love night he'):
+			for end in range(1, len(query) + 1):
+				seconds = []
+				for run in range(3):
+					index._ranked = dict(ranked)
+					start = time.time()
+					index.search(query[:end])
+					seconds.append(time.time() - start)
+				slowest = max(slowest, (min(seconds), query[:end]))
+		self.assertTrue(slowest[0] < BUDGET, 'searching for %r took %.1fms' % (slowest[1], slowest[0] * 1000))
+
+if __name__ == '__main__':
+	unittest.main()
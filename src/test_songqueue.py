@@ -0,0 +1,315 @@
+import unittest
+import SongQueue as songqueue
+from SongQueue import SongQueue
+
+class FakeSong(object):
+	def __init__(self, songID):
+		self._id = songID
+		self.data = {'id': songID, 'title': songID}
+
+	def id(self):
+		return self._id
+
+	def title(self):
+		return self._id
+
+	def duration(self):
+		return 180000
+
+class FakeBuffer(object):
+	'''
+	A buffer which is complete, or which becomes complete when it is waited
+	for if buffered is False
+	'''
+
+	def __init__(self, buffered = True):
+		self._buffered = buffered
+
+	def waitUntilPlayable(self, seconds = None, timeout = None):
+		self._buffered = True
+		return True
+
+	def isPlayableFrom(self, position):
+		return self._buffered
+
+	def isComplete(self):
+		return True
+
+	def hasFailed(self):
+		return False
+
+	def getSource(self):
+		return None
+
+class FakePrefetch(object):
+	def __init__(self, lookahead = 1, lookbehind = 1, **kwargs):
+		self._lookahead = lookahead
+		self._lookbehind = lookbehind
+		self.window = None
+		self.unbuffered = {}
+
+	def lookahead(self):
+		return self._lookahead
+
+	def lookbehind(self):
+		return self._lookbehind
+
+	def setWindow(self, current, after, before):
+		self.window = (current.id(), [song.id() for song in after], [song.id() for song in before])
+
+	def getBuffer(self, song):
+		'''
+		Songs whose IDs are added to unbuffered are not buffered until they
+		are waited for
+		'''
+		if song.id() in self.unbuffered:
+			return self.unbuffered[song.id()]
+		return FakeBuffer()
+
+	def close(self):
+		pass
+
+class FakeShuffle(object):
+	'''
+	Draws the songs in the order given by draws, then in library order,
+	putting songs put back at the front
+	'''
+
+	draws = []
+
+	def __init__(self, songs, seed = None, history = None):
+		self._songs = dict((song.id(), song) for song in songs)
+		self._order = sorted(self._songs)
+		self._draws = list(self.draws)
+		self._drawn = 0
+		self.skipped = []
+
+	def next(self, count = 1):
+		ret = []
+		for i in range(count):
+			if self._draws:
+				songID = self._draws.pop(0)
+			else:
+				songID = self._order[self._drawn % len(self._order)]
+				self._drawn += 1
+			ret.append(self._songs[songID])
+		return ret
+
+	def putBack(self, song):
+		self._draws.insert(0, song.id())
+
+	def recordSkip(self, song):
+		self.skipped.append(song.id())
+
+	def recordComplete(self, song):
+		pass
+
+class FakePlayer(object):
+	playing = False
+	time = 0.0
+
+	def play(self):
+		self.playing = True
+
+	def pause(self):
+		self.playing = False
+
+	def seek(self, position):
+		self.time = position
+
+class FakeTransitions(object):
+	def __init__(self, onTransition = None, onEnd = None):
+		self._player = FakePlayer()
+		self._current = None
+
+	def player(self):
+		return self._player
+
+	def current(self):
+		return self._current
+
+	def play(self, key, source, position = 0):
+		self._current = key
+		self._player.time = position
+		self._player.play()
+
+	def preload(self, key, source):
+		return False
+
+	def queued(self):
+		return None
+
+	def stop(self):
+		self._current = None
+		self._player.pause()
+
+class SongQueueTest(unittest.TestCase):
+	'''
+	Tests of the moves through and changes to the queue. The buffers,
+	shuffle and player are replaced with fakes.
+	'''
+
+	def setUp(self):
+		self._replaced = {}
+		for name, fake in (('PrefetchManager', FakePrefetch), ('ShuffleEngine', FakeShuffle),
+						   ('TransitionEngine', FakeTransitions)):
+			self._replaced[name] = getattr(songqueue, name)
+			setattr(songqueue, name, fake)
+		FakeShuffle.draws = []
+
+	def tearDown(self):
+		for name, original in self._replaced.iteritems():
+			setattr(songqueue, name, original)
+		FakeShuffle.draws = []
+
+	def makeQueue(self, songIDs, draws = ()):
+		FakeShuffle.draws = list(draws)
+		queue = SongQueue(dict((songID, FakeSong(songID)) for songID in songIDs))
+		self.addCleanup(queue.close)
+		return queue
+
+	def current(self, queue):
+		return queue.getCurrentSongInfo()['id']
+
+	def upcoming(self, queue, count = 10):
+		return [song.id() for song in queue.upcoming(count)]
+
+	def history(self, queue, count = 10):
+		return [song.id() for song in queue.history(count)]
+
+	def testPlayThrough(self):
+		queue = self.makeQueue('abc')
+		queue.togglePlay()
+		self.assertEqual(self.current(queue), 'a')
+		queue.playNext()
+		queue.playNext()
+		self.assertEqual(self.current(queue), 'c')
+		self.assertEqual(self.history(queue), ['b', 'a'])
+		queue.playPrevious()
+		self.assertEqual(self.current(queue), 'b')
+		self.assertEqual(self.upcoming(queue, 1), ['c'])
+
+	def testRedrawnSongKeepsHistory(self):
+		queue = self.makeQueue('ab', draws = 'ababab')
+		queue.togglePlay()
+		queue.playNext()
+		queue.playNext()
+		# a is drawn again in the next cycle, and was played before
+		self.assertEqual(self.current(queue), 'a')
+		self.assertEqual(self.history(queue), ['b', 'a'])
+		queue.playNext()
+		self.assertEqual(self.history(queue), ['a', 'b', 'a'])
+
+	def testRedrawnQueuedSongIsNotQueuedTwice(self):
+		queue = self.makeQueue('abc', draws = 'abbc')
+		queue.togglePlay()
+		queue.playNext()
+		self.assertEqual(self.current(queue), 'b')
+		self.assertFalse('b' in self.upcoming(queue))
+		self.assertEqual(self.history(queue), ['a'])
+
+	def testPlayNextOnPlayedSong(self):
+		queue = self.makeQueue('abcd')
+		queue.togglePlay()
+		queue.playNext()
+		queue.playAfterCurrent('a')
+		self.assertEqual(self.upcoming(queue, 1), ['a'])
+		self.assertEqual(self.history(queue), ['a'])
+		queue.playNext()
+		self.assertEqual(self.current(queue), 'a')
+		self.assertEqual(self.history(queue), ['b', 'a'])
+
+	def testInsertSongMovesQueuedSong(self):
+		queue = self.makeQueue('abcde')
+		queue.togglePlay()
+		self.assertTrue(queue.insertSong('c', 5))
+		self.assertEqual(self.upcoming(queue).count('c'), 1)
+		self.assertFalse(queue.insertSong('a', 0))
+		self.assertFalse(queue.insertSong('unknown', 0))
+
+	def testMoveSong(self):
+		queue = self.makeQueue('abcd')
+		queue.togglePlay()
+		queue._fillQueue(3)
+		self.assertEqual(self.upcoming(queue), ['b', 'c', 'd'])
+		self.assertTrue(queue.moveSong('d', 0))
+		self.assertEqual(self.upcoming(queue), ['d', 'b', 'c'])
+		# only queued songs can be moved
+		self.assertFalse(queue.moveSong('a', 0))
+		queue.playNext()
+		self.assertFalse(queue.moveSong('a', 0))
+		self.assertEqual(self.history(queue), ['a'])
+
+	def testRemoveSong(self):
+		queue = self.makeQueue('abcd', draws = 'abcabcd')
+		queue.togglePlay()
+		queue.playNext()
+		queue.playNext()
+		queue.playNext()
+		self.assertEqual(self.current(queue), 'a')
+		self.assertEqual(self.history(queue), ['c', 'b', 'a'])
+		self.assertFalse(queue.removeSong('a'))
+
+		# b is queued, so its queued entry goes and the history is kept
+		queue.playAfterCurrent('b')
+		self.assertTrue(queue.removeSong('b'))
+		self.assertEqual(self.history(queue), ['c', 'b', 'a'])
+		self.assertFalse('b' in self.upcoming(queue))
+
+		# c is only in the history
+		self.assertTrue(queue.removeSong('c'))
+		self.assertEqual(self.history(queue), ['b', 'a'])
+		self.assertEqual(self.current(queue), 'a')
+		self.assertFalse(queue.removeSong('unknown'))
+
+	def testJumpTo(self):
+		queue = self.makeQueue('abcde')
+		queue.togglePlay()
+		queue._fillQueue(4)
+		self.assertTrue(queue.jumpTo(2))
+		self.assertEqual(self.current(queue), 'c')
+		self.assertEqual(self.history(queue), ['b', 'a'])
+		self.assertTrue(queue.jumpTo(-2))
+		self.assertEqual(self.current(queue), 'a')
+		self.assertFalse(queue.jumpTo(-1))
+		self.assertFalse(queue.jumpTo(0))
+
+	def testSkipRedrawsUnplayedSongs(self):
+		queue = self.makeQueue('abcde', draws = 'abcd')
+		queue.togglePlay()
+		queue._fillQueue(3)
+		self.assertEqual(self.upcoming(queue), ['b', 'c', 'd'])
+		queue.playNext()
+		# c and d were put back, and one of them drawn again
+		self.assertEqual(self.current(queue), 'b')
+		upcoming = self.upcoming(queue)
+		self.assertEqual(len(upcoming), 1)
+		self.assertTrue(upcoming[0] in ('c', 'd'))
+		self.assertEqual(queue._shuffle.skipped, ['a'])
+
+	def testSeekEndsSkipBurst(self):
+		queue = self.makeQueue('abcd')
+		queue.togglePlay()
+		queue._fillQueue(3)
+		for songID in 'bcd':
+			queue._prefetch.unbuffered[songID] = FakeBuffer(buffered = False)
+		queue.playNext()
+		skippedTo = self.upcoming(queue, 1)[0]
+		queue.playNext()
+		self.assertEqual(queue.playbackTime(), None)
+		self.assertTrue(queue.seek(30.0))
+		self.assertEqual(self.current(queue), skippedTo)
+		self.assertEqual(queue._transitions.current(), skippedTo)
+		self.assertEqual(queue.playbackTime(), 30.0)
+
+	def testPrefetchWindow(self):
+		queue = self.makeQueue('abc', draws = 'abab')
+		queue.togglePlay()
+		queue.playNext()
+		queue.playNext()
+		current, after, before = queue._prefetch.window
+		self.assertEqual(current, 'a')
+		self.assertEqual(before, ['b'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,228 @@
+import time
+from collections import deque
+import pyglet
+from shared import *
+
+class TransitionEngine:
+	'''
+	Plays songs one after another on a single pyglet Player. The source of
+	the next song is queued on the player before the current song ends, so
+	the player moves on to it by itself: sources with the same audio format
+	are played as one stream, and the start of the next one is decoded into
+	the audio driver's buffers ahead of the boundary. Songs are identified
+	by a key, such as a song ID.
+
+	When there is nothing queued, or the caller wants a different song, the
+	next song is started explicitly, which leaves a gap while the player
+	creates its audio output. The gap of every transition is measured, from
+	the end of the previous song to the next song being heard: the time
+	since the end of stream, less how far the next song has played, once it
+	has started.
+
+	Members:
+		Private:
+			* _player: the pyglet Player, created once
+			* _current: the key of the song playing, None if none
+			* _queued: the key of the song queued after it, None if none
+			* _onTransition: called with the key of the new song when the
+				player moves on to the queued song by itself
+			* _onEnd: called with the key of the song which ended when the
+				player runs out of songs
+			* _ended: True once the end of the current song has been handled,
+				since both on_eos and on_player_eos may report it
+			* _endTime: the time at which the last song ended, until the gap
+				after it has been measured
+			* _gaps: the gaps of the most recent transitions in seconds
+			* _stats: counters for stats()
+	'''
+
+	# how often to check whether the song after a transition is heard, in seconds
+	GAP_POLL_INTERVAL = 0.005
+
+	# gaps longer than this are recorded as this long
+	MAX_GAP = 10.0
+
+	# the number of gaps kept for gaps()
+	HISTORY = 100
+
+	def __init__(self, onTransition = None, onEnd = None):
+		'''
+		:param onTransition: called with the key of the new song when the
+			player moves on to the queued song by itself
+		:param onEnd: called with the key of the song which ended when there
+			is no song queued after it
+		'''
+
+		self._player = pyglet.media.Player()
+		self._player.on_eos = self._onEos
+		self._player.on_source_group_eos = self._onSourceGroupEos
+		self._player.on_player_eos = self._onPlayerEos
+		self._onTransition = onTransition
+		self._onEnd = onEnd
+		self._current = None
+		self._queued = None
+		self._ended = False
+		self._endTime = None
+		self._gaps = deque(maxlen = self.HISTORY)
+		self._stats = {
+			'transitions': 0,
+			'gapless': 0,
+			'totalGap': 0.0,
+			'maxGap': 0.0,
+		}
+
+	def player(self):
+		'''
+		Return the Player, for pausing, seeking and reading the time. Its
+		sources must not be changed other than through the engine.
+		'''
+		return self._player
+
+	def current(self):
+		return self._current
+
+	def queued(self):
+		return self._queued
+
+	def play(self, key, source, position = 0):
+		'''
+		Play a song now from the given position in seconds, dropping anything
+		queued. If a different song just ended, this is its transition.
+		'''
+
+		pyglet.clock.unschedule(self._measureGap)
+		measure = self._endTime is not None and key != self._current
+
+		# delete clears the player's sources without dispatching events,
+		# and the player can be used again afterwards
+		self._player.delete()
+		self._player.queue(source)
+		if position:
+			self._player.seek(position)
+		self._player.play()
+
+		self._current = key
+		self._queued = None
+		self._ended = False
+		if measure:
+			self._startMeasuring()
+		else:
+			self._endTime = None
+
+	def preload(self, key, source):
+		'''
+		Queue a song to be played when the current one ends. Returns False if
+		there is no current song or a song is already queued.
+		'''
+
+		if self._current is None or self._queued is not None or self._ended:
+			return False
+		self._player.queue(source)
+		self._queued = key
+		return True
+
+	def stop(self):
+		'''
+		Stop playback and drop every song
+		'''
+
+		pyglet.clock.unschedule(self._measureGap)
+		self._player.delete()
+		self._current = None
+		self._queued = None
+		self._ended = False
+		self._endTime = None
+
+	def gaps(self):
+		'''
+		Return a list of the gaps of the most recent transitions in seconds,
+		oldest first
+		'''
+		return list(self._gaps)
+
+	def stats(self):
+		'''
+		Return a dictionary describing the transitions:
+			* transitions: the number of transitions measured
+			* gapless: the number made by the player moving on to a queued song
+			* meanGap, maxGap, lastGap: gaps in seconds, None if there were none
+		'''
+
+		stats = dict(self._stats)
+		count = stats['transitions']
+		stats['meanGap'] = stats.pop('totalGap') / count if count else None
+		stats['lastGap'] = self._gaps[-1] if self._gaps else None
+		if not count:
+			stats['maxGap'] = None
+		return stats
+
+	def _onEos(self):
+		'''
+		The player reached the end of a source. With pyglet 1.2 this is only
+		dispatched when a queued source of the same audio format follows,
+		once it has started
+		'''
+
+		self._endTime = time.time()
+		if self._queued is None:
+			self._end()
+			return
+
+		self._stats['gapless'] += 1
+		self._transition()
+
+	def _onSourceGroupEos(self):
+		'''
+		The player ran out of sources of one audio format. It moves on to the
+		next queued source, if there is one, as it does by default
+		'''
+
+		self._endTime = time.time()
+		queued = self._queued is not None
+		self._player.next_source()
+		if queued:
+			self._transition()
+
+	def _transition(self):
+		key = self._queued
+		self._current = key
+		self._queued = None
+		self._startMeasuring()
+		if self._onTransition is not None:
+			self._onTransition(key)
+
+	def _onPlayerEos(self):
+		'''
+		The player ran out of sources
+		'''
+
+		if self._endTime is None:
+			self._endTime = time.time()
+		self._end()
+
+	def _end(self):
+		if self._ended or self._current is None:
+			return
+		self._ended = True
+		if self._onEnd is not None:
+			self._onEnd(self._current)
+
+	def _startMeasuring(self):
+		pyglet.clock.unschedule(self._measureGap)
+		pyglet.clock.schedule_interval(self._measureGap, self.GAP_POLL_INTERVAL)
+
+	def _measureGap(self, dt):
+		elapsed = time.time() - self._endTime
+		position = self._player.time if self._player.playing else 0.0
+		if position <= 0 and elapsed < self.MAX_GAP:
+			return
+
+		pyglet.clock.unschedule(self._measureGap)
+		self._endTime = None
+		gap = min(max(elapsed - position, 0.0), self.MAX_GAP)
+		self._gaps.append(gap)
+		self._stats['transitions'] += 1
+		self._stats['totalGap'] += gap
+		if gap > self._stats['maxGap']:
+			self._stats['maxGap'] = gap
+		debug('Transition gap %.1f ms', gap * 1000)
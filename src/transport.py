@@ -0,0 +1,260 @@
+import threading
+import time
+import ssl
+import urllib3
+import certifi
+from urlparse import urljoin
+from urllib3.util.ssl_ import create_urllib3_context
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from shared import *
+
+# Set by the connections below when they open a socket, so that a request can
+# tell whether it paid for a new connection. Thread local because several
+# threads send requests through the same pools at once.
+_connectFlag = threading.local()
+
+class _TimedHTTPConnection(HTTPConnection):
+	def connect(self):
+		_connectFlag.connected = True
+		HTTPConnection.connect(self)
+
+class _TimedHTTPSConnection(HTTPSConnection):
+	def connect(self):
+		_connectFlag.connected = True
+		HTTPSConnection.connect(self)
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+	ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = _TimedHTTPSConnection
+
+class RequestTiming:
+	'''
+	Timing information for a single request made through a Transport
+
+	Members:
+		Public:
+			* host: the host the request was sent to
+			* start: the time at which the request was sent
+			* elapsed: seconds from sending the request to receiving the
+				response headers. For a new connection this includes the TCP
+				and TLS handshakes
+			* newConnection: True if a new connection had to be opened for
+				the request, False if a pooled connection was reused
+			* status: the HTTP status of the response, None on failure
+	'''
+
+	def __init__(self, host, start, elapsed, newConnection, status):
+		self.host = host
+		self.start = start
+		self.elapsed = elapsed
+		self.newConnection = newConnection
+		self.status = status
+
+	def __str__(self):
+		if self.newConnection:
+			connection = 'new connection'
+		else:
+			connection = 'reused connection'
+		return '%s %.3fs (%s, status %s)' % (self.host, self.elapsed, connection, self.status)
+
+class Transport:
+	'''
+	A pool of keep-alive HTTP(S) connections shared by everything in the
+	process that fetches audio. Connections to a host are kept open between
+	requests, so only the first request to a host pays for the TCP and TLS
+	handshakes, and the CA bundle is loaded once for the lifetime of the
+	transport rather than once per request.
+
+	Use getTransport() to get the process-wide instance.
+
+	Members:
+		Private:
+			* _manager: the urllib3 PoolManager holding a connection pool per host
+			* _poolSize: the number of connections kept open to a host unless
+				overridden in _hostPoolSizes
+			* _hostPoolSizes: a dictionary of host:pool size overrides
+			* _timings: the RequestTimings of the most recent requests, oldest first
+			* _lock: protects _timings and the counters
+	'''
+
+	# enough for a couple of buffers each downloading a song over
+	# RangeDownload.DEFAULT_CONNECTIONS connections
+	DEFAULT_POOL_SIZE = 8
+
+	# number of pools (hosts) kept open at once
+	DEFAULT_NUM_POOLS = 10
+
+	# number of RequestTimings kept for timings()
+	TIMING_HISTORY = 256
+
+	# redirects followed by request() before giving up
+	MAX_REDIRECTS = 5
+
+	def __init__(self, poolSize = DEFAULT_POOL_SIZE, hostPoolSizes = None, numPools = DEFAULT_NUM_POOLS):
+		'''
+		:param poolSize: the number of connections kept open to each host
+		:param hostPoolSizes: a dictionary of host:pool size pairs for hosts
+			that should not use poolSize
+		:param numPools: the number of hosts to keep connections open to
+		'''
+
+		# build the SSL context once so the CA bundle is only read once
+		context = create_urllib3_context(cert_reqs = ssl.CERT_REQUIRED)
+		context.load_verify_locations(certifi.where())
+
+		self._manager = urllib3.PoolManager(
+			num_pools = numPools,
+			maxsize = poolSize,
+			cert_reqs = 'CERT_REQUIRED',
+			ssl_context = context
+		)
+		self._manager.pool_classes_by_scheme = {
+			'http': _TimedHTTPConnectionPool,
+			'https': _TimedHTTPSConnectionPool
+		}
+		self._poolSize = poolSize
+		self._hostPoolSizes = dict(hostPoolSizes or {})
+
+		self._timings = []
+		self._requests = 0
+		self._newConnections = 0
+		self._lock = threading.Lock()
+
+	def setHostPoolSize(self, host, size):
+		'''
+		Set the number of connections kept open to the given host. Takes effect
+		for pools created after the call.
+		'''
+		self._hostPoolSizes[host] = size
+
+	def request(self, method, url, headers = None, preload_content = False, retries = False, timeout = None):
+		'''
+		Send a request and return the urllib3 response. By default the body is
+		not preloaded: read it with response.stream() and call
+		response.release_conn() when done so the connection goes back to the pool.
+
+		:param method: the HTTP method, eg 'GET'
+		:param url: the URL to request
+		:param headers: a dictionary of extra request headers
+		:param preload_content: if True, read the whole body before returning
+		:param retries: passed on to urllib3. By default failures are raised
+			immediately so the caller can decide what to do
+		:param timeout: a urllib3 timeout, or None for no timeout
+		'''
+
+		for _ in range(self.MAX_REDIRECTS + 1):
+			pool = self._pool(url)
+
+			_connectFlag.connected = False
+			start = time.time()
+			status = None
+			try:
+				response = pool.urlopen(method, url, headers = headers,
+										preload_content = preload_content,
+										redirect = False, retries = retries,
+										timeout = timeout, assert_same_host = False)
+				status = response.status
+			finally:
+				self._record(RequestTiming(pool.host, start, time.time() - start,
+										   _connectFlag.connected,
+										   status))
+
+			location = response.get_redirect_location()
+			if not location:
+				return response
+
+			# follow the redirect through the pool for the new host
+			response.drain_conn()
+			response.release_conn()
+			url = urljoin(url, location)
+			method = 'GET' if response.status == 303 else method
+
+		raise urllib3.exceptions.MaxRetryError(pool, url, 'too many redirects')
+
+	def timings(self):
+		'''
+		Return a list of RequestTimings for the most recent requests, oldest first
+		'''
+		with self._lock:
+			return list(self._timings)
+
+	def stats(self):
+		'''
+		Return a dictionary summarizing the requests made so far:
+			* requests: the number of requests sent
+			* newConnections: the number of requests that opened a connection
+			* reusedConnections: the number of requests sent over a pooled
+				connection
+			* meanNewConnectionTime: the mean time to headers of recent
+				requests that opened a connection, None if there were none
+			* meanReusedConnectionTime: the same for requests that reused one
+		'''
+		with self._lock:
+			new = [t.elapsed for t in self._timings if t.newConnection]
+			reused = [t.elapsed for t in self._timings if not t.newConnection]
+			return {
+				'requests': self._requests,
+				'newConnections': self._newConnections,
+				'reusedConnections': self._requests - self._newConnections,
+				'meanNewConnectionTime': sum(new) / len(new) if new else None,
+				'meanReusedConnectionTime': sum(reused) / len(reused) if reused else None,
+			}
+
+	def clear(self):
+		'''
+		Close all pooled connections
+		'''
+		self._manager.clear()
+
+	def _pool(self, url):
+		'''
+		Return the connection pool for the host of the given URL
+		'''
+		host = urllib3.util.url.parse_url(url).host
+		if host in self._hostPoolSizes:
+			return self._manager.connection_from_url(url,
+				pool_kwargs = {'maxsize': self._hostPoolSizes[host]})
+		return self._manager.connection_from_url(url)
+
+	def _record(self, timing):
+		with self._lock:
+			self._requests += 1
+			if timing.newConnection:
+				self._newConnections += 1
+			self._timings.append(timing)
+			if len(self._timings) > self.TIMING_HISTORY:
+				del self._timings[0]
+		log('request timing: %s', args = (timing,))
+
+
+_transport = None
+_transportLock = threading.Lock()
+
+def getTransport():
+	'''
+	Return the process-wide Transport, creating it with default settings if
+	configureTransport has not been called
+	'''
+	global _transport
+	with _transportLock:
+		if _transport is None:
+			_transport = Transport()
+		return _transport
+
+def configureTransport(poolSize = Transport.DEFAULT_POOL_SIZE, hostPoolSizes = None):
+	'''
+	Replace the process-wide Transport with one using the given pool sizes.
+	Should be called at startup, before any songs are fetched.
+
+	:param poolSize: the number of connections kept open to each host
+	:param hostPoolSizes: a dictionary of host:pool size overrides
+	'''
+	global _transport
+	with _transportLock:
+		if _transport is not None:
+			_transport.clear()
+		_transport = Transport(poolSize, hostPoolSizes)
+		return _transport